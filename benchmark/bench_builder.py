@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+Benchmark generating code with xasm.builder.CodeBuilder against
+formatting the same code as assembly text and assembling that.
+
+    python benchmark/bench_builder.py --methods 400 --blocks 40
+"""
+import contextlib
+import io
+import os.path as osp
+import sys
+import time
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+sys.path.insert(0, osp.dirname(osp.abspath(__file__)))
+
+import click
+from listing import make_listing
+
+from xasm.assemble import asm_string
+from xasm.builder import CodeBuilder
+
+
+def build(methods: int, blocks: int):
+    """
+    Build the module of listing.make_listing() with CodeBuilder.
+    """
+    module = CodeBuilder("3.8", filename="bench.py")
+    functions = []
+    line = 1
+    for m in range(methods):
+        f = module.nested(
+            f"f{m}", argcount=2, flags=0x43, stacksize=4, first_line=line
+        )
+        for name in ("a", "b", "c"):
+            f.varname(name)
+        for value in (None, 0, 1, "step"):
+            f.const(value)
+        for b in range(blocks):
+            f.line(line)
+            f.emit("LOAD_FAST", 0)
+            f.emit("LOAD_FAST", 1)
+            f.emit("COMPARE_OP", 4)
+            f.emit("POP_JUMP_IF_FALSE", f"L{b}1")
+            f.line(line + 1)
+            f.emit("LOAD_FAST", 1)
+            f.emit("LOAD_FAST", 0)
+            f.emit("ROT_TWO")
+            f.emit("STORE_FAST", 0)
+            f.emit("STORE_FAST", 1)
+            f.emit("JUMP_FORWARD", f"L{b}2")
+            f.label(f"L{b}1")
+            f.line(line + 2)
+            f.emit("LOAD_GLOBAL", f.name("print"))
+            f.emit("LOAD_CONST", 3)
+            f.emit("LOAD_FAST", 2)
+            f.emit("CALL_FUNCTION", 2)
+            f.emit("POP_TOP")
+            f.label(f"L{b}2")
+            f.line(line + 3)
+            f.emit("LOAD_FAST", 0)
+            f.emit("LOAD_CONST", 2)
+            f.emit("BINARY_ADD")
+            f.emit("STORE_FAST", 2)
+            line += 4
+        f.emit("LOAD_FAST", 2)
+        f.emit("RETURN_VALUE")
+        functions.append(f.build())
+    module.line(1)
+    for m, co in enumerate(functions):
+        module.emit("LOAD_CONST", module.const(co))
+        module.emit("LOAD_CONST", module.const(f"f{m}"))
+        module.emit("MAKE_FUNCTION", 0)
+        module.emit("STORE_NAME", module.name(f"f{m}"))
+    module.emit("LOAD_CONST", module.const(None))
+    module.emit("RETURN_VALUE")
+    return module.build()
+
+
+def assemble_text(methods: int, blocks: int):
+    """
+    Format the module as assembly text, and assemble it.
+    """
+    asm = asm_string(make_listing(methods, blocks), keep_instructions=False)
+    return asm.code_list[0]
+
+
+@click.command()
+@click.option("--methods", default=200, help="number of functions in the module")
+@click.option("--blocks", default=40, help="instruction blocks per function")
+@click.option("--repeat", default=3, help="number of timing runs; the best is reported")
+def main(methods: int, blocks: int, repeat: int) -> None:
+    best = {}
+    for _ in range(repeat):
+        for how in (assemble_text, build):
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                how(methods, blocks)
+            elapsed = time.perf_counter() - start
+            if how not in best or elapsed < best[how]:
+                best[how] = elapsed
+    text, built = best[assemble_text], best[build]
+    print(
+        f"{methods} methods of {blocks} blocks: text and asm_string() "
+        f"{text:.3f}s, CodeBuilder {built:.3f}s ({text / built:.1f}x faster)"
+    )
+
+
+if __name__ == "__main__":
+    main()
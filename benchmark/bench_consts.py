@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+Benchmark assembling a method that loads many distinct constants and
+names given as "(value)" operands, which must be looked up in, and
+added to, co_consts and co_names.
+
+Run this on two checkouts to compare, e.g.:
+
+    python benchmark/bench_consts.py --count 20000
+"""
+import contextlib
+import io
+import os.path as osp
+import sys
+import time
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+
+import click
+
+from xasm.assemble import asm_string
+
+
+def make_listing(count: int) -> str:
+    lines = ["# Python bytecode 3.8 (3413)", "# Method Name: <module>", "  1:"]
+    for i in range(count):
+        lines.append(f"            LOAD_CONST           ({i})")
+        lines.append(f"            STORE_NAME           (name{i})")
+    lines.append("            LOAD_CONST           (None)")
+    lines.append("            RETURN_VALUE")
+    return "\n".join(lines) + "\n"
+
+
+@click.command()
+@click.option("--count", default=10000, help="number of constants and names")
+@click.option("--repeat", default=3, help="number of timing runs; the best is reported")
+def main(count: int, repeat: int) -> None:
+    text = make_listing(count)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            asm = asm_string(text, keep_instructions=False)
+        elapsed = time.perf_counter() - start
+        assert len(asm.code_list[0].co_consts) == count + 1
+        if best is None or elapsed < best:
+            best = elapsed
+    print(f"{count} constants and names: best of {repeat} {best:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Benchmark building the pyc-convert intermediate form from a bytecode
+file: through a ``pydisasm --xasm`` listing, as pyc-convert used to,
+versus directly from the loaded code object with code_to_asm().
+"""
+import contextlib
+import io
+import os
+import os.path as osp
+import sys
+import time
+from tempfile import NamedTemporaryFile
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+sys.path.insert(0, osp.dirname(osp.abspath(__file__)))
+
+import click
+from listing import make_listing
+from xdis import disassemble_file, load_module
+
+from xasm.assemble import asm_string
+from xasm.pyc_convert import code_to_asm
+from xasm.write_pyc import write_pycfile
+
+
+def best_time(fn, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+@click.command()
+@click.option("--methods", default=200, help="number of functions in the module")
+@click.option("--blocks", default=40, help="instruction blocks per function")
+@click.option("--version", default="3.8", help="bytecode version of the module")
+@click.option("--repeat", default=3, help="number of timing runs; the best is reported")
+def main(methods: int, blocks: int, version: str, repeat: int) -> None:
+    with contextlib.redirect_stdout(io.StringIO()):
+        asm = asm_string(make_listing(methods, blocks, version))
+    with NamedTemporaryFile("wb", suffix=".pyc", delete=False) as fp:
+        write_pycfile(fp, asm.code_list, 0, asm.python_version, asm.is_pypy)
+    try:
+
+        def text_path():
+            # What pyc-convert did before: disassemble to text and reparse it.
+            out = io.StringIO()
+            disassemble_file(fp.name, out, asm_format="xasm")
+            asm_string(out.getvalue())
+
+        def direct_path():
+            version, timestamp, _, co, is_pypy, _, _ = load_module(fp.name)
+            code_to_asm(co, version, is_pypy, timestamp)
+
+        text_time = best_time(text_path, repeat)
+        direct_time = best_time(direct_path, repeat)
+    finally:
+        os.unlink(fp.name)
+    print(f"{methods} methods, Python {version}, best of {repeat}:")
+    print(f"  disassemble + asm_string: {text_time:.3f}s")
+    print(f"  load_module + code_to_asm: {direct_time:.3f}s")
+    print(f"  speedup: {text_time / direct_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
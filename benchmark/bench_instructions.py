@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+Benchmark the memory and time taken by the instructions of a large
+listing, which are kept in Assembler.codes when assembling with
+keep_instructions=True, as pyc_convert and other tools do.
+
+Run this on two checkouts to compare, e.g.:
+
+    python benchmark/bench_instructions.py --methods 200 --blocks 50
+"""
+import contextlib
+import io
+import os.path as osp
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+sys.path.insert(0, osp.dirname(osp.abspath(__file__)))
+
+import click
+from listing import make_listing
+
+from xasm.assemble import Instruction, asm_string
+
+
+@click.command()
+@click.option("--methods", default=200, help="number of methods in the listing")
+@click.option("--blocks", default=50, help="number of blocks per method")
+@click.option("--repeat", default=3, help="number of timing runs; the best is reported")
+def main(methods: int, blocks: int, repeat: int) -> None:
+    text = make_listing(methods, blocks)
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            asm = asm_string(text)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    count = sum(len(code.instructions) for code in asm.codes)
+    del asm
+
+    # Measure what stays allocated once assembly is done, most of
+    # which is instructions.
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        asm = asm_string(text)
+    kept, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # Keep the assembly alive until it has been measured.
+    del asm
+
+    # Python 3.11 and later allocate an instance __dict__ only when it
+    # is asked for, so measure the size of an instruction by making some.
+    tracemalloc.start()
+    insts = []
+    for _ in range(10000):
+        inst = Instruction()
+        inst.opname, inst.opcode, inst.arg = "LOAD_FAST", 124, 1
+        inst.line_no, inst.offset = None, 2
+        insts.append(inst)
+    inst_size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    inst_size = (inst_size - sys.getsizeof(insts)) / len(insts)
+
+    print(f"{count} instructions; {inst_size:.0f} bytes per Instruction object")
+    print(f"memory kept: {kept / count:.0f} bytes per instruction")
+    print(
+        f"assembly: best of {repeat} {best:.3f}s, "
+        f"{count / best:,.0f} instructions per second"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""
+Benchmark assembling a large generated listing from its text against
+assembling it from the IR file written by --emit-ir.
+
+    python benchmark/bench_ir.py --methods 400 --blocks 40
+"""
+import contextlib
+import io
+import os.path as osp
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+sys.path.insert(0, osp.dirname(osp.abspath(__file__)))
+
+import click
+from listing import make_listing
+
+from xasm.assemble import asm_file
+from xasm.ir import ir_path, write_ir_file
+
+
+@click.command()
+@click.option("--methods", default=200, help="number of functions in the listing")
+@click.option("--blocks", default=40, help="instruction blocks per function")
+@click.option("--version", default="3.8", help="bytecode version of the listing")
+@click.option("--repeat", default=5, help="number of timing runs; the best is reported")
+def main(methods: int, blocks: int, version: str, repeat: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        asm_path = osp.join(tmp_dir, "bench.pyasm")
+        with open(asm_path, "w") as fp:
+            fp.write(make_listing(methods, blocks, version))
+        path = ir_path(asm_path)
+        write_ir_file(asm_path, path)
+        best = {}
+        # The two are run in turn, so that changes in machine load
+        # affect both alike.
+        for _ in range(repeat):
+            for source in (asm_path, path):
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    asm = asm_file(source)
+                elapsed = time.perf_counter() - start
+                assert asm is not None and asm.status == "finished"
+                if source not in best or elapsed < best[source]:
+                    best[source] = elapsed
+        text, ir = best[asm_path], best[path]
+        print(
+            f"{methods} methods of {blocks} blocks, Python {version}: "
+            f"text {text:.3f}s ({osp.getsize(asm_path):,} bytes), "
+            f"IR {ir:.3f}s ({osp.getsize(path):,} bytes); "
+            f"{text / ir:.1f}x faster"
+        )
+
+
+if __name__ == "__main__":
+    main()
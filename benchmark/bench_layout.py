@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+Benchmark create_code() on ever larger methods, to check that laying
+out instructions and jumps takes time linear in the size of a method,
+including methods over 64K where jumps need EXTENDED_ARG instructions.
+
+    python benchmark/bench_layout.py --blocks 500 --blocks 5000 --blocks 20000
+"""
+import contextlib
+import io
+import os.path as osp
+import sys
+import time
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+
+import click
+
+from xasm.assemble import asm_string
+
+
+def make_listing(blocks: int) -> str:
+    """
+    Return a method of `blocks` loop bodies, each jumping to the end of
+    the method and back to its start, so that jump operands grow with
+    the size of the method.
+    """
+    lines = ["# Python bytecode 3.8 (3413)", "# Method Name: <module>", "  1:"]
+    for b in range(blocks):
+        lines += [
+            f"L{b}:",
+            "            LOAD_NAME            (x)",
+            "            POP_JUMP_IF_FALSE    END",
+            "            LOAD_NAME            (x)",
+            "            POP_TOP",
+            f"            JUMP_ABSOLUTE        L{b}",
+        ]
+    lines += [
+        "END:",
+        "            LOAD_CONST           (None)",
+        "            RETURN_VALUE",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+@click.command()
+@click.option(
+    "--blocks",
+    multiple=True,
+    type=int,
+    default=[1000, 4000, 16000],
+    help="number of blocks of 5 instructions in the method; can be repeated",
+)
+@click.option("--repeat", default=3, help="number of timing runs; the best is reported")
+def main(blocks, repeat: int) -> None:
+    for count in blocks:
+        text = make_listing(count)
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                asm = asm_string(text, keep_instructions=False)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        size = len(asm.code_list[0].co_code)
+        instructions = 5 * count + 2
+        print(
+            f"{instructions} instructions, {size} bytes: best of {repeat} "
+            f"{best:.3f}s, {1e6 * best / instructions:.2f}us per instruction"
+        )
+
+
+if __name__ == "__main__":
+    main()
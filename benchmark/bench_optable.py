@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+Benchmark the per-instruction cost of the opcode lookups done while
+assembling: through the xdis opcode module and helpers, as the
+assembler used to, versus through an xasm.optable.OpcodeTable. Also
+reports the per-instruction cost of assembly as a whole.
+"""
+import contextlib
+import io
+import os.path as osp
+import sys
+import time
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+sys.path.insert(0, osp.dirname(osp.abspath(__file__)))
+
+import click
+import xdis
+from listing import make_listing
+
+from xasm.assemble import asm_string
+from xasm.optable import OPERAND_CONST, opcode_table
+
+
+def best_time(fn, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def lookups_opc(opcodes, opc) -> int:
+    count = 0
+    for opcode in opcodes:
+        count += xdis.op_size(opcode, opc)
+        if xdis.op_has_argument(opcode, opc):
+            if opcode in opc.JUMP_OPS:
+                count += 1
+            elif opcode in opc.COMPARE_OPS:
+                count += 2
+            elif opcode in opc.CONST_OPS:
+                count += 3
+    return count
+
+
+def lookups_optable(opcodes, optable) -> int:
+    size = optable.size
+    has_arg = optable.has_arg
+    is_jump = optable.is_jump
+    operand_kind = optable.operand_kind
+    count = 0
+    for opcode in opcodes:
+        count += size[opcode]
+        if has_arg[opcode]:
+            if is_jump[opcode]:
+                count += 1
+            else:
+                count += operand_kind[opcode] == OPERAND_CONST
+    return count
+
+
+@click.command()
+@click.option("--methods", default=50, help="number of functions in the listing")
+@click.option("--blocks", default=40, help="instruction blocks per function")
+@click.option("--version", default="3.8", help="bytecode version of the listing")
+@click.option("--repeat", default=5, help="number of timing runs; the best is reported")
+def main(methods: int, blocks: int, version: str, repeat: int) -> None:
+    text = make_listing(methods, blocks, version)
+    with contextlib.redirect_stdout(io.StringIO()):
+        asm = asm_string(text)
+    opcodes = [inst.opcode for code in asm.codes for inst in code.instructions]
+    n = len(opcodes)
+    optable = opcode_table(asm.python_version, asm.is_pypy)
+
+    for name, fn in (
+        ("xdis opcode module", lambda: lookups_opc(opcodes, asm.opc)),
+        ("OpcodeTable", lambda: lookups_optable(opcodes, optable)),
+    ):
+        elapsed = best_time(fn, repeat)
+        print(f"{name:20}: {elapsed / n * 1e9:6.1f} ns/instruction")
+
+    def assemble():
+        with contextlib.redirect_stdout(io.StringIO()):
+            asm_string(text, keep_instructions=False)
+
+    elapsed = best_time(assemble, repeat)
+    print(f"{'assembly':20}: {elapsed / n * 1e9:6.1f} ns/instruction")
+    print(f"{n} instructions, Python {version}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""
+Benchmark how many lines per second asm_file() gets through on a large
+generated listing.
+
+Run this on two checkouts to compare parsers, e.g.:
+
+    python benchmark/bench_parse.py --methods 400 --blocks 40
+
+Use --jobs to time assembling methods in several processes.
+"""
+import contextlib
+import io
+import os
+import os.path as osp
+import sys
+import time
+from tempfile import NamedTemporaryFile
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+sys.path.insert(0, osp.dirname(osp.abspath(__file__)))
+
+import click
+from listing import make_listing
+
+from xasm.assemble import asm_file
+
+
+@click.command()
+@click.option("--methods", default=200, help="number of functions in the listing")
+@click.option("--blocks", default=40, help="instruction blocks per function")
+@click.option("--version", default="3.8", help="bytecode version of the listing")
+@click.option("--repeat", default=3, help="number of timing runs; the best is reported")
+@click.option("--jobs", default=1, help="processes to assemble methods in")
+def main(methods: int, blocks: int, version: str, repeat: int, jobs: int) -> None:
+    text = make_listing(methods, blocks, version)
+    num_lines = text.count("\n")
+    with NamedTemporaryFile("w", suffix=".pyasm", delete=False) as fp:
+        fp.write(text)
+    best = None
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                asm = asm_file(fp.name, jobs=jobs)
+            elapsed = time.perf_counter() - start
+            assert asm is not None and asm.status == "finished"
+            if best is None or elapsed < best:
+                best = elapsed
+    finally:
+        os.unlink(fp.name)
+    print(
+        f"{num_lines} lines, {methods} methods, Python {version}, {jobs} job(s): "
+        f"best of {repeat} {best:.3f}s, {num_lines / best:,.0f} lines/s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+Benchmark max_stack_depth() on ever larger methods, to check that the
+stack-depth computation of --compute-stack-size takes time linear in
+the number of instructions.
+
+    python benchmark/bench_stackdepth.py --blocks 1000 --blocks 10000
+"""
+import os.path as osp
+import sys
+import time
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+
+import click
+
+from xasm.optable import opcode_table
+from xasm.stackdepth import max_stack_depth
+
+
+def make_method(blocks: int, optable):
+    """
+    Return (opcodes, args, targets) for a method of `blocks` loop
+    bodies, each a branch to the end of the method and one back to its
+    start, falling through to the next body.
+    """
+    op = optable.opmap
+    opcodes, args, targets = [], [], []
+    end = 5 * blocks
+    for b in range(blocks):
+        start = 5 * b
+        opcodes += [
+            op["LOAD_NAME"],
+            op["POP_JUMP_IF_FALSE"],
+            op["LOAD_NAME"],
+            op["POP_JUMP_IF_TRUE"],
+            op["NOP"],
+        ]
+        args += [0, 0, 0, 0, None]
+        targets += [-1, end, -1, start, -1]
+    opcodes += [op["LOAD_CONST"], op["RETURN_VALUE"]]
+    args += [0, None]
+    targets += [-1, -1]
+    return opcodes, args, targets
+
+
+@click.command()
+@click.option(
+    "--blocks",
+    multiple=True,
+    type=int,
+    default=[1000, 10000, 100000],
+    help="number of blocks of 5 instructions in the method; can be repeated",
+)
+@click.option("--repeat", default=3, help="number of timing runs; the best is reported")
+def main(blocks, repeat: int) -> None:
+    optable = opcode_table((3, 8), False)
+    for count in blocks:
+        opcodes, args, targets = make_method(count, optable)
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            depth, problems = max_stack_depth(opcodes, args, targets, optable)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        assert depth == 1 and not problems, problems
+        instructions = len(opcodes)
+        print(
+            f"{instructions} instructions: best of {repeat} "
+            f"{best:.4f}s, {1e6 * best / instructions:.3f}us per instruction"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Benchmark the cost of checking operands: assemble a large generated
+listing with and without trusted=True, and report the difference.
+
+    python benchmark/bench_validate.py --methods 400 --blocks 40
+"""
+import contextlib
+import io
+import os.path as osp
+import sys
+import time
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+sys.path.insert(0, osp.dirname(osp.abspath(__file__)))
+
+import click
+from listing import make_listing
+
+from xasm.assemble import asm_string
+
+
+def best_times(text: str, repeat: int) -> dict:
+    """
+    Return the best time to assemble `text` with and without
+    trusted=True. The two are run in turn, so that changes in machine
+    load affect both alike.
+    """
+    best = {}
+    for _ in range(repeat):
+        for trusted in (False, True):
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                asm = asm_string(text, keep_instructions=False, trusted=trusted)
+            elapsed = time.perf_counter() - start
+            assert asm is not None and asm.status == "finished"
+            if trusted not in best or elapsed < best[trusted]:
+                best[trusted] = elapsed
+    return best
+
+
+@click.command()
+@click.option("--methods", default=200, help="number of functions in the listing")
+@click.option("--blocks", default=40, help="instruction blocks per function")
+@click.option("--version", default="3.8", help="bytecode version of the listing")
+@click.option("--repeat", default=5, help="number of timing runs; the best is reported")
+def main(methods: int, blocks: int, version: str, repeat: int) -> None:
+    text = make_listing(methods, blocks, version)
+    # Lines that are neither headers, labels nor line numbers.
+    instructions = sum(
+        1
+        for line in text.splitlines()
+        if line.startswith("            ") and not line.strip().endswith(":")
+    )
+    best = best_times(text, repeat)
+    checked, trusted = best[False], best[True]
+    cost = checked - trusted
+    print(
+        f"{instructions} instructions, {methods} methods, Python {version}: "
+        f"checked {checked:.3f}s, trusted {trusted:.3f}s; checking costs "
+        f"{cost * 1e9 / instructions:,.0f} ns per instruction "
+        f"({100 * cost / checked:.1f}%)"
+    )
+
+
+if __name__ == "__main__":
+    main()
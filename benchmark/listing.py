@@ -0,0 +1,125 @@
+"""
+Generate large, synthetic Python assembly listings for benchmarking.
+
+The listings look like what ``pydisasm --xasm`` produces: a module
+header, followed by many "# Method Name:" sections, with the module
+code object last, referring to all of the others as constants.
+"""
+
+MODULE_HEADER = """\
+# pydisasm version 6.1.8
+# Python bytecode {version} ({magic})
+# Timestamp in code: 1499607075 (2017-07-09 09:31:15)
+# Source code size mod 2**32: 58 bytes
+"""
+
+METHOD_HEADER = """
+# Method Name:       {name}
+# Filename:          bench.py
+# Argument count:    2
+# Position-only argument count: 0
+# Keyword-only arguments: 0
+# Number of locals:  3
+# Stack size:        4
+# Flags:             0x00000043 (NOFREE | NEWLOCALS | OPTIMIZED)
+# First Line:        {first_line}
+# Constants:
+#    0: None
+#    1: 0
+#    2: 1
+#    3: 'step'
+# Names:
+#    0: print
+#    1: len
+# Varnames:
+#\ta, b, c
+# Positional arguments:
+#\ta, b
+"""
+
+# One block of instructions in a method body. Each block has its own
+# labels so that they can be repeated within a method.
+METHOD_BLOCK = """\
+  {line}:
+            LOAD_FAST            0 (a)
+            LOAD_FAST            1 (b)
+            COMPARE_OP           4 (>)
+            POP_JUMP_IF_FALSE    L{n}1 (to 0)
+  {line1}:
+            LOAD_FAST            1 (b)
+            LOAD_FAST            0 (a)
+            ROT_TWO
+            STORE_FAST           0 (a)
+            STORE_FAST           1 (b)
+            JUMP_FORWARD         L{n}2 (to 0)
+L{n}1:
+  {line2}:
+            LOAD_GLOBAL          (print)
+            LOAD_CONST           ('step')
+            LOAD_FAST            (c)
+            CALL_FUNCTION        2 (2 positional, 0 keyword pair)
+            POP_TOP
+L{n}2:
+  {line3}:
+            LOAD_FAST            0 (a)
+            LOAD_CONST           2 (1)
+            BINARY_ADD
+            STORE_FAST           2 (c)
+"""
+
+METHOD_TAIL = """\
+            LOAD_FAST            2 (c)
+            RETURN_VALUE
+"""
+
+MODULE_METHOD_HEADER = """
+# Method Name:       <module>
+# Filename:          bench.py
+# Argument count:    0
+# Position-only argument count: 0
+# Keyword-only arguments: 0
+# Number of locals:  0
+# Stack size:        2
+# Flags:             0x00000040 (NOFREE)
+# First Line:        1
+# Constants:
+"""
+
+
+def make_listing(methods: int = 100, blocks: int = 20, version: str = "3.8") -> str:
+    """
+    Return the text of a Python assembly listing with `methods` functions,
+    each containing `blocks` copies of METHOD_BLOCK.
+    """
+    magic = {"2.7": 62211, "3.8": 3413, "3.9": 3425, "3.10": 3439}[version]
+    parts = [MODULE_HEADER.format(version=version, magic=magic)]
+    line = 1
+    for m in range(methods):
+        name = f"f{m}"
+        parts.append(METHOD_HEADER.format(name=name, first_line=line))
+        for b in range(blocks):
+            parts.append(
+                METHOD_BLOCK.format(
+                    n=b, line=line, line1=line + 1, line2=line + 2, line3=line + 3
+                )
+            )
+            line += 4
+        parts.append(METHOD_TAIL)
+    parts.append(MODULE_METHOD_HEADER)
+    for m in range(methods):
+        parts.append(f"#    {m}: <code object f{m} at 0x{m:x}, file \"bench.py\", line 1>\n")
+    parts.append(f"#    {methods}: None\n")
+    parts.append("# Names:\n")
+    for m in range(methods):
+        parts.append(f"#    {m}: f{m}\n")
+    parts.append("  1:\n")
+    for m in range(methods):
+        parts.append(
+            f"            LOAD_CONST           {m} (<code object f{m}>)\n"
+            f"            LOAD_CONST           ('f{m}')\n"
+            f"            MAKE_FUNCTION        0\n"
+            f"            STORE_NAME           {m} (f{m})\n"
+        )
+    parts.append(f"            LOAD_CONST           {methods} (None)\n")
+    parts.append("            RETURN_VALUE\n")
+    return "".join(parts)
@@ -2,66 +2,481 @@
 Test xasm.assemble code
 """
 
-from xdis.opcodes import (
-    opcode_15,
-    opcode_27,
-    opcode_35,
-    opcode_36,
-    opcode_36pypy,
-    opcode_312,
+import sys
+import types
+from contextlib import redirect_stdout
+from io import StringIO
+
+from xdis.opcodes import opcode_27, opcode_38, opcode_311
+
+from xasm.assemble import (
+    INSTRUCTION_RE,
+    FieldIndex,
+    Instruction,
+    LineStream,
+    asm_sections,
+    asm_string,
+    update_code_tuple_field,
 )
 
-from xasm.assemble import append_operand
 
+def test_instruction_re() -> None:
+    for line, expected in (
+        ("            RETURN_VALUE\n", (None, "RETURN_VALUE", None, None)),
+        ("  2:           0 LOAD_CONST                0 (1)\n", ("2", "LOAD_CONST", "0", None)),
+        ("  6:     >>   36 LOAD_CONST                3 ('done')\n", ("6", "LOAD_CONST", "3", None)),
+        ("     >>   12 POP_TOP\n", (None, "POP_TOP", None, None)),
+        ("            LOAD_CONST           ('a  b')\n", (None, "LOAD_CONST", None, "('a  b')")),
+        ("            POP_JUMP_IF_FALSE    L38 (to 38)\n", (None, "POP_JUMP_IF_FALSE", None, "L38 (to 38)")),
+        ("            CALL_FUNCTION        1 (1 positional, 0 keyword pair)", (None, "CALL_FUNCTION", "1", None)),
+        ("            SLICE+0\n", (None, "SLICE+0", None, None)),
+    ):
+        match = INSTRUCTION_RE.match(line)
+        assert match, line
+        assert match.groups() == expected, line
+
+
+def test_update_code_tuple_field() -> None:
+    class Code:
+        co_names = []
+
+    lines = LineStream(["#    0: x\n", "#    1: y\n", "  1:\n", "LOAD_NAME (x)\n"])
+    update_code_tuple_field("co_names", Code, lines)
+    assert Code.co_names == ["x", "y"]
+    # The line that ended the table is read again.
+    assert lines.line_no == 2
+    assert next(lines) == "  1:\n"
+    assert lines.line_no == 3
+    assert list(lines) == ["LOAD_NAME (x)\n"]
+
+
+def test_asm_string() -> None:
+    asm = asm_string(
+        """# Python bytecode 3.8 (3413)
+# Method Name: <module>
+  1:
+            LOAD_CONST           (5)
+            RETURN_VALUE
+"""
+    )
+    assert asm is not None
+    assert asm.status == "finished"
+    assert asm.python_version == (3, 8)
+    co = asm.code_list[0]
+    assert co.co_consts == (5,)
+    assert co.co_code == bytes([100, 0, 83, 0])
+
+
+def test_asm_sections() -> None:
+    text = """# Python bytecode 3.8 (3413)
+# Method Name: five
+  2:
+            LOAD_CONST           (5)
+            RETURN_VALUE
+
+# Method Name: <module>
+# Constants:
+#    0: <code object five at 0x0000>
+#    1: <code object six at 0x0001>
+  1:
+            LOAD_CONST           0 (<code object five at 0x0000>)
+            LOAD_CONST           1 (<code object six at 0x0001>)
+            RETURN_VALUE
+"""
+    with redirect_stdout(StringIO()) as out:
+        asm = asm_sections(StringIO(text), 2)
+    assert "can't find method six" in out.getvalue()
+    assert asm.status == "finished"
+    assert asm.python_version == (3, 8)
+    expected = asm_string(text).code_list[0]
+    co = asm.code_list[0]
+    assert co.co_code == expected.co_code
+    assert co.co_consts[0].co_consts == (5,)
+    assert co.co_consts[1] == "**bogus six**"
+
+
+def test_field_index() -> None:
+    values = [1, True, 1.0, 0.0]
+    index = FieldIndex(values)
+    assert [index.find(v) for v in (1, True, 1.0, 0.0)] == [0, 1, 2, 3]
+    assert index.find(-0.0) == -1
+    assert index.add(-0.0) == 4
+    assert index.add((1, 0.0)) == 5
+    assert index.add((True, -0.0)) == 6
+    assert index.add(frozenset([1])) == 7
+    assert index.add(frozenset([True])) == 8
+    assert index.add(float("nan")) == index.add(float("nan")) == 9
+
+    # Entries appended to the list directly are found too.
+    values.append("x")
+    assert index.find("x") == 10
+
+    # Unhashable values fall back to a linear search.
+    assert index.add([1]) == 11
+    assert index.add([1]) == 11
+    assert index.find([2]) == -1
+    assert len(values) == 12
+
+
+def test_large_method_jumps() -> None:
+    # A method with over 64K of bytecode, whose jumps need EXTENDED_ARG
+    # instructions that themselves move the jump targets.
+    nops = 40000
+    lines = [
+        "# Python bytecode 3.8 (3413)",
+        "# Method Name: <module>",
+        "  1:",
+        "L0:",
+        "            JUMP_ABSOLUTE        L2",
+        "L1:",
+    ]
+    lines += ["            NOP"] * nops
+    lines += [
+        "            JUMP_FORWARD         L2",
+        "            JUMP_ABSOLUTE        L1",
+        "L2:",
+        "            LOAD_CONST           (None)",
+        "            RETURN_VALUE",
+    ]
+    with redirect_stdout(StringIO()):
+        asm = asm_string("\n".join(lines) + "\n")
+    assert asm.status == "finished"
+    code = asm.code_list[0].co_code
+
+    def arg_at(offset: int) -> int:
+        # The operand of the instruction at offset, with its EXTENDED_ARGs.
+        arg = 0
+        while code[offset] == opcode_38.EXTENDED_ARG:
+            arg = (arg | code[offset + 1]) << 8
+            offset += 2
+        return arg | code[offset + 1]
+
+    # JUMP_ABSOLUTE L2 needs two EXTENDED_ARGs, so L1 is at 6.
+    jump_forward = 6 + 2 * nops
+    jump_back = jump_forward + 2
+    end = jump_back + 2
+    extended_arg = opcode_38.EXTENDED_ARG
+    jump_absolute = opcode_38.opmap["JUMP_ABSOLUTE"]
+    assert code[:6] == bytes([extended_arg, 1, extended_arg, 0x38, jump_absolute, 0x8A])
+    assert arg_at(0) == end
+    # JUMP_FORWARD L2 skips just the JUMP_ABSOLUTE L1 after it.
+    assert code[jump_forward] == opcode_38.opmap["JUMP_FORWARD"]
+    assert arg_at(jump_forward) == 2
+    assert arg_at(jump_back) == 6
+    assert code[end] == opcode_38.opmap["LOAD_CONST"]
+    assert len(code) == end + 4
+
+
+def test_operand_bytes() -> None:
+    def assemble(version: str, magic: int, operand: int):
+        text = f"""# Python bytecode {version} ({magic})
+# Method Name: <module>
+  1:
+            BUILD_TUPLE          {operand}
+            RETURN_VALUE
+"""
+        with redirect_stdout(StringIO()):
+            return asm_string(text).code_list[0].co_code
+
+    build_tuple = opcode_38.opmap["BUILD_TUPLE"]
+    extended_arg = opcode_38.EXTENDED_ARG
+    return_value = opcode_38.opmap["RETURN_VALUE"]
+    assert assemble("3.8", 3413, 255) == bytes([build_tuple, 255, return_value, 0])
+    assert assemble("3.8", 3413, 0x10203) == bytes(
+        [extended_arg, 1, extended_arg, 2, build_tuple, 3, return_value, 0]
+    )
 
-def test_append_operand() -> None:
-    def check_one(expected_bytecode_len: int, operand_value: int) -> None:
-        bytecode = []
-        append_operand(
-            bytecode,
-            operand_value,
-            opc.EXTENDED_ARG_SHIFT,
-            opc.ARG_MAX_VALUE,
-            opc.EXTENDED_ARG,
+    build_tuple = opcode_27.opmap["BUILD_TUPLE"]
+    extended_arg = opcode_27.EXTENDED_ARG
+    return_value = opcode_27.opmap["RETURN_VALUE"]
+    code = assemble("2.7", 62211, 0xFF)
+    assert code == "".join(map(chr, [build_tuple, 255, 0, return_value]))
+    code = assemble("2.7", 62211, 0x1020304)
+    assert code == "".join(
+        map(chr, [extended_arg, 2, 1, build_tuple, 4, 3, return_value])
+    )
+
+
+def test_instruction() -> None:
+    inst = Instruction("LOAD_CONST", opcode_38.opmap["LOAD_CONST"], 1, line_no=3)
+    assert repr(inst) == "   3: LOAD_CONST     \t1"
+    assert inst.offset == 0
+    # Instructions have slots rather than a __dict__.
+    assert not hasattr(inst, "__dict__")
+
+
+def test_constant_fold() -> None:
+    text = """# Python bytecode 3.8 (3413)
+# Method Name: <module>
+  1:
+            LOAD_CONST           (2)
+            LOAD_CONST           (3)
+            BINARY_MULTIPLY
+            LOAD_CONST           (1)
+            BINARY_ADD
+            STORE_NAME           (x)
+  2:
+            LOAD_NAME            (x)
+            LOAD_CONST           (1)
+            LOAD_CONST           (2)
+            BUILD_SET            2
+            COMPARE_OP           (in)
+            POP_TOP
+            LOAD_CONST           ('abc')
+            LOAD_CONST           (1)
+            BINARY_SUBSCR
+            LOAD_CONST           (2)
+            LOAD_CONST           (1000)
+            BINARY_POWER
+            LOAD_CONST           (1)
+            LOAD_CONST           (0)
+            BINARY_TRUE_DIVIDE
+            BUILD_TUPLE          3
+            RETURN_VALUE
+"""
+    out = StringIO()
+    with redirect_stdout(out):
+        co = asm_string(text, fold_constants=True).code_list[0]
+    assert out.getvalue() == "<module>: 4 constant operation(s) folded\n"
+    load_const = opcode_38.opmap["LOAD_CONST"]
+    loads = [
+        co.co_consts[co.co_code[i + 1]]
+        for i in range(0, len(co.co_code), 2)
+        if co.co_code[i] == load_const
+    ]
+    # 2 ** 1000 is too big, and 1 / 0 raises an exception, so those and
+    # the tuple built from them are left for run time.
+    assert loads == [7, frozenset((1, 2)), "b", 2, 1000, 1, 0]
+    assert len(co.co_code) == 2 * 15
+
+
+def test_inline_caches() -> None:
+    listing = """# Python bytecode 3.11 (3495)
+# Method Name: <module>
+  1:
+            RESUME               0
+            LOAD_NAME            (x)
+            LOAD_CONST           (1)
+            BINARY_OP            0 (+)
+%s
+            STORE_NAME           (x)
+L1:
+            LOAD_NAME            (x)
+            POP_JUMP_FORWARD_IF_FALSE L2
+            JUMP_BACKWARD        %s
+L2:
+            LOAD_CONST           (None)
+            RETURN_VALUE
+"""
+    op = opcode_311.opmap
+    # BINARY_OP has one CACHE entry after it in 3.11, and jumps count it.
+    instructions = [
+        ("RESUME", 0),
+        ("LOAD_NAME", 0),
+        ("LOAD_CONST", 0),
+        ("BINARY_OP", 0),
+        ("CACHE", 0),
+        ("STORE_NAME", 0),
+        ("LOAD_NAME", 0),
+        ("POP_JUMP_FORWARD_IF_FALSE", 1),
+        ("JUMP_BACKWARD", 3),
+        ("LOAD_CONST", 1),
+        ("RETURN_VALUE", 0),
+    ]
+    expected = bytes(b for name, arg in instructions for b in (op[name], arg))
+    # With no CACHE lines, with them, and with a jump given by number.
+    for caches, jump in (("", "L1"), ("            CACHE", "L1"), ("", "3")):
+        asm = asm_string(listing % (caches, jump))
+        assert asm.status == "finished"
+        assert asm.code_list[0].co_code == expected
+
+
+# def f(x):
+#     try:
+#         return 1 / x
+#     except ZeroDivisionError:
+#         return 0
+
+
+TRY_LISTING = """# Python bytecode 3.11 (3495)
+# Method Name: f
+# Argument count: 1
+# Number of locals: 1
+# Stack size: 4
+# Flags: 0x00000003 (NEWLOCALS | OPTIMIZED)
+# Varnames:
+#\tx
+# Positional arguments:
+#\tx
+  1:
+            RESUME               0
+  2:
+            NOP
+  3:
+L4:
+            LOAD_CONST           (1)
+            LOAD_FAST            (x)
+            BINARY_OP            11 (/)
+L12:
+            RETURN_VALUE
+%s
+L14:
+            PUSH_EXC_INFO
+            LOAD_GLOBAL          (ZeroDivisionError)
+            CHECK_EXC_MATCH
+            POP_JUMP_FORWARD_IF_FALSE L40
+            POP_TOP
+L34:
+            POP_EXCEPT
+            LOAD_CONST           (0)
+            RETURN_VALUE
+L40:
+            RERAISE              0
+L42:
+            COPY                 3
+            POP_EXCEPT
+            RERAISE              1
+%s
+"""
+
+
+def test_exception_table() -> None:
+    # As CPython 3.11 compiles f.
+    expected = b"\x82\x04\x07\x00\x87\n\x15\x03\x94\x01\x15\x03"
+    with_labels = """# Exception table:
+#   L4 to L12 -> L14 [0]
+#   L14 to L34 -> L42 [1] lasti
+#   L40 to L42 -> L42 [1] lasti"""
+    # As dis shows it: offsets, with the end that of the last code unit.
+    with_offsets = """ExceptionTable:
+  4 to 10 -> 14 [0]
+  14 to 32 -> 42 [1] lasti
+  40 to 40 -> 42 [1] lasti"""
+    for table in (with_labels, with_offsets):
+        with redirect_stdout(StringIO()):
+            asm = asm_string(TRY_LISTING % ("", table))
+        co = asm.code_list[0]
+        assert co.co_exceptiontable == expected
+        assert len(co.co_code) == 48
+
+    # Unreachable code is removed, but not the handlers, and the entries
+    # move with their instructions.
+    dead_code = """            LOAD_CONST           (2)
+            RETURN_VALUE"""
+    out = StringIO()
+    with redirect_stdout(out):
+        asm = asm_string(
+            TRY_LISTING % (dead_code, with_labels),
+            optimize=True,
+            compute_stacksize=True,
         )
+    co = asm.code_list[0]
+    assert co.co_exceptiontable == expected
+    assert co.co_stacksize == 4
+    assert out.getvalue() == "f: 2 unreachable instructions removed\n"
+    if sys.version_info[:2] == (3, 11):
+        f = types.FunctionType(co, {})
+        assert (f(0), f(2)) == (0, 0.5)
 
-        assert len(bytecode) > 0
-        assert len(bytecode) == expected_bytecode_len
-        shift_value = 1
-        extended_arg_value = 0
-        low_order_value = bytecode.pop()
-        assert low_order_value <= opc.ARG_MAX_VALUE
-
-        if len(bytecode):
-            assert bytecode[0] == opc.EXTENDED_ARG
-
-        while len(bytecode) > 1:
-            shift_value <<= opc.EXTENDED_ARG_SHIFT
-            extended_arg_value += bytecode.pop() * shift_value
-
-        assert extended_arg_value <= operand_value
-        got_value = extended_arg_value + low_order_value
-        assert got_value == operand_value
-
-    for opc in (
-        opcode_15,
-        opcode_27,
-        opcode_35,
-        opcode_36,
-        opcode_312,
-        opcode_36pypy,
-        opcode_312,
-    ):
-        for operand_value in 0, 11, 255:
-            check_one(1, operand_value)
-        for operand_value in 256, 413, 900, 4000, 1001, 65535:
-            print(opc, operand_value)
-            bytecode_len = 1 if opc.version_tuple < (3, 6) else 3
-            check_one(bytecode_len, operand_value)
-        for operand_value in 65536, 200000:
-            print(opc, operand_value)
-            check_one(3, operand_value)
+
+def test_operand_checks() -> None:
+    listing = """# Python bytecode 3.11 (3495)
+# Method Name: <module>
+# Constants:
+#    0: None
+# Names:
+#    0: print
+            RESUME               0
+            LOAD_GLOBAL          1 (NULL + print)
+            LOAD_CONST           3
+            LOAD_NAME            1
+            POP_TOP
+"""
+    # Problems are collected and reported together, and nothing is
+    # assembled. The low bit of the LOAD_GLOBAL operand isn't part of
+    # the name index.
+    out = StringIO()
+    with redirect_stdout(out):
+        asm = asm_string(listing)
+    assert asm is None
+    assert out.getvalue().splitlines() == [
+        "Warning:  <module>: LOAD_CONST operand at offset 14: constant index 3 "
+        "is too large; it should be less than 1",
+        "Warning:  <module>: LOAD_NAME operand at offset 16: name index 1 "
+        "is too large; it should be less than 1",
+        "Warning:  <module>: last instruction, at offset 18, is POP_TOP; "
+        "execution would run off the end",
+    ]
+
+    # A trusted listing isn't checked.
+    out = StringIO()
+    with redirect_stdout(out):
+        asm = asm_string(listing, trusted=True)
+    assert asm.status == "finished"
+    assert out.getvalue() == ""
+
+
+def test_operand_checks_313() -> None:
+    # def f(a, b):
+    #     c = a
+    #     a, b = b, c
+    #     return b + a
+    # as compiled by Python 3.13, where some instructions take two local
+    # variable indices of 4 bits each.
+    listing = """# Python bytecode 3.13 (3571)
+# Method Name: f
+# Argument count: 2
+# Number of locals: 3
+# Stack size: 2
+# Flags: 0x00000003 (NEWLOCALS | OPTIMIZED)
+# First Line: 2
+# Constants:
+#    0: None
+# Varnames:
+#    a, b, c
+  2:
+            RESUME               0
+  3:
+            LOAD_FAST            0 (a)
+            STORE_FAST           2 (c)
+  4:
+            LOAD_FAST_LOAD_FAST  18 (b, c)
+            STORE_FAST_STORE_FAST 16 (b, a)
+  5:
+            LOAD_FAST_LOAD_FAST  16 (b, a)
+            BINARY_OP            0 (+)
+            RETURN_VALUE
+"""
+    out = StringIO()
+    with redirect_stdout(out):
+        asm = asm_string(listing)
+    assert out.getvalue() == ""
+    assert asm.code_list[0].co_code == (
+        b"\x95\x00U\x00n\x02X\x12p\x10X\x10-\x00\x00\x00$\x00"
+    )
+
+    # Each half of the operand is checked.
+    out = StringIO()
+    with redirect_stdout(out):
+        asm = asm_string(listing.replace("18 (b, c)", "19 (b, ?)"))
+    assert asm is None
+    assert out.getvalue().splitlines() == [
+        "Warning:  f: LOAD_FAST_LOAD_FAST operand at offset 6: variable index 3 "
+        "is too large; it should be less than 3",
+    ]
 
 
 if __name__ == "__main__":
-    test_append_operand()
+    test_instruction_re()
+    test_update_code_tuple_field()
+    test_asm_string()
+    test_asm_sections()
+    test_large_method_jumps()
+    test_operand_bytes()
+    test_instruction()
+    test_field_index()
+    test_constant_fold()
+    test_inline_caches()
+    test_exception_table()
+    test_operand_checks()
+    test_operand_checks_313()
@@ -0,0 +1,143 @@
+"""
+Test xasm.builder code
+"""
+
+import sys
+from contextlib import redirect_stdout
+from io import StringIO
+
+import pytest
+from xdis.bytecode import parse_exception_table
+
+from xasm.assemble import asm_string
+from xasm.builder import CodeBuilder
+
+LISTING = """# Python bytecode 3.8 (3413)
+# Method Name: <module>
+# Stack size: 2
+  1:
+            LOAD_NAME            (x)
+            POP_JUMP_IF_FALSE    done
+  2:
+            LOAD_NAME            (print)
+            LOAD_CONST           ('x is set')
+            CALL_FUNCTION        1
+            POP_TOP
+done:
+  3:
+            LOAD_CONST           (None)
+            RETURN_VALUE
+"""
+
+
+def build_module(version) -> CodeBuilder:
+    module = CodeBuilder(version)
+    module.line(1)
+    module.emit("LOAD_NAME", module.name("x"))
+    module.emit("POP_JUMP_IF_FALSE", "done")
+    module.line(2)
+    module.emit("LOAD_NAME", module.name("print"))
+    module.emit("LOAD_CONST", module.const("x is set"))
+    module.emit("CALL_FUNCTION", 1)
+    module.emit("POP_TOP")
+    module.label("done")
+    module.line(3)
+    module.emit("LOAD_CONST", module.const(None))
+    module.emit("RETURN_VALUE")
+    return module
+
+
+def test_build() -> None:
+    # The same code object as from the listing, with the stack size
+    # computed.
+    out = StringIO()
+    with redirect_stdout(out):
+        co = build_module("3.8").build()
+        expected = asm_string(LISTING).code_list[0]
+    assert out.getvalue() == ""
+    for field in ("co_code", "co_consts", "co_names", "co_lnotab", "co_stacksize"):
+        assert getattr(co, field) == getattr(expected, field)
+
+    module = build_module((3, 8))
+    with pytest.raises(ValueError):
+        module.emit("NO_SUCH_OPCODE")
+    with pytest.raises(ValueError):
+        module.emit("LOAD_CONST")
+    with pytest.raises(ValueError):
+        module.emit("LOAD_CONST", "done")
+    with pytest.raises(ValueError):
+        module.label("12")
+
+
+def test_build_nested() -> None:
+    # def double(x):
+    #     try:
+    #         return x * 2
+    #     except TypeError:
+    #         return None
+    module = CodeBuilder("3.11")
+    function = module.nested("double", argcount=1, flags=0x03)
+    function.emit("RESUME", 0)
+    function.label("try")
+    function.emit("LOAD_FAST", function.varname("x"))
+    function.emit("LOAD_CONST", function.const(2))
+    function.emit("BINARY_OP", 5)
+    function.emit("RETURN_VALUE")
+    function.label("handler")
+    function.emit("PUSH_EXC_INFO")
+    function.emit("LOAD_GLOBAL", function.name("TypeError") << 1)
+    function.emit("CHECK_EXC_MATCH")
+    function.emit("POP_JUMP_FORWARD_IF_FALSE", "reraise")
+    function.emit("POP_TOP")
+    function.emit("POP_EXCEPT")
+    function.emit("LOAD_CONST", function.const(None))
+    function.emit("RETURN_VALUE")
+    function.label("reraise")
+    function.emit("RERAISE", 0)
+    function.label("cleanup")
+    function.emit("COPY", 3)
+    function.emit("POP_EXCEPT")
+    function.emit("RERAISE", 1)
+    function.exception_entry("try", "handler", "handler", 0)
+    function.exception_entry("handler", "reraise", "cleanup", 1, lasti=True)
+    function.exception_entry("reraise", "cleanup", "cleanup", 1, lasti=True)
+
+    module.emit("RESUME", 0)
+    out = StringIO()
+    with redirect_stdout(out):
+        module.emit("LOAD_CONST", module.const(function.build()))
+        module.emit("MAKE_FUNCTION", 0)
+        module.emit("STORE_NAME", module.name("double"))
+        module.emit("LOAD_CONST", module.const(None))
+        module.emit("RETURN_VALUE")
+        co = module.build()
+    assert out.getvalue() == ""
+    double = co.co_consts[0]
+    assert double.co_name == "double"
+    assert double.co_varnames == ("x",)
+    assert double.co_stacksize == 4
+    assert [tuple(entry) for entry in parse_exception_table(double.co_exceptiontable)] == [
+        (2, 12, 12, 0, False),
+        (12, 38, 40, 1, True),
+        (38, 40, 40, 1, True),
+    ]
+    if sys.version_info[:2] == (3, 11):
+        namespace = {}
+        exec(co, namespace)
+        assert namespace["double"](21) == 42
+        assert namespace["double"](None) is None
+
+
+def test_build_problems() -> None:
+    for trusted in (False, True):
+        module = CodeBuilder("3.8", trusted=trusted)
+        module.emit("LOAD_CONST", 1)
+        module.emit("RETURN_VALUE")
+        out = StringIO()
+        with redirect_stdout(out):
+            if trusted:
+                module.build()
+            else:
+                with pytest.raises(ValueError, match="has problems"):
+                    module.build()
+        assert ("constant index 1 is too large" in out.getvalue()) != trusted
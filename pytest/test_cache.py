@@ -0,0 +1,103 @@
+"""
+Test xasm.cache: the on-disk cache of assembled bytecode
+"""
+
+import os
+import os.path as osp
+from contextlib import redirect_stdout
+from io import BytesIO, StringIO
+
+from xasm.assemble import asm_file
+from xasm.cache import AssemblyCache
+from xasm.write_pyc import write_pycfile
+
+LISTING = """# Python bytecode 3.8 (3413)
+# Timestamp in code: 1 (1970-01-01 00:00:01)
+# Method Name: <module>
+  1:
+            LOAD_CONST           (%d)
+            RETURN_VALUE
+"""
+
+
+def write_listing(tmp_path, name: str, value: int) -> str:
+    path = osp.join(str(tmp_path), name)
+    with open(path, "w") as fp:
+        fp.write(LISTING % value)
+    return path
+
+
+def pyc_bytes(asm) -> bytes:
+    fp = BytesIO()
+    assert write_pycfile(fp, asm.code_list, asm.timestamp, asm.python_version) == 0
+    return fp.getvalue()
+
+
+def test_cache_hit(tmp_path) -> None:
+    cache = AssemblyCache(osp.join(str(tmp_path), "cache"))
+    path = write_listing(tmp_path, "five.pyasm", 5)
+    expected = pyc_bytes(asm_file(path))
+
+    assert pyc_bytes(asm_file(path, cache=cache)) == expected
+    assert (cache.hits, cache.misses) == (0, 1)
+
+    # Same text in another file is a hit.
+    other_path = write_listing(tmp_path, "other.pyasm", 5)
+    asm = asm_file(other_path, cache=cache)
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert asm.python_version == (3, 8)
+    assert asm.timestamp == 1
+    assert pyc_bytes(asm) == expected
+
+    path = write_listing(tmp_path, "six.pyasm", 6)
+    assert pyc_bytes(asm_file(path, cache=cache)) != expected
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_cache_eviction(tmp_path) -> None:
+    cache = AssemblyCache(osp.join(str(tmp_path), "cache"))
+    five = write_listing(tmp_path, "five.pyasm", 5)
+    six = write_listing(tmp_path, "six.pyasm", 6)
+    with open(five, "rb") as fp:
+        key = cache.key(fp)
+    asm_file(five, cache=cache)
+    # Leave room for just one entry.
+    cache.max_size = os.stat(cache.entry_path(key)).st_size
+    asm_file(six, cache=cache)
+    assert cache.evictions == 1
+    asm_file(six, cache=cache)
+    asm_file(five, cache=cache)
+    assert (cache.hits, cache.misses) == (1, 3)
+
+
+def test_cache_eviction_skips_tmp_files(tmp_path) -> None:
+    cache = AssemblyCache(osp.join(str(tmp_path), "cache"))
+    five = write_listing(tmp_path, "five.pyasm", 5)
+    six = write_listing(tmp_path, "six.pyasm", 6)
+    with open(five, "rb") as fp:
+        key = cache.key(fp)
+    asm_file(five, cache=cache)
+    size = os.stat(cache.entry_path(key)).st_size
+    assert cache.size == size
+    # An entry another process is still writing.
+    tmp_file = cache.entry_path("ab" + "0" * 38) + ".tmp99999"
+    os.makedirs(osp.dirname(tmp_file), exist_ok=True)
+    with open(tmp_file, "wb") as fp:
+        fp.write(b"x" * size)
+    cache.max_size = size
+    asm_file(six, cache=cache)
+    assert cache.evictions == 1
+    assert osp.exists(tmp_file)
+    assert cache.size <= cache.max_size
+
+
+def test_cache_trusted(tmp_path) -> None:
+    # A listing that is only assembled when trusted.
+    cache = AssemblyCache(osp.join(str(tmp_path), "cache"))
+    path = osp.join(str(tmp_path), "bad.pyasm")
+    with open(path, "w") as fp:
+        fp.write((LISTING % 5).replace("LOAD_CONST           (5)", "LOAD_FAST 3"))
+    assert asm_file(path, cache=cache, trusted=True) is not None
+    with redirect_stdout(StringIO()):
+        assert asm_file(path, cache=cache) is None
+    assert (cache.hits, cache.misses) == (0, 2)
@@ -0,0 +1,49 @@
+"""
+Test xasm.exceptiontable code
+"""
+
+import sys
+
+from xdis.bytecode import parse_exception_table
+
+from xasm.exceptiontable import append_varint, encode_exception_table
+
+
+def test_append_varint() -> None:
+    for value, encoded in (
+        (0, b"\x00"),
+        (63, b"\x3f"),
+        (64, b"\x41\x00"),
+        (4095, b"\x7f\x3f"),
+        (4096, b"\x41\x40\x00"),
+    ):
+        table = bytearray()
+        append_varint(table, value)
+        assert table == encoded
+    table = bytearray()
+    append_varint(table, 64, 0x80)
+    assert table == b"\xc1\x00"
+
+
+def test_encode_exception_table() -> None:
+    entries = [
+        (4, 12, 14, 0, False),
+        (14, 34, 42, 1, True),
+        (40, 42, 42, 1, True),
+        (200, 20000, 300000, 70, False),
+    ]
+    table = encode_exception_table(entries)
+    assert [tuple(entry) for entry in parse_exception_table(table)] == entries
+    assert encode_exception_table([]) == b""
+
+    if sys.version_info[:2] == (3, 11):
+
+        def f(x):
+            try:
+                return 1 / x
+            except ZeroDivisionError:
+                return 0
+
+        table = f.__code__.co_exceptiontable
+        entries = [tuple(entry) for entry in parse_exception_table(table)]
+        assert encode_exception_table(entries) == table
@@ -0,0 +1,76 @@
+"""
+Benchmark how long it takes to import the modules pyc-xasm starts with,
+using "python -X importtime", and fail if that grows past a limit.
+
+The limits are generous so that slow machines pass; they can be changed
+with the environment variables XASM_CLI_IMPORT_LIMIT_MS and
+XASM_ASSEMBLE_IMPORT_LIMIT_MS.
+"""
+
+import os
+import os.path as osp
+import re
+import subprocess
+import sys
+
+SRC_DIR = osp.dirname(osp.dirname(osp.realpath(__file__)))
+
+IMPORT_TIME_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|(\s+)(\S+)$")
+
+
+def import_times(module: str) -> dict:
+    """
+    Import `module` in a fresh interpreter. Returns a dictionary
+    mapping the name of each module imported to the cumulative time,
+    in microseconds, taken to import it.
+    """
+    env = dict(os.environ, PYTHONPATH=SRC_DIR)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        env=env,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_RE.match(line)
+        if match:
+            times[match.group(4)] = int(match.group(2))
+    return times
+
+
+def best_import_time(module: str, runs: int = 3) -> tuple:
+    """
+    Return the smallest cumulative import time of `module` in
+    milliseconds over `runs` runs, and the modules imported.
+    """
+    best = None
+    for _ in range(runs):
+        times = import_times(module)
+        if best is None or times[module] < best:
+            best = times[module]
+    return best / 1000, times
+
+
+def test_cli_import_time() -> None:
+    limit = float(os.environ.get("XASM_CLI_IMPORT_LIMIT_MS", 200))
+    elapsed, times = best_import_time("xasm.xasm_cli")
+    # xdis pulls in every opcode module, so it is only imported once
+    # there is something to assemble.
+    assert "xdis" not in times
+    assert elapsed < limit, f"importing xasm.xasm_cli took {elapsed:.1f}ms"
+
+
+def test_assemble_import_time() -> None:
+    limit = float(os.environ.get("XASM_ASSEMBLE_IMPORT_LIMIT_MS", 500))
+    elapsed, times = best_import_time("xasm.assemble")
+    for module in ("concurrent.futures", "xasm.incremental", "xasm.cache"):
+        assert module not in times, f"{module} should be imported only when used"
+    assert elapsed < limit, f"importing xasm.assemble took {elapsed:.1f}ms"
+
+
+if __name__ == "__main__":
+    for module in ("xasm.xasm_cli", "xasm.assemble"):
+        elapsed, _ = best_import_time(module)
+        print(f"{module}: {elapsed:.1f}ms")
@@ -0,0 +1,87 @@
+"""
+Test xasm.incremental: reuse of code objects for unchanged methods
+"""
+
+import os.path as osp
+
+from xdis.magics import magic2int, magics
+from xdis.version_info import PYTHON_VERSION_TRIPLE, version_tuple_to_str
+
+from xasm.assemble import asm_string
+from xasm.incremental import MethodCache, sidecar_path
+
+LISTING = """# Python bytecode %s
+# Method Name:       five
+# Filename:          five.py
+# First Line:        1
+  2:
+            LOAD_CONST           (5)
+            RETURN_VALUE
+
+# Method Name:       six
+# Filename:          five.py
+# First Line:        4
+  5:
+            LOAD_CONST           (6)
+            RETURN_VALUE
+
+# Method Name:       <module>
+# Filename:          five.py
+# Constants:
+#    0: <code object five at 0x0000>
+#    1: <code object six at 0x0001>
+# Names:
+#    0: five
+#    1: six
+  1:
+            LOAD_CONST           0 (<code object five at 0x0000>)
+            LOAD_CONST           ('five')
+            MAKE_FUNCTION        0
+            STORE_NAME           (five)
+            LOAD_CONST           1 (<code object six at 0x0001>)
+            LOAD_CONST           ('six')
+            MAKE_FUNCTION        0
+            STORE_NAME           (six)
+            LOAD_CONST           (None)
+            RETURN_VALUE
+"""
+
+
+def check_incremental(version: str, tmp_path) -> None:
+    text = LISTING % version
+    expected = asm_string(text).code_list[0]
+
+    path = sidecar_path(osp.join(str(tmp_path), "five.pyc"))
+    cache = MethodCache.load(path)
+    asm = asm_string(text, method_cache=cache)
+    assert (cache.hits, cache.misses) == (0, 3)
+    assert asm.code_list[0].co_code == expected.co_code
+    cache.save(path)
+
+    # Nothing changed, so nothing is assembled again.
+    cache = MethodCache.load(path)
+    asm = asm_string(text, method_cache=cache)
+    assert (cache.hits, cache.misses) == (3, 0)
+    co = asm.code_list[0]
+    assert co.co_code == expected.co_code
+    assert [c.co_consts for c in co.co_consts[:2]] == [(5,), (6,)]
+    cache.save(path)
+
+    # Changing "six" reassembles it and <module> which contains it,
+    # but not "five".
+    cache = MethodCache.load(path)
+    asm = asm_string(text.replace("(6)", "(7)"), method_cache=cache)
+    assert (cache.hits, cache.misses) == (1, 2)
+    co = asm.code_list[0]
+    assert [c.co_consts for c in co.co_consts[:2]] == [(5,), (7,)]
+
+
+def test_incremental_38(tmp_path) -> None:
+    check_incremental("3.8 (3413)", tmp_path)
+
+
+def test_incremental_native(tmp_path) -> None:
+    # When the target is the running Python, code objects are native.
+    version = version_tuple_to_str(PYTHON_VERSION_TRIPLE[:2])
+    if version in magics:
+        check_incremental(f"{version} ({magic2int(magics[version])})", tmp_path)
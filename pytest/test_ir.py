@@ -0,0 +1,134 @@
+"""
+Test xasm.ir: binary IR files of parsed listings
+"""
+
+import marshal
+import os.path as osp
+from contextlib import redirect_stdout
+from io import BytesIO, StringIO
+
+import pytest
+from click.testing import CliRunner
+
+from xasm.assemble import asm_file
+from xasm.ir import IR_MAGIC, ir_path, load_ir, write_ir_file
+from xasm.write_pyc import write_pycfile
+from xasm.xasm_cli import main
+
+LISTING = """# Python bytecode 3.8 (3413)
+# Method Name: <module>
+# Filename: ir.py
+# Stack size: 2
+  1:
+            LOAD_CONST           (<code object f>)
+            LOAD_CONST           ('f')
+            MAKE_FUNCTION        0
+            STORE_NAME           (f)
+  2:
+            LOAD_CONST           (2)
+            LOAD_CONST           (3)
+            BINARY_ADD
+            STORE_NAME           (x)
+            LOAD_CONST           (None)
+            RETURN_VALUE
+
+# Method Name: f
+# Filename: ir.py
+# Argument count: 1
+# Number of locals: 1
+# Stack size: 2
+# Flags: 0x00000043 (NOFREE | NEWLOCALS | OPTIMIZED)
+# First Line: 4
+# Constants:
+#    0: None
+#    1: 'positive'
+# Names:
+#    0: print
+# Local variables:
+#    0: a
+  5:
+            LOAD_FAST            (a)
+            POP_JUMP_IF_FALSE    L1
+            JUMP_ABSOLUTE        L2
+L1:
+  6:
+            LOAD_GLOBAL          (print)
+            LOAD_CONST           ('positive')
+            CALL_FUNCTION        1
+            POP_TOP
+L2:
+  7:
+            LOAD_CONST           (None)
+            RETURN_VALUE
+"""
+
+
+def pyc_bytes(asm) -> bytes:
+    fp = BytesIO()
+    write_pycfile(fp, asm.code_list, 0, asm.python_version, asm.is_pypy)
+    return fp.getvalue()
+
+
+@pytest.fixture
+def listing(tmp_path) -> str:
+    path = osp.join(str(tmp_path), "ir.pyasm")
+    with open(path, "w") as fp:
+        fp.write(LISTING)
+    return path
+
+
+@pytest.mark.parametrize("optimize", [False, True])
+def test_round_trip(listing, optimize) -> None:
+    path = ir_path(listing)
+    assert write_ir_file(listing, path)
+    with redirect_stdout(StringIO()):
+        from_text = asm_file(listing, optimize=optimize, fold_constants=optimize)
+        from_ir = asm_file(path, optimize=optimize, fold_constants=optimize)
+    assert [co.co_name for co in from_ir.code_list] == ["f", "<module>"]
+    assert pyc_bytes(from_ir) == pyc_bytes(from_text)
+    # The options are applied when the IR is loaded.
+    if optimize:
+        assert 5 in from_ir.code_list[-1].co_consts
+
+
+def test_stale(listing) -> None:
+    path = ir_path(listing)
+    assert write_ir_file(listing, path)
+    with open(path, "rb") as fp:
+        fp.read(len(IR_MAGIC))
+        data = list(marshal.load(fp))
+    data[1] = "0.0.0"
+    with open(path, "wb") as fp:
+        fp.write(IR_MAGIC)
+        marshal.dump(tuple(data), fp)
+
+    out = StringIO()
+    with redirect_stdout(out):
+        asm = load_ir(path)
+    assert "was written by xasm 0.0.0" in out.getvalue()
+    assert asm.code_list[-1].co_name == "<module>"
+
+    # Without the listing it was made from, a stale file is an error.
+    data[3] = listing + ".gone"
+    with open(path, "wb") as fp:
+        fp.write(IR_MAGIC)
+        marshal.dump(tuple(data), fp)
+    with pytest.raises(RuntimeError, match="--emit-ir"):
+        load_ir(path)
+
+
+def test_emit_ir(listing) -> None:
+    runner = CliRunner()
+    result = runner.invoke(main, ["--emit-ir", listing])
+    assert result.exit_code == 0, result.output
+    path = ir_path(listing)
+    assert osp.exists(path)
+
+    result = runner.invoke(main, [path])
+    assert result.exit_code == 0, result.output
+    pyc_path = osp.splitext(listing)[0] + ".pyc"
+    with open(pyc_path, "rb") as fp:
+        from_ir = fp.read()
+    # With no timestamp in the listing, the header has the time written.
+    with redirect_stdout(StringIO()):
+        assert from_ir[16:] == pyc_bytes(asm_file(listing))[16:]
@@ -0,0 +1,94 @@
+"""
+Test xasm.linetable code
+"""
+
+import dis
+import sys
+from types import SimpleNamespace
+
+from xdis import findlinestarts
+from xdis.codetype.code310 import Code310
+from xdis.codetype.code311 import parse_linetable
+
+from xasm.assemble import decode_lineno_tab_old
+from xasm.linetable import (
+    encode_linetable_310,
+    encode_lnotab,
+    encode_locations_311,
+    line_ranges,
+)
+
+# Gaps of more than 255 bytes, line deltas of more than 127 and 255,
+# and lines going backwards, by a little and by a lot.
+LINE_STARTS = {
+    0: 1,
+    4: 2,
+    10: 3,
+    12: 3,
+    600: 2,
+    700: 400,
+    710: 5,
+    1300: 300,
+    1302: 302,
+}
+CODE_SIZE = 1310
+
+
+def merged(ranges) -> list:
+    """
+    Join neighboring ranges with the same line, which are split when
+    they are too large for one table entry.
+    """
+    result = []
+    for start, end, line in ranges:
+        if result and result[-1][1] == start and result[-1][2] == line:
+            start = result.pop()[0]
+        result.append((start, end, line))
+    return result
+
+
+def test_encode_lnotab() -> None:
+    expected = {offset: line for offset, line in LINE_STARTS.items() if offset not in (0, 12)}
+    lnotab = encode_lnotab(LINE_STARTS, 1)
+    assert decode_lineno_tab_old(lnotab, 1, signed=True) == expected
+    co = SimpleNamespace(co_lnotab=lnotab, co_code=bytes(CODE_SIZE), co_firstlineno=1)
+    assert list(findlinestarts(co)) == [(0, 1)] + sorted(expected.items())
+
+    # Before 3.6 line numbers can't go backwards.
+    lnotab = encode_lnotab(LINE_STARTS, 1, signed=False)
+    assert decode_lineno_tab_old(lnotab, 1) == {4: 2, 10: 3, 700: 400}
+    assert encode_lnotab({}, 1) == b""
+
+
+def test_line_ranges() -> None:
+    assert line_ranges({2: 5, 4: 5, 6: 7}, 10) == [(0, 2, None), (2, 6, 5), (6, 10, 7)]
+    assert line_ranges({}, 4) == [(0, 4, None)]
+
+
+def test_encode_linetable_310() -> None:
+    expected = line_ranges(LINE_STARTS, CODE_SIZE)
+    linetable = encode_linetable_310(LINE_STARTS, 1, CODE_SIZE)
+    co = SimpleNamespace(co_linetable=linetable, co_firstlineno=1)
+    assert merged(Code310.co_lines(co)) == expected
+
+    # Code before the first line number has none.
+    linetable = encode_linetable_310({4: 2}, 1, 8)
+    assert list(Code310.co_lines(SimpleNamespace(co_linetable=linetable, co_firstlineno=1))) == [
+        (0, 4, None),
+        (4, 8, 2),
+    ]
+
+
+def test_encode_locations_311() -> None:
+    line_starts = {0: 0, 2: 1, 40: 200, 42: 3, 60: 3, 62: 70000}
+    table = encode_locations_311(line_starts, 0, 80)
+    assert list(parse_linetable(table, 0)) == line_ranges(line_starts, 80)
+    if sys.version_info >= (3, 11):
+        co = compile("", "<test>", "exec").replace(
+            co_code=bytes([dis.opmap["NOP"], 0] * 40),
+            co_firstlineno=0,
+            co_linetable=table,
+        )
+        assert merged(co.co_lines()) == line_ranges(line_starts, 80)
+    table = encode_locations_311({4: 2}, 1, 8)
+    assert list(parse_linetable(table, 1)) == [(0, 4, None), (4, 8, 2)]
@@ -0,0 +1,54 @@
+"""
+Test xasm.optable lookup tables against the xdis opcode modules
+"""
+
+import xdis
+from xdis import get_opcode
+
+from xasm.optable import (
+    OPERAND_COMPARE,
+    OPERAND_CONST,
+    OPERAND_FREE,
+    OPERAND_INT,
+    OPERAND_LOCAL,
+    OPERAND_NAME,
+    OPERAND_NONE,
+    opcode_table,
+)
+
+
+def test_opcode_table() -> None:
+    for version, is_pypy in (
+        ((2, 7), False),
+        ((3, 5), False),
+        ((3, 6), True),
+        ((3, 8), False),
+        ((3, 10), False),
+        ((3, 11), False),
+    ):
+        opc = get_opcode(version, is_pypy)
+        optable = opcode_table(version + (1,), is_pypy)
+        assert optable is opcode_table(version, is_pypy)
+        assert optable.opc is opc
+        assert optable.jump_unit == (2 if version >= (3, 10) else 1)
+        for opname, opcode in opc.opmap.items():
+            assert optable.opmap[opname] == opcode
+            assert optable.size[opcode] == xdis.op_size(opcode, opc)
+            assert optable.has_arg[opcode] == xdis.op_has_argument(opcode, opc)
+            assert optable.is_jump[opcode] == (opcode in opc.JUMP_OPS)
+            assert optable.is_jrel[opcode] == (opcode in opc.JREL_OPS)
+            kind = optable.operand_kind[opcode]
+            if not optable.has_arg[opcode]:
+                assert kind == OPERAND_NONE
+            elif opcode in opc.COMPARE_OPS:
+                assert kind == OPERAND_COMPARE
+            elif opcode in opc.CONST_OPS:
+                assert kind == OPERAND_CONST
+            elif opcode in opc.LOCAL_OPS:
+                assert kind == OPERAND_LOCAL
+            elif opcode in opc.NAME_OPS:
+                assert kind == OPERAND_NAME
+            elif opcode in opc.FREE_OPS:
+                assert kind == OPERAND_FREE
+            else:
+                assert kind == OPERAND_INT
@@ -0,0 +1,141 @@
+"""
+Test xasm.peephole code
+"""
+
+from contextlib import redirect_stdout
+from io import StringIO
+
+from xasm.assemble import asm_string
+from xasm.optable import opcode_table
+from xasm.peephole import optimize
+
+HEADER = """# Python bytecode 3.8 (3413)
+# Method Name: <module>
+"""
+
+
+def test_optimize_listing() -> None:
+    text = (
+        HEADER
+        + """  1:
+            LOAD_NAME            (x)
+            POP_JUMP_IF_FALSE    L1
+            LOAD_CONST           (1)
+            POP_TOP
+            JUMP_ABSOLUTE        L2
+L1:
+            JUMP_ABSOLUTE        L2
+L2:
+  2:
+            NOP
+  3:
+            LOAD_NAME            (y)
+            RETURN_VALUE
+            LOAD_CONST           (2)
+            RETURN_VALUE
+"""
+    )
+    expected_text = (
+        HEADER
+        + """  1:
+            LOAD_NAME            (x)
+            POP_JUMP_IF_FALSE    L1
+L1:
+  2:
+            NOP
+  3:
+            LOAD_NAME            (y)
+            RETURN_VALUE
+"""
+    )
+    out = StringIO()
+    with redirect_stdout(out):
+        co = asm_string(text, optimize=True).code_list[0]
+        expected = asm_string(expected_text).code_list[0]
+    assert co.co_code == expected.co_code
+    assert co.co_lnotab == expected.co_lnotab
+    assert out.getvalue() == (
+        "<module>: 1 jump threaded, 3 unreachable instructions removed, "
+        "1 load and POP_TOP removed, 1 jump to the next instruction removed\n"
+    )
+
+    # Without optimize, the code is as given.
+    with redirect_stdout(StringIO()):
+        co = asm_string(text).code_list[0]
+    assert len(co.co_code) == 2 * 11
+
+
+def test_optimize() -> None:
+    optable = opcode_table((3, 8), False)
+    op = optable.opmap
+
+    # A NOP that is the only instruction of its line is kept; one whose
+    # line can move to the next instruction is not.
+    opcodes = [op["NOP"], op["NOP"], op["LOAD_CONST"], op["RETURN_VALUE"]]
+    args = [None, None, 0, None]
+    targets = [-1, -1, -1, -1]
+    line_starts = {0: 1, 1: 2}
+    new_index, stats = optimize(opcodes, args, targets, line_starts, optable)
+    assert opcodes == [op["NOP"], op["LOAD_CONST"], op["RETURN_VALUE"]]
+    assert line_starts == {0: 1, 1: 2}
+    assert new_index == [0, 1, 1, 2, 3]
+    assert stats.report() == "1 NOP removed"
+
+    # An unconditional jump to a return becomes the return.
+    opcodes = [op["JUMP_ABSOLUTE"], op["LOAD_CONST"], op["RETURN_VALUE"]]
+    args = [None, 0, None]
+    targets = [2, -1, -1]
+    new_index, stats = optimize(opcodes, args, targets, {}, optable)
+    assert opcodes == [op["RETURN_VALUE"]]
+    assert stats.returns == 1 and stats.unreachable == 2
+
+    # A jump whose target isn't known stops any change.
+    opcodes = [op["JUMP_ABSOLUTE"], op["NOP"], op["RETURN_VALUE"]]
+    _, stats = optimize(opcodes, [7, None, None], [-1, -1, -1], {}, optable)
+    assert len(opcodes) == 3
+    assert stats.report().startswith("not optimized")
+
+
+def test_optimize_311_handlers() -> None:
+    # From 3.11 on, code reached only from the exception table is kept
+    # unless the handlers are given.
+    optable = opcode_table((3, 11), False)
+    op = optable.opmap
+    opcodes = [op["RETURN_VALUE"], op["PUSH_EXC_INFO"], op["RERAISE"]]
+    args = [None, None, 0]
+    _, stats = optimize(opcodes[:], args[:], [-1, -1, -1], {}, optable)
+    assert stats.unreachable == 0
+    _, stats = optimize(opcodes[:], args[:], [-1, -1, -1], {}, optable, handlers=[])
+    assert stats.unreachable == 2
+
+
+def test_optimize_setup_handlers() -> None:
+    # Before 3.11, a handler is found as the target of the SETUP_* that
+    # covers the try block, so it is kept.
+    for version, magic, setup in (
+        ("3.8", 3413, "SETUP_FINALLY"),
+        ("2.7", 62211, "SETUP_EXCEPT"),
+    ):
+        text = f"""# Python bytecode {version} ({magic})
+# Method Name: <module>
+  1:
+            {setup}        L1
+            LOAD_NAME            (f)
+            CALL_FUNCTION        0
+            POP_TOP
+            POP_BLOCK
+            LOAD_CONST           (None)
+            RETURN_VALUE
+L1:
+            POP_TOP
+            POP_TOP
+            POP_TOP
+            LOAD_CONST           (None)
+            RETURN_VALUE
+"""
+        out = StringIO()
+        with redirect_stdout(out):
+            co = asm_string(text, optimize=True).code_list[0]
+            expected = asm_string(text).code_list[0]
+        assert out.getvalue() == ""
+        assert co.co_code == expected.co_code
@@ -0,0 +1,234 @@
+"""
+Test xasm.pyc_convert code
+"""
+
+import sys
+from dis import findlinestarts
+
+import pytest
+import xdis
+from xdis.codetype import to_portable
+
+from xasm.assemble import asm_string, create_code
+from xasm.optable import opcode_table
+from xasm.pyc_convert import code_to_asm, decode_instructions, transform_asm
+from xasm.stackdepth import max_stack_depth
+
+LISTING_38 = """# Python bytecode 3.8 (3413)
+# Method Name:       five
+# Filename:          five.py
+# First Line:        1
+  2:
+            LOAD_CONST           (5)
+            RETURN_VALUE
+
+# Method Name:       <module>
+# Filename:          five.py
+# Constants:
+#    0: <code object five at 0x0000>
+# Names:
+#    0: five
+  1:
+            LOAD_CONST           0 (<code object five at 0x0000>)
+            LOAD_CONST           ('five')
+            MAKE_FUNCTION        0
+            STORE_NAME           (five)
+  3:
+            LOAD_NAME            (five)
+            POP_JUMP_IF_FALSE    L16 (to 16)
+            LOAD_CONST           (1)
+            POP_TOP
+L16:
+  4:
+            LOAD_CONST           (None)
+            RETURN_VALUE
+"""
+
+
+def test_code_to_asm_roundtrip() -> None:
+    asm = asm_string(LISTING_38)
+    co = asm.code_list[0]
+    new_asm = code_to_asm(co, asm.python_version, asm.is_pypy)
+    assert new_asm.python_version == (3, 8)
+    assert len(new_asm.codes) == 2
+    assert new_asm.label[-1] == {"L16": 16}
+
+    instructions = new_asm.codes[-1].instructions
+    assert [inst.opname for inst in instructions[:4]] == [
+        "LOAD_CONST",
+        "LOAD_CONST",
+        "MAKE_FUNCTION",
+        "STORE_NAME",
+    ]
+    jump = instructions[5]
+    assert jump.arg == "L16"
+    assert jump in new_asm.backpatch[-1]
+    assert new_asm.codes[-1].co_lnotab == {0: 1, 8: 3, 16: 4}
+
+    # Reassembling the intermediate form gives back the same bytecode.
+    for j, code in enumerate(new_asm.codes):
+        new_asm.code = code
+        new_co, is_valid = create_code(new_asm, new_asm.label[j], new_asm.backpatch[j])
+        assert is_valid
+        assert new_co.co_code == new_asm.code_list[-1 - j].co_code
+
+
+@pytest.mark.skipif(
+    sys.version_info[:2] < (3, 11), reason="needs inline caches in host bytecode"
+)
+def test_code_to_asm_caches() -> None:
+    # Jumps to, and lines starting at, instructions right after inline
+    # caches.
+    source = """
+def f(items, limit):
+    total = 0
+    for item in items:
+        if item.size > limit.size:
+            total += item.size
+        else:
+            total -= 1
+        size = item.size if item else limit.size
+    return total
+"""
+    co = compile(source, "f.py", "exec").co_consts[0]
+    asm = code_to_asm(co, sys.version_info[:2], False)
+    code = asm.codes[-1]
+    assert sorted(set(code.co_linetable.values())) == [2, 3, 4, 5, 6, 8, 9, 10]
+    asm.code = code
+    new_co, is_valid = create_code(asm, asm.label[-1], asm.backpatch[-1])
+    assert is_valid
+    assert new_co.co_code == co.co_code
+    assert list(findlinestarts(new_co)) == list(findlinestarts(co))
+
+
+LISTING_26 = """# Python bytecode 2.6 (62161)
+# Method Name:       <module>
+# Filename:          jumps.py
+# Stack size:        2
+# Flags:             0x00000040 (NOFREE)
+# First Line:        1
+# Constants:
+#    0: 1
+#    1: None
+# Names:
+#    0: x
+#    1: y
+  1:
+            LOAD_NAME            0 (x)
+            JUMP_IF_FALSE        L1
+            POP_TOP
+            LOAD_CONST           0 (1)
+            STORE_NAME           1 (y)
+            JUMP_FORWARD         L2
+L1:
+            POP_TOP
+L2:
+  2:
+            LOAD_NAME            0 (x)
+            JUMP_IF_TRUE         L3
+            POP_TOP
+            LOAD_NAME            1 (y)
+L3:
+            STORE_NAME           1 (y)
+            LOAD_CONST           1 (None)
+            RETURN_VALUE
+"""
+
+
+def test_transform_26_27() -> None:
+    # An if statement, where the jump target pops the value tested too,
+    # and an "or", where the value is kept at the jump target.
+    asm = asm_string(LISTING_26)
+    asm = code_to_asm(asm.code_list[0], (2, 6), False, 0)
+    new_asm = transform_asm(asm, "26-27", "2.6", "2.7")
+    assert new_asm.status == "finished"
+    co = new_asm.code_list[0]
+    optable = opcode_table((2, 7), False)
+    instructions, label, _ = decode_instructions(co, optable)
+    assert [inst.opname for inst in instructions] == [
+        "LOAD_NAME",
+        "POP_JUMP_IF_FALSE",
+        "LOAD_CONST",
+        "STORE_NAME",
+        "JUMP_FORWARD",
+        "POP_TOP",
+        "LOAD_NAME",
+        "JUMP_IF_TRUE_OR_POP",
+        "LOAD_NAME",
+        "STORE_NAME",
+        "LOAD_CONST",
+        "RETURN_VALUE",
+    ]
+
+    # Both ways through each jump reach its target with the same stack.
+    index_at = {inst.offset: i for i, inst in enumerate(instructions)}
+    targets = [
+        index_at[label[inst.arg]] if isinstance(inst.arg, str) else -1
+        for inst in instructions
+    ]
+    assert targets[1] == 6
+    _, problems = max_stack_depth(
+        [inst.opcode for inst in instructions],
+        [inst.arg for inst in instructions],
+        targets,
+        optable,
+    )
+    assert problems == []
+
+
+def test_transform_33_32() -> None:
+    def make_code(
+        co_code: bytes, co_consts: tuple, co_names: tuple, co_name: str, co_lnotab
+    ):
+        return to_portable(
+            co_argcount=0,
+            co_posonlyargcount=0,
+            co_kwonlyargcount=0,
+            co_nlocals=0,
+            co_stacksize=2,
+            co_flags=0x40,
+            co_code=co_code,
+            co_consts=co_consts,
+            co_names=co_names,
+            co_varnames=(),
+            co_filename="five.py",
+            co_name=co_name,
+            co_firstlineno=1,
+            co_lnotab=co_lnotab,
+            co_freevars=(),
+            co_cellvars=(),
+            version_triple=(3, 3, 0),
+        )
+
+    five = make_code(bytes([100, 1, 0, 83]), (None, 5), (), "five", b"")
+    # LOAD_CONST 0; LOAD_CONST 1; MAKE_FUNCTION 0; STORE_NAME 0;
+    # LOAD_CONST 2; RETURN_VALUE, with line 2 starting at MAKE_FUNCTION.
+    module = make_code(
+        bytes([100, 0, 0, 100, 1, 0, 132, 0, 0, 90, 0, 0, 100, 2, 0, 83]),
+        (five, "five", None),
+        ("five",),
+        "<module>",
+        b"\x06\x01",
+    )
+    asm = code_to_asm(module, (3, 3), False, 0)
+    new_asm = transform_asm(asm, "33-32", "3.3", "3.2")
+    assert new_asm.status == "finished"
+    assert new_asm.python_version == (3, 2)
+    assert [inst.opname for inst in new_asm.codes[-1].instructions] == [
+        "LOAD_CONST",
+        "MAKE_FUNCTION",
+        "STORE_NAME",
+        "LOAD_CONST",
+        "RETURN_VALUE",
+    ]
+    # The line start moves with MAKE_FUNCTION.
+    assert list(xdis.findlinestarts(new_asm.code_list[0])) == [(0, 1), (3, 2)]
+    # The nested code object is the converted one.
+    assert new_asm.code_list[0].co_consts[0] is new_asm.code_list[1]
+
+
+if __name__ == "__main__":
+    test_code_to_asm_roundtrip()
+    test_code_to_asm_caches()
+    test_transform_26_27()
+    test_transform_33_32()
@@ -0,0 +1,93 @@
+"""
+Test xasm.server: assembling over a Unix-domain socket
+"""
+
+import os.path as osp
+import sys
+import threading
+
+import pytest
+from click.testing import CliRunner
+from xdis.magics import magics
+
+from xasm.server import AssemblerClient, AssemblerServer, assemble_to_bytes
+from xasm.xasm_cli import main
+
+LISTING = """# Python bytecode 3.8 (3413)
+# Method Name: <module>
+  1:
+            LOAD_CONST           (None)
+            RETURN_VALUE
+"""
+
+FOLD_LISTING = """# Python bytecode 3.8 (3413)
+# Method Name: <module>
+# Stack size: 2
+  1:
+            LOAD_CONST           (2)
+            LOAD_CONST           (3)
+            BINARY_ADD
+            RETURN_VALUE
+"""
+
+FOLD = {"fold_constants": True}
+
+
+@pytest.mark.skipif(sys.platform in ("win32",), reason="needs Unix-domain sockets")
+def test_server(tmp_path) -> None:
+    socket_path = osp.join(str(tmp_path), "xasm.sock")
+    server = AssemblerServer(socket_path)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        with AssemblerClient(socket_path) as client:
+            rc, pyc, diagnostics = client.assemble(LISTING, timestamp=1)
+            assert rc == 0, diagnostics
+            assert pyc.startswith(magics["3.8"])
+            assert pyc[8:12] == (1).to_bytes(4, "little")
+
+            # The connection can be used again, and errors are reported.
+            rc, pyc, diagnostics = client.assemble("garbage\n")
+            assert rc == 1
+            assert pyc == b""
+            assert "Improper beginning" in diagnostics
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+    assert not osp.exists(socket_path)
+
+
+@pytest.mark.skipif(sys.platform in ("win32",), reason="needs Unix-domain sockets")
+def test_server_options(tmp_path) -> None:
+    socket_path = osp.join(str(tmp_path), "xasm.sock")
+    server = AssemblerServer(socket_path, FOLD)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        # A connection held open doesn't keep others waiting.
+        idle = AssemblerClient(socket_path)
+        with AssemblerClient(socket_path) as client:
+            # The server's default, and the request's own option.
+            _, folded, _ = client.assemble(FOLD_LISTING, 1)
+            _, unfolded, _ = client.assemble(FOLD_LISTING, 1, fold_constants=False)
+            assert folded == assemble_to_bytes(FOLD_LISTING, 1, FOLD)[1]
+            assert unfolded == assemble_to_bytes(FOLD_LISTING, 1)[1]
+            assert folded != unfolded
+
+            rc, pyc, diagnostics = client.assemble(LISTING, speed=True)
+            assert rc == 1
+            assert "unknown option speed" in diagnostics
+            assert idle.assemble(LISTING)[0] == 0
+        idle.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def test_serve_rejects_file_options(tmp_path) -> None:
+    socket_path = osp.join(str(tmp_path), "xasm.sock")
+    result = CliRunner().invoke(main, ["--serve", socket_path, "--emit-ir"])
+    assert result.exit_code == 2
+    assert "can be given with --serve" in result.output
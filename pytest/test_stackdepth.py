@@ -0,0 +1,123 @@
+"""
+Test xasm.stackdepth code
+"""
+
+from contextlib import redirect_stdout
+from io import StringIO
+
+from xasm.assemble import asm_string
+from xasm.optable import opcode_table
+from xasm.stackdepth import max_stack_depth, operand_effect
+
+# def f(x):
+#     total = 0
+#     for i in x:
+#         if i:
+#             total = total + i * 2
+#     return total
+LISTING = """# Python bytecode 3.8 (3413)
+# Method Name: f
+# Argument count: 1
+# Number of locals: 3
+# Stack size: %d
+# Flags: 0x00000043 (NOFREE | NEWLOCALS | OPTIMIZED)
+# Varnames:
+# x, total, i
+  2:
+            LOAD_CONST           (0)
+            STORE_FAST           (total)
+  3:
+            LOAD_FAST            (x)
+            GET_ITER
+L1:
+            FOR_ITER             L3
+            STORE_FAST           (i)
+  4:
+            LOAD_FAST            (i)
+            POP_JUMP_IF_FALSE    L1
+  5:
+            LOAD_FAST            (total)
+            LOAD_FAST            (i)
+            LOAD_CONST           (2)
+            BINARY_MULTIPLY
+            BINARY_ADD
+            STORE_FAST           (total)
+            JUMP_ABSOLUTE        L1
+L3:
+  6:
+            LOAD_FAST            (total)
+            RETURN_VALUE
+"""
+
+
+def assemble(text: str, compute_stacksize: bool):
+    out = StringIO()
+    with redirect_stdout(out):
+        asm = asm_string(text, compute_stacksize=compute_stacksize)
+    assert asm.status == "finished"
+    return asm.code_list[0], out.getvalue()
+
+
+def test_compute_stacksize() -> None:
+    co, messages = assemble(LISTING % 4, True)
+    assert co.co_stacksize == 4
+    assert "stack size" not in messages
+
+    co, messages = assemble(LISTING % 1, True)
+    assert co.co_stacksize == 4
+    assert "f: stack size given is 1, but the computed size is 4" in messages
+
+    # Without compute_stacksize, the listing is trusted.
+    co, messages = assemble(LISTING % 1, False)
+    assert co.co_stacksize == 1
+    assert messages == ""
+
+    # With no "# Stack size:", there is nothing to compare with.
+    no_header = (LISTING % 0).replace("# Stack size: 0\n", "")
+    co, messages = assemble(no_header, True)
+    assert co.co_stacksize == 4
+    assert messages == ""
+    co, messages = assemble(no_header, False)
+    assert co.co_stacksize == 10
+
+
+def test_max_stack_depth() -> None:
+    optable = opcode_table((3, 8), False)
+    op = optable.opmap
+    # A handler reached with the 6 entries of an exception, and an
+    # instruction popping more than is there.
+    opcodes = [
+        op["SETUP_FINALLY"],
+        op["LOAD_CONST"],
+        op["POP_TOP"],
+        op["POP_BLOCK"],
+        op["LOAD_CONST"],
+        op["RETURN_VALUE"],
+        op["POP_TOP"],
+        op["POP_TOP"],
+        op["RETURN_VALUE"],
+    ]
+    args = [4, 0, None, None, 0, None, None, None, None]
+    targets = [6, -1, -1, -1, -1, -1, -1, -1, -1]
+    assert max_stack_depth(opcodes, args, targets, optable) == (6, [])
+
+    depth, problems = max_stack_depth(
+        [op["POP_TOP"], op["RETURN_VALUE"]], [None, None], [-1, -1], optable
+    )
+    assert depth == 0
+    assert problems == [
+        "instruction 0 POP_TOP: stack underflow",
+        "instruction 1 RETURN_VALUE: stack underflow",
+    ]
+
+
+def test_operand_effect() -> None:
+    # Two positional and one keyword argument, with the function.
+    assert operand_effect("CALL_FUNCTION", 0x0102, (2, 7)) == -4
+    assert operand_effect("CALL_FUNCTION", 3, (3, 8)) == -3
+    # Defaults, keyword defaults and the code and name.
+    assert operand_effect("MAKE_FUNCTION", 0x03, (3, 8)) == -3
+    assert operand_effect("MAKE_FUNCTION", 0x03, (3, 11)) == -2
+    assert operand_effect("MAKE_CLOSURE", 1, (2, 7)) == -2
+    assert operand_effect("BUILD_MAP", 2, (3, 8)) == -3
+    assert operand_effect("NOP", 0, (3, 8)) is None
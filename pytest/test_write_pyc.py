@@ -1,12 +1,14 @@
+import marshal
 import os
 import os.path as osp
 import sys
+from io import BytesIO
 from tempfile import NamedTemporaryFile
 
 from xdis import PYTHON3, PYTHON_VERSION_TRIPLE, load_module
 
 import pytest
-from xasm.write_pyc import write_pycfile
+from xasm.write_pyc import dumps_pyc, write_pycfile, write_pycfile_atomic
 
 
 def get_srcdir() -> str:
@@ -44,5 +46,28 @@ def test_roundtrip3() -> None:
     os.unlink(new_path)
 
 
+@pytest.mark.skipif(
+    PYTHON_VERSION_TRIPLE < (3, 7), reason="header sizes differ before 3.7"
+)
+def test_dumps_pyc(tmp_path) -> None:
+    co = compile("x = 1\n", "x.py", "exec")
+    version = PYTHON_VERSION_TRIPLE[:2]
+    data = dumps_pyc([co], 12345, version)
+    fp = BytesIO()
+    assert write_pycfile(fp, [co], 12345, version) == 0
+    assert fp.getvalue() == data
+    # Native code objects are marshalled by the running Python.
+    assert marshal.loads(data[16:]) == co
+
+    path = osp.join(str(tmp_path), "x.pyc")
+    with open(path, "wb") as old_fp:
+        old_fp.write(b"old")
+    assert write_pycfile_atomic(path, [co], 12345, version, fsync=True) == 0
+    with open(path, "rb") as new_fp:
+        assert new_fp.read() == data
+    # The temporary file has replaced the old one.
+    assert os.listdir(str(tmp_path)) == ["x.pyc"]
+
+
 if __name__ == "__main__":
     test_roundtrip3()
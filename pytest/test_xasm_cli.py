@@ -0,0 +1,51 @@
+"""
+Test the pyc-xasm command
+"""
+
+import os
+import os.path as osp
+
+from click.testing import CliRunner
+
+from xasm.xasm_cli import expand_asm_paths, main
+
+LISTING = """# Python bytecode 3.8 (3413)
+# Method Name: <module>
+  1:
+            LOAD_CONST           (None)
+            RETURN_VALUE
+"""
+
+
+def make_tree(tmp_path) -> str:
+    src = osp.join(str(tmp_path), "src")
+    os.makedirs(osp.join(src, "sub"))
+    for name in ("a.pyasm", osp.join("sub", "b.xasm")):
+        with open(osp.join(src, name), "w") as fp:
+            fp.write(LISTING)
+    with open(osp.join(src, "sub", "notes.txt"), "w") as fp:
+        fp.write("not assembly\n")
+    return src
+
+
+def test_expand_asm_paths(tmp_path) -> None:
+    src = make_tree(tmp_path)
+    assert expand_asm_paths([src], None) == [
+        (osp.join(src, "a.pyasm"), osp.join(src, "a.pyc")),
+        (osp.join(src, "sub", "b.xasm"), osp.join(src, "sub", "b.pyc")),
+    ]
+    assert expand_asm_paths([src, osp.join(src, "a.pyasm")], "out") == [
+        (osp.join(src, "a.pyasm"), osp.join("out", "a.pyc")),
+        (osp.join(src, "sub", "b.xasm"), osp.join("out", "sub", "b.pyc")),
+        (osp.join(src, "a.pyasm"), osp.join("out", "a.pyc")),
+    ]
+
+
+def test_batch(tmp_path) -> None:
+    src = make_tree(tmp_path)
+    out = osp.join(str(tmp_path), "out")
+    result = CliRunner().invoke(main, ["-j", "2", "--output-dir", out, src])
+    assert result.exit_code == 0, result.output
+    assert "Assembled 2 file(s): 2 with return code 0." in result.output
+    assert osp.exists(osp.join(out, "a.pyc"))
+    assert osp.exists(osp.join(out, "sub", "b.pyc"))
@@ -4,5 +4,7 @@
 
 __docformat__ = "restructuredtext"
 
-# This ensures VERSION will appear in pydoc
-from xdis.version import __version__  # noqa
+# This ensures VERSION will appear in pydoc. It comes from
+# xasm.version rather than xdis so that "import xasm" doesn't
+# load xdis and all of its opcode modules.
+from xasm.version import __version__  # noqa
@@ -1,20 +1,97 @@
 #!/usr/bin/env python
 import ast
+import io
+import itertools
+import marshal
+import operator
 import re
-from typing import Any, List, Optional
+import types
+import warnings
+from typing import Any, Iterable, Optional, Tuple
 
 import xdis
-from xdis import get_opcode, load_module
 from xdis.opcodes.base import cmp_op
 from xdis.version_info import PYTHON_VERSION_TRIPLE, version_str_to_tuple
 
+from xasm.exceptiontable import encode_exception_table
+from xasm.linetable import encode_line_table
+from xasm.optable import (
+    OPERAND_COMPARE,
+    OPERAND_CONST,
+    OPERAND_FREE,
+    OPERAND_LOCAL,
+    OPERAND_NAME,
+    opcode_table,
+)
+from xasm.peephole import compact, optimize
+from xasm.stackdepth import TERMINATOR_NAMES, max_stack_depth
+
 # import xdis.bytecode as Mbytecode
 
+# Regular expressions used in parsing assembly text. These are
+# compiled once here since some of them are applied to every line.
+BYTECODE_VERSION_RE = re.compile(r"^# (PyPy )?Python bytecode ")
+READ_DIRECTIVE_RE = re.compile(r"^.READ (.+)$")
+TABLE_ENTRY_RE = re.compile(r"^#\s+(\d+): (.+)$")
+CODE_OBJECT_RE = re.compile(r"<(?:Code\d+ )?code object (\S+) at (0x[0-f]+)")
+ANGLE_NAME_RE = re.compile(r"^<(.+)>$")
+LABEL_RE = re.compile(r"^\s*(\S+):\s*$")
+LINE_NUMBER_RE = re.compile(r"^\d+$")
+JUMP_TARGET_RE = re.compile(r"^\(to (\d+)\)$")
+BACKPATCH_LABEL_RE = re.compile(r"^(L\d+)(?: \(to \d+\))?$")
+# An exception-table entry, "L1 to L2 -> L3 [0] lasti", as a comment
+# under "# Exception table:" or as dis shows it under "ExceptionTable:".
+EXCEPTION_ENTRY_RE = re.compile(r"^#?\s*(\S+) to (\S+) -> (\S+) \[(\d+)\]( lasti)?\s*$")
+METHOD_NAME_PREFIX = "# Method Name:"
+
+# The stack size of a method whose listing has no "# Stack size:", when
+# it isn't computed.
+DEFAULT_STACKSIZE = 10
+
+# Prefix of the string put in co_consts in place of a code object that
+# is defined in another section, when sections are assembled in parallel.
+CODE_CONST_PLACEHOLDER = "\0xasm code object "
+
+# An instruction line is an optional line number, optional ">>" jump-target
+# marker and optional bytecode offset, followed by an opcode name and
+# an operand. An all-digit operand is split off from anything that
+# follows it, like the "(1 positional)" in "CALL_FUNCTION 1 (1 positional)".
+INSTRUCTION_RE = re.compile(
+    r"""
+    ^\s*
+    (?:>>\s+)?
+    (?:(\d+):\s+)?              # source-code line number
+    (?:>>\s+)?
+    (?:\d+\s+)?                 # bytecode offset
+    ([A-Za-z_][\w+]*)           # opcode name
+    (?:\s+(?:([-+]?\d+)(?!\S).*|(\S.*?)))?
+    \s*$
+    """,
+    re.VERBOSE,
+)
+
 
 class Instruction:  # (Mbytecode.Instruction):
-    line_no: Optional[int]
-    opname: str
-    arg: Optional[int]
+    """
+    One instruction of a method. There can be millions of these in a
+    listing, so attributes are kept in slots rather than a __dict__.
+    """
+
+    __slots__ = ("opname", "opcode", "arg", "line_no", "offset")
+
+    def __init__(
+        self,
+        opname: str = "",
+        opcode: int = 0,
+        arg=None,
+        line_no: Optional[int] = None,
+        offset: int = 0,
+    ) -> None:
+        self.opname = opname
+        self.opcode = opcode
+        self.arg = arg
+        self.line_no = line_no
+        self.offset = offset
 
     def __repr__(self) -> str:
         if self.line_no:
@@ -26,8 +103,6 @@ class Instruction:  # (Mbytecode.Instruction):
             s += f"\t{self.arg}"
         return s
 
-    pass
-
 
 def is_int(s: Any) -> bool:
     try:
@@ -37,34 +112,10 @@ def is_int(s: Any) -> bool:
         return False
 
 
-def match_lineno(s: str) -> Optional[re.Match]:
-    return re.match(r"^\d+:", s)
-
-
-def get_opname_operand(opc, fields: List[str]):
-    assert len(fields) > 0
-    opname = fields[0]
-    if opc.opmap[opname] < opc.HAVE_ARGUMENT:
-        return opname, None
-    if len(fields) > 1:
-        if is_int(fields[1]):
-            operand = int(fields[1])
-        else:
-            operand = " ".join(fields[1:])
-            if operand.startswith("(to "):
-                int_val = operand[len("(to ") :]
-                # In xasm format this shouldn't appear
-                if is_int(int_val):
-                    operand = int(int_val)
-
-        return opname, operand
-    else:
-        return opname, None
-
-
 class Assembler:
     def __init__(self, python_version, is_pypy) -> None:
-        self.opc = get_opcode(python_version, is_pypy)
+        self.optable = opcode_table(python_version, is_pypy)
+        self.opc = self.optable.opc
         self.code_list = []
         self.codes = []  # FIXME use a better name
         self.status: str = "unfinished"
@@ -76,6 +127,21 @@ class Assembler:
         self.label = []  # list of label dists, one for each function
         self.code = None
         self.siphash = None
+        # When False, a method's instructions are dropped after its
+        # code object has been created.
+        self.keep_instructions = True
+        # When True, co_stacksize is computed rather than taken from
+        # "# Stack size:"; see xasm.stackdepth.
+        self.compute_stacksize = False
+        # When True, methods go through the peephole optimizer; see
+        # xasm.peephole.
+        self.optimize = False
+        # When True, operations on constants are done at assembly time;
+        # see constant_fold().
+        self.fold_constants = False
+        # When True, the listing is taken to be valid, and operands
+        # aren't checked; see create_code().
+        self.trusted = False
 
     def code_init(self, python_version=None) -> None:
         if self.python_version is None and python_version:
@@ -86,7 +152,7 @@ class Assembler:
             co_posonlyargcount=0,
             co_kwonlyargcount=0,
             co_nlocals=0,
-            co_stacksize=10,
+            co_stacksize=DEFAULT_STACKSIZE,
             co_flags=0,
             co_code=[],
             co_consts=[],
@@ -98,12 +164,22 @@ class Assembler:
             co_lnotab={},
             co_freevars=[],
             co_cellvars=[],
+            co_exceptiontable=b"" if python_version >= (3, 11) else None,
             version_triple=python_version,
         )
 
+        # None until "# Stack size:" is seen; see finish_code().
+        self.code.co_stacksize = None
         self.code.instructions = []
+        # Entries of the "# Exception table:" section, if there is one,
+        # as (start, end, target, depth, lasti) with the first three
+        # label names or offsets.
+        self.code.exception_table = None
 
     def update_lists(self, co, label, backpatch) -> None:
+        if not self.keep_instructions:
+            self.code.instructions = []
+            backpatch = set([])
         self.code_list.append(co)
         self.codes.append(self.code)
         self.label.append(label)
@@ -131,330 +207,906 @@ class Assembler:
         self.status = "errored"
 
 
-def asm_file(path) -> Optional[Assembler]:
-    offset = 0
-    methods = {}
-    method_name = None
-    asm = None
-    backpatch_inst = set([])
-    label = {}
-    python_bytecode_version = None
-    lines = open(path).readlines()
-    i = 0
-    bytecode_seen = False
-    while i < len(lines):
-        line = lines[i]
-        i += 1
-        if line.startswith("##"):
-            # comment line
-            continue
-        if line.startswith(".READ"):
-            match = re.match("^.READ (.+)$", line)
-            if match:
-                input_pyc = match.group(1)
-                print(f"Reading {input_pyc}")
-                (
-                    version,
-                    timestamp,
-                    magic_int,
-                    co,
-                    is_pypy,
-                    source_size,
-                    sip_hash,
-                ) = load_module(input_pyc)
-                if python_bytecode_version and python_bytecode_version != version:
-                    TypeError(
-                        f"We previously saw Python version {python_bytecode_version} but we just loaded {version}.\n"
-                    )
-                python_bytecode_version = version
-                # FIXME: extract all code options below the top-level and asm.code_list
-
-        elif line.startswith("#"):
-            match = re.match("^# (PyPy )?Python bytecode ", line)
-            if match:
-                if match.group(1):
-                    is_pypy = True
-                    pypy_str = match.group(1)
-                else:
-                    is_pypy = False
-                    pypy_str = ""
+class LineStream:
+    """
+    An iterator over the lines of assembly text which counts lines
+    read and allows a single line to be pushed back. Tables like
+    "# Constants:" and "# Names:" end at the first line that isn't an
+    entry, and that line is pushed back to be read again.
+
+    If `hasher` is set, each line is fed to it the first time it is
+    read, except for "# Method Name:" lines, which start a new method
+    and so are hashed by whoever sets up the next hasher.
+    """
 
-                python_bytecode_version = (
-                    line[len("# Python bytecode " + pypy_str) :].strip().split()[0]
-                )
+    def __init__(self, lines: Iterable[str]) -> None:
+        self.lines = iter(lines)
+        self.line_no = 0
+        self.pushed_back: Optional[str] = None
+        self.hasher = None
 
-                python_version_pair = version_str_to_tuple(
-                    python_bytecode_version, length=2
-                )
-                asm = Assembler(python_version_pair, is_pypy)
-                if python_version_pair >= (3, 10):
-                    TypeError(
-                        f"Creating Python version {python_bytecode_version} not supported yet. "
-                        "Feel free to fix and put in a PR.\n"
-                    )
-                asm.code_init(python_version_pair)
-                bytecode_seen = True
-            elif line.startswith("# Timestamp in code: "):
-                text = line[len("# Timestamp in code: ") :].strip()
-                time_str = text.split()[0]
-                if is_int(time_str) and hasattr(asm, "timestamp"):
-                    asm.timestamp = int(time_str)
-            elif line.startswith("# Method Name: "):
-                if method_name:
-                    co, is_valid = create_code(asm, label, backpatch_inst)
-                    if not is_valid:
-                        return
-                    asm.update_lists(co, label, backpatch_inst)
-                    label = {}
-                    backpatch_inst = set([])
-                    methods[method_name] = co
-                    offset = 0
-                if python_bytecode_version is None:
-                    raise TypeError(
-                        f'Line {i}: "Python bytecode" not seen before "Method Name:"; please set this.'
-                    )
-                python_version_pair = version_str_to_tuple(
-                    python_bytecode_version, length=2
-                )
-                asm.code_init(python_version_pair)
-                asm.code.co_qual_name = asm.code.co_name = line[
-                    len("# Method Name: ") :
-                ].strip()
-                method_name = asm.code.co_name
-            elif line.startswith("# SipHash: "):
-                siphash = line[len("# ShipHash: ") :].strip().split()[0]
-                asm.siphash = ast.literal_eval(siphash)
-                if asm.siphash != 0:
-                    raise TypeError(
-                        "SIP hashes not supported yet. Feel free to fix and in a PR.\n"
-                    )
-
-            elif line.startswith("# Filename: "):
-                asm.code.co_filename = line[len("# Filename: ") :].strip()
-            elif line.startswith("# First Line: "):
-                s = line[len("# First Line: ") :].strip()
-                first_lineno = int(s)
-                asm.code.co_firstlineno = first_lineno
-            elif line.startswith("# Argument count: "):
-                argc = line[len("# Argument count: ") :].strip().split()[0]
-            elif line.startswith("# Position-only argument count: "):
-                argc = (
-                    line[len("# Position-only argument count: ") :].strip().split()[0]
-                )
-                asm.code.co_posonlyargcount = ast.literal_eval(argc)
-            elif line.startswith("# Keyword-only argument count: "):
-                argc = line[len("# Keyword-only argument count: ") :].strip().split()[0]
-                asm.code.co_kwonlyargcount = ast.literal_eval(argc)
-            elif line.startswith("# Number of locals: "):
-                l_str = line[len("# Number of locals: ") :].strip()
-                asm.code.co_nlocals = int(l_str)
-            elif line.startswith("# Source code size mod 2**32: ") and hasattr(
-                asm, "size"
-            ):
-                l_str = line[
-                    len("# Source code size mod 2**32: ") : -len(" bytes")
-                ].strip()
-                asm.size = int(l_str)
-            elif line.startswith("# Stack size: "):
-                l_str = line[len("# Stack size: ") :].strip()
-                asm.code.co_stacksize = int(l_str)
-            elif line.startswith("# Flags: "):
-                flags = line[len("# Flags: ") :].strip().split()[0]
-                asm.code.co_flags = ast.literal_eval(flags)
-            elif line.startswith("# Constants:"):
-                count = 0
-                while i < len(lines):
-                    line = lines[i]
-                    i += 1
-                    match = re.match(r"^#\s+(\d+): (.+)$", line)
-                    if match:
-                        index = int(match.group(1))
-                        assert index == count, (
-                            f"Constant index {index} found on line {i} "
-                            f"doesn't match expected constant index {count}."
-                        )
-                        expr = match.group(2)
-                        match = re.match(
-                            r"<(?:Code\d+ )?code object (\S+) at (0x[0-f]+)", expr
-                        )
-                        if match:
-                            name = match.group(1)
-                            m2 = re.match("^<(.+)>$", name)
-                            if m2:
-                                name = f"{m2.group(1)}_{match.group(2)}"
-                            if name in methods:
-                                asm.code.co_consts.append(methods[name])
-                            else:
-                                print(
-                                    f"line {i} ({asm.code.co_filename}, {method_name}): can't find method {name}"
-                                )
-                                bogus_name = f"**bogus {name}**"
-                                print(f"\t appending {bogus_name} to list of constants")
-                                asm.code.co_consts.append(bogus_name)
-                        else:
-                            asm.code.co_consts.append(ast.literal_eval(expr))
-                        count += 1
-                    else:
-                        i -= 1
-                        break
-                    pass
-                pass
-            elif line.startswith("# Cell variables:"):
-                i = update_code_tuple_field("co_cellvars", asm.code, lines, i)
-            elif line.startswith("# Free variables:"):
-                i = update_code_tuple_field("co_freevars", asm.code, lines, i)
-            elif line.startswith("# Names:"):
-                i = update_code_tuple_field("co_names", asm.code, lines, i)
-            elif line.startswith("# Varnames:"):
-                line = lines[i]
-                asm.code.co_varnames = line[1:].strip().split(", ")
-                i += 1
-            elif line.startswith("# Positional arguments:"):
-                line = lines[i]
-                args = line[1:].strip().split(", ")
-                asm.code.co_argcount = len(args)
-                i += 1
+    def __iter__(self) -> "LineStream":
+        return self
+
+    def __next__(self) -> str:
+        if self.pushed_back is not None:
+            line = self.pushed_back
+            self.pushed_back = None
         else:
-            if not line.strip():
-                continue
+            line = next(self.lines)
+            if self.hasher is not None and not line.startswith(METHOD_NAME_PREFIX):
+                self.hasher.update(line.encode())
+        self.line_no += 1
+        return line
 
-            match = re.match(r"^(\S+):$", line)
-            if match:
-                label_value = match.group(1)
-                # All-numeric labels, i.e. line numbers, are handled below
-                if not re.match(r"^(\d+)$", label_value):
-                    label[label_value] = offset
+    def push_back(self, line: str) -> None:
+        assert self.pushed_back is None, "only one line of pushback is supported"
+        self.pushed_back = line
+        self.line_no -= 1
+
+
+class AsmParser:
+    """
+    Turns the lines of a Python assembly (.pyasm) file into an
+    Assembler.
+
+    Lines that start with "#" are looked up by the text before their
+    first colon in HEADER_HANDLERS; all other non-blank lines are
+    labels, line numbers, or instructions, which are split apart by a
+    single precompiled regular expression, INSTRUCTION_RE.
+    """
+
+    def __init__(
+        self,
+        keep_instructions: bool = True,
+        method_cache=None,
+        compute_stacksize: bool = False,
+        optimize: bool = False,
+        fold_constants: bool = False,
+        trusted: bool = False,
+    ) -> None:
+        self.keep_instructions = keep_instructions
+        self.compute_stacksize = compute_stacksize
+        self.optimize = optimize
+        self.fold_constants = fold_constants
+        self.trusted = trusted
+        # With a MethodCache (see xasm.incremental), instruction lines
+        # are held back until the end of their method, and only
+        # tokenized if no code object was saved for the method's
+        # fingerprint.
+        self.method_cache = method_cache
+        self.fingerprints = {}
+        self.pending_lines = []
+        # When True, code objects in "# Constants:" tables become
+        # placeholders to be filled in by link_code_consts().
+        self.defer_code_consts = False
+        self.asm: Optional[Assembler] = None
+        self.methods = {}
+        self.method_name: Optional[str] = None
+        self.label = {}
+        self.backpatch_inst = set([])
+        self.offset = 0
+        self.python_bytecode_version: Optional[str] = None
+        self.python_version_pair = None
+        self.bytecode_seen = False
+        self.lines = LineStream([])
+
+    def parse(self, lines: Iterable[str]) -> Optional[Assembler]:
+        """
+        Parse `lines`, which can be any iterable of strings, such as an
+        open file. Lines are consumed one at a time, so only the
+        method currently being assembled is held in memory.
+        """
+        self.lines = LineStream(lines)
+        for line in self.lines:
+            if line.startswith("#"):
+                if line.startswith("##"):
+                    # comment line
                     continue
+                colon = line.find(":")
+                handler = HEADER_HANDLERS.get(line[2:colon]) if colon > 0 else None
+                if handler is not None:
+                    if handler(self, line[colon + 1 :].strip()) is False:
+                        return None
+                else:
+                    match = BYTECODE_VERSION_RE.match(line)
+                    if match:
+                        self.bytecode_header(match, line)
+            elif line.startswith(".READ"):
+                self.read_directive(line)
+            elif line.strip():
+                if self.method_cache is not None and self.method_name:
+                    self.pending_lines.append((self.lines.line_no, line))
+                else:
+                    self.instruction_line(line)
 
-            line_no = None
+        asm = self.asm
+        if asm is not None:
+            if self.method_name:
+                if not self.finish_method():
+                    return None
+            else:
+                co, is_valid = self.build_code()
+                if not is_valid:
+                    return None
+                asm.update_lists(co, self.label, self.backpatch_inst)
+            asm.code_list.reverse()
+            asm.status = "finished"
+
+        return asm
 
-            match = re.match(r"^\s*(\d+):\s*", line)
+    def build_code(self) -> tuple:
+        """
+        Build the code object of the method just parsed; see
+        create_code().
+        """
+        return create_code(self.asm, self.label, self.backpatch_inst)
 
-            # Sanity checking: make sure we have seen
-            # proper header lines
-            if i == 1:
-                assert bytecode_seen, (
-                    f"Improper beginning:\n{line}"
-                    "\nLine should begin with '#' "
-                    "and contain header bytecode header information."
+    def read_directive(self, line: str) -> None:
+        match = READ_DIRECTIVE_RE.match(line)
+        if match:
+            input_pyc = match.group(1)
+            print(f"Reading {input_pyc}")
+            (
+                version,
+                timestamp,
+                magic_int,
+                co,
+                is_pypy,
+                source_size,
+                sip_hash,
+            ) = xdis.load_module(input_pyc)
+            if (
+                self.python_bytecode_version
+                and self.python_bytecode_version != version
+            ):
+                TypeError(
+                    f"We previously saw Python version {self.python_bytecode_version} but we just loaded {version}.\n"
                 )
-            assert bytecode_seen, (
-                f"Error translating line {i}: "
-                "a line before this should include: \n"
-                "# Python bytecode <version>"
+            self.python_bytecode_version = version
+            # FIXME: extract all code options below the top-level and asm.code_list
+
+    def bytecode_header(self, match: re.Match, line: str) -> None:
+        if match.group(1):
+            is_pypy = True
+            pypy_str = match.group(1)
+        else:
+            is_pypy = False
+            pypy_str = ""
+
+        self.python_bytecode_version = (
+            line[len("# Python bytecode " + pypy_str) :].strip().split()[0]
+        )
+
+        python_version_pair = version_str_to_tuple(
+            self.python_bytecode_version, length=2
+        )
+        self.python_version_pair = python_version_pair
+        self.asm = asm = Assembler(python_version_pair, is_pypy)
+        asm.keep_instructions = self.keep_instructions
+        asm.compute_stacksize = self.compute_stacksize
+        asm.optimize = self.optimize
+        asm.fold_constants = self.fold_constants
+        asm.trusted = self.trusted
+        if python_version_pair >= (3, 10):
+            TypeError(
+                f"Creating Python version {self.python_bytecode_version} not supported yet. "
+                "Feel free to fix and put in a PR.\n"
             )
+        asm.code_init(python_version_pair)
+        self.bytecode_seen = True
 
-            if match:
-                line_no = int(match.group(1))
-                linetable_field = (
-                    "co_lnotab" if python_version_pair < (3, 10) else "co_linetable"
-                )
-                assert asm is not None
-                linetable = getattr(asm.code, linetable_field)
-                linetable[offset] = line_no
+    def timestamp_header(self, text: str) -> None:
+        time_str = text.split()[0] if text else ""
+        if is_int(time_str) and hasattr(self.asm, "timestamp"):
+            self.asm.timestamp = int(time_str)
 
-            # Opcode section
-            fields = line.strip().split()
-            num_fields = len(fields)
+    def finish_method(self) -> bool:
+        """
+        Build, or with a method cache possibly reuse, the code object for
+        the method being parsed. Returns False if it isn't valid.
+        """
+        asm = self.asm
+        co = None
+        cache = self.method_cache
+        if cache is not None:
+            fingerprint = self.lines.hasher.hexdigest()
+            self.lines.hasher = None
+            self.fingerprints[self.method_name] = fingerprint
+            co = cache.get(fingerprint, asm.python_version, asm.is_pypy)
+            if co is None:
+                for text_line_no, line in self.pending_lines:
+                    self.instruction_line(line, text_line_no)
+            self.pending_lines = []
+        if co is None:
+            co, is_valid = self.build_code()
+            if not is_valid:
+                return False
+            if cache is not None:
+                cache.put(fingerprint, co, asm.python_version, asm.is_pypy)
+        asm.update_lists(co, self.label, self.backpatch_inst)
+        self.label = {}
+        self.backpatch_inst = set([])
+        self.methods[self.method_name] = co
+        self.offset = 0
+        return True
 
-            if num_fields == 1 and line_no is not None:
-                continue
+    def method_name_header(self, text: str) -> Optional[bool]:
+        asm = self.asm
+        if self.method_name and not self.finish_method():
+            return False
+        if self.python_bytecode_version is None:
+            raise TypeError(
+                f'Line {self.lines.line_no}: "Python bytecode" not seen before "Method Name:"; please set this.'
+            )
+        self.python_version_pair = version_str_to_tuple(
+            self.python_bytecode_version, length=2
+        )
+        asm.code_init(self.python_version_pair)
+        asm.code.co_qual_name = asm.code.co_name = text
+        self.method_name = text
+        if self.method_cache is not None:
+            from xasm.incremental import method_hasher
+
+            self.lines.hasher = method_hasher(
+                asm.python_version,
+                asm.is_pypy,
+                output_options(
+                    self.compute_stacksize,
+                    self.optimize,
+                    self.fold_constants,
+                    self.trusted,
+                ),
+            )
+            self.lines.hasher.update(f"{METHOD_NAME_PREFIX} {text}\n".encode())
+        return None
+
+    def siphash_header(self, text: str) -> None:
+        siphash = text.split()[0]
+        self.asm.siphash = ast.literal_eval(siphash)
+        if self.asm.siphash != 0:
+            raise TypeError(
+                "SIP hashes not supported yet. Feel free to fix and in a PR.\n"
+            )
 
-            try:
-                if num_fields > 1:
-                    if fields[0] == ">>":
-                        fields = fields[1:]
-                        num_fields -= 1
-                    if match_lineno(fields[0]) and is_int(fields[1]):
-                        line_no = int(fields[0][:-1])
-                        opname, operand = get_opname_operand(asm.opc, fields[2:])
-                    elif match_lineno(fields[0]):
-                        line_no = int(fields[0][:-1])
-                        fields = fields[1:]
-                        if fields[0] == ">>":
-                            fields = fields[1:]
-                            if is_int(fields[0]):
-                                fields = fields[1:]
-                        opname, operand = get_opname_operand(asm.opc, fields)
-                    elif is_int(fields[0]):
-                        opname, operand = get_opname_operand(asm.opc, fields[1:])
+    def filename_header(self, text: str) -> None:
+        self.asm.code.co_filename = text
+
+    def first_line_header(self, text: str) -> None:
+        self.asm.code.co_firstlineno = int(text)
+
+    def argument_count_header(self, text: str) -> None:
+        # The argument count is computed from "# Positional arguments:"
+        pass
+
+    def posonly_argument_count_header(self, text: str) -> None:
+        self.asm.code.co_posonlyargcount = ast.literal_eval(text.split()[0])
+
+    def kwonly_argument_count_header(self, text: str) -> None:
+        self.asm.code.co_kwonlyargcount = ast.literal_eval(text.split()[0])
+
+    def number_of_locals_header(self, text: str) -> None:
+        self.asm.code.co_nlocals = int(text)
+
+    def source_size_header(self, text: str) -> None:
+        if hasattr(self.asm, "size"):
+            if text.endswith(" bytes"):
+                text = text[: -len(" bytes")]
+            self.asm.size = int(text)
+
+    def stack_size_header(self, text: str) -> None:
+        self.asm.code.co_stacksize = int(text)
+
+    def flags_header(self, text: str) -> None:
+        self.asm.code.co_flags = ast.literal_eval(text.split()[0])
+
+    def constants_header(self, text: str) -> None:
+        asm = self.asm
+        count = 0
+        for line in self.lines:
+            match = TABLE_ENTRY_RE.match(line)
+            if match:
+                index = int(match.group(1))
+                assert index == count, (
+                    f"Constant index {index} found on line {self.lines.line_no} "
+                    f"doesn't match expected constant index {count}."
+                )
+                expr = match.group(2)
+                match = CODE_OBJECT_RE.match(expr)
+                if match:
+                    name = match.group(1)
+                    m2 = ANGLE_NAME_RE.match(name)
+                    if m2:
+                        name = f"{m2.group(1)}_{match.group(2)}"
+                    if self.defer_code_consts:
+                        asm.code.co_consts.append(CODE_CONST_PLACEHOLDER + name)
+                    elif name in self.methods:
+                        asm.code.co_consts.append(self.methods[name])
+                        if name in self.fingerprints:
+                            # A change to a nested code object changes
+                            # this method too.
+                            self.lines.hasher.update(self.fingerprints[name].encode())
                     else:
-                        opname, operand = get_opname_operand(asm.opc, fields)
-                else:
-                    opname, _ = get_opname_operand(asm.opc, fields)
-            except Exception as e:
-                print(f"Line {i}: {e}")
-                raise
-
-            if opname in asm.opc.opname:
-                inst = Instruction()
-                inst.opname = opname.replace("+", "_")
-                inst.opcode = asm.opc.opmap[inst.opname]
-                if xdis.op_has_argument(inst.opcode, asm.opc):
-                    inst.arg = operand
+                        print(
+                            f"line {self.lines.line_no} ({asm.code.co_filename}, {self.method_name}): can't find method {name}"
+                        )
+                        bogus_name = f"**bogus {name}**"
+                        print(f"\t appending {bogus_name} to list of constants")
+                        asm.code.co_consts.append(bogus_name)
                 else:
-                    inst.arg = None
-                inst.line_no = line_no
-                asm.code.instructions.append(inst)
-                if inst.opcode in asm.opc.JUMP_OPS:
-                    if not is_int(operand):
-                        backpatch_inst.add(inst)
-                offset += xdis.op_size(inst.opcode, asm.opc)
+                    asm.code.co_consts.append(ast.literal_eval(expr))
+                count += 1
             else:
-                raise RuntimeError(f"Illegal opname {opname} in:\n{line}")
-            pass
-        pass
+                self.lines.push_back(line)
+                break
+
+    def cell_variables_header(self, text: str) -> None:
+        update_code_tuple_field("co_cellvars", self.asm.code, self.lines)
+
+    def free_variables_header(self, text: str) -> None:
+        update_code_tuple_field("co_freevars", self.asm.code, self.lines)
+
+    def names_header(self, text: str) -> None:
+        update_code_tuple_field("co_names", self.asm.code, self.lines)
 
-    if asm is not None:
-        # print(linetable)
+    def varnames_header(self, text: str) -> None:
+        line = next(self.lines, "")
+        self.asm.code.co_varnames = line[1:].strip().split(", ")
 
-        co, is_valid = create_code(asm, label, backpatch_inst)
-        asm.update_lists(co, label, backpatch_inst)
-        asm.code_list.reverse()
-        asm.status = "finished"
+    def positional_arguments_header(self, text: str) -> None:
+        line = next(self.lines, "")
+        args = line[1:].strip().split(", ")
+        self.asm.code.co_argcount = len(args)
 
+    def exception_table_header(self, text: str) -> None:
+        self.asm.code.exception_table = entries = []
+        for line in self.lines:
+            match = EXCEPTION_ENTRY_RE.match(line)
+            if match:
+                entries.append(exception_entry(match))
+            else:
+                self.lines.push_back(line)
+                break
+
+    def instruction_line(self, line: str, text_line_no: Optional[int] = None) -> None:
+        if text_line_no is None:
+            text_line_no = self.lines.line_no
+        # Sanity checking: make sure we have seen
+        # proper header lines
+        if text_line_no == 1:
+            assert self.bytecode_seen, (
+                f"Improper beginning:\n{line}"
+                "\nLine should begin with '#' "
+                "and contain header bytecode header information."
+            )
+        assert self.bytecode_seen, (
+            f"Error translating line {text_line_no}: "
+            "a line before this should include: \n"
+            "# Python bytecode <version>"
+        )
+        asm = self.asm
+        assert asm is not None
+
+        match = LABEL_RE.match(line)
+        if match:
+            label_value = match.group(1)
+            if LINE_NUMBER_RE.match(label_value):
+                # A line number that applies to the next instruction.
+                self.set_line_number(int(label_value))
+            elif label_value == "ExceptionTable":
+                # The exception table as dis shows it; its entries
+                # follow.
+                if asm.code.exception_table is None:
+                    asm.code.exception_table = []
+            else:
+                self.label[label_value] = self.offset
+            return
+
+        match = INSTRUCTION_RE.match(line)
+        if not match:
+            raise RuntimeError(f"Line {text_line_no}: can't parse instruction in:\n{line}")
+        line_no, opname, int_arg, arg = match.groups()
+        if line_no is not None:
+            line_no = int(line_no)
+            self.set_line_number(line_no)
+
+        optable = asm.optable
+        opname = opname.replace("+", "_")
+        opcode = optable.opmap.get(opname)
+        if opcode is None:
+            match = EXCEPTION_ENTRY_RE.match(line)
+            if match and asm.code.exception_table is not None:
+                asm.code.exception_table.append(exception_entry(match))
+                return
+            raise RuntimeError(f"Illegal opname {opname} in:\n{line}")
+
+        inst = Instruction(opname, opcode, line_no=line_no)
+        if optable.has_arg[opcode]:
+            if int_arg is not None:
+                inst.arg = int(int_arg)
+            else:
+                match = JUMP_TARGET_RE.match(arg) if arg else None
+                inst.arg = int(match.group(1)) if match else arg
+            if optable.is_jump[opcode] and not isinstance(inst.arg, int):
+                # Keep just the label name of "L16 (to 16)".
+                match = BACKPATCH_LABEL_RE.match(inst.arg)
+                if match:
+                    inst.arg = match.group(1)
+                self.backpatch_inst.add(inst)
+        asm.code.instructions.append(inst)
+        self.offset += optable.size[opcode]
+
+    def set_line_number(self, line_no: int) -> None:
+        linetable_field = (
+            "co_lnotab" if self.python_version_pair < (3, 10) else "co_linetable"
+        )
+        getattr(self.asm.code, linetable_field)[self.offset] = line_no
+
+
+# Maps the text between "# " and the first ":" of a header line to the
+# AsmParser method that handles the rest of the line.
+HEADER_HANDLERS = {
+    "Timestamp in code": AsmParser.timestamp_header,
+    "Method Name": AsmParser.method_name_header,
+    "SipHash": AsmParser.siphash_header,
+    "Filename": AsmParser.filename_header,
+    "First Line": AsmParser.first_line_header,
+    "Argument count": AsmParser.argument_count_header,
+    "Position-only argument count": AsmParser.posonly_argument_count_header,
+    "Keyword-only argument count": AsmParser.kwonly_argument_count_header,
+    "Number of locals": AsmParser.number_of_locals_header,
+    "Source code size mod 2**32": AsmParser.source_size_header,
+    "Stack size": AsmParser.stack_size_header,
+    "Flags": AsmParser.flags_header,
+    "Constants": AsmParser.constants_header,
+    "Cell variables": AsmParser.cell_variables_header,
+    "Free variables": AsmParser.free_variables_header,
+    "Names": AsmParser.names_header,
+    "Varnames": AsmParser.varnames_header,
+    "Positional arguments": AsmParser.positional_arguments_header,
+    "Exception table": AsmParser.exception_table_header,
+}
+
+
+def exception_entry(match: re.Match) -> tuple:
+    """
+    Return (start, end, target, depth, lasti) for an exception-table
+    entry matched by EXCEPTION_ENTRY_RE.
+    """
+    start, end, target, depth, lasti = match.groups()
+    return start, end, target, int(depth), lasti is not None
+
+
+def output_options(
+    compute_stacksize: bool = False,
+    optimize: bool = False,
+    fold_constants: bool = False,
+    trusted: bool = False,
+) -> tuple:
+    """
+    Return the assembly options that change the bytecode produced, or
+    whether any is, and aren't at their defaults, as a tuple of
+    (name, value) pairs, to be mixed into the keys of saved bytecode.
+    """
+    options = []
+    if compute_stacksize:
+        options.append(("compute_stacksize", True))
+    if optimize:
+        options.append(("optimize", True))
+    if fold_constants:
+        options.append(("fold_constants", True))
+    if trusted:
+        options.append(("trusted", True))
+    return tuple(options)
+
+
+def asm_stream(
+    fp,
+    keep_instructions: bool = True,
+    method_cache=None,
+    compute_stacksize: bool = False,
+    optimize: bool = False,
+    fold_constants: bool = False,
+    trusted: bool = False,
+) -> Optional[Assembler]:
+    """
+    Assemble Python assembly text read from the open text file `fp`,
+    for example sys.stdin. The file is read a line at a time.
+
+    If `keep_instructions` is False, the instructions of each method
+    are dropped once its code object has been built, so that memory use
+    is bounded by the largest method rather than by the whole file.
+
+    If `method_cache` is an xasm.incremental.MethodCache, methods whose
+    fingerprint is found in it are not assembled again; the saved code
+    object is used instead. Instructions are not kept for those methods.
+
+    If `compute_stacksize` is True, the stack size of each method is
+    computed from its instructions, with a warning if that differs
+    from the one given in "# Stack size:".
+
+    If `optimize` is True, each method goes through the peephole
+    optimizer of xasm.peephole before its bytecode is produced, and the
+    changes made are printed.
+
+    If `fold_constants` is True, operations on constants, like
+    arithmetic and building tuples, are done at assembly time; see
+    constant_fold().
+
+    If `trusted` is True, the listing is taken to be valid, as for one
+    that was machine generated and checked before, and the operands of
+    its instructions aren't checked.
+    """
+    return AsmParser(
+        keep_instructions,
+        method_cache,
+        compute_stacksize,
+        optimize,
+        fold_constants,
+        trusted,
+    ).parse(fp)
+
+
+def asm_string(
+    text: str,
+    keep_instructions: bool = True,
+    method_cache=None,
+    compute_stacksize: bool = False,
+    optimize: bool = False,
+    fold_constants: bool = False,
+    trusted: bool = False,
+) -> Optional[Assembler]:
+    """
+    Assemble the Python assembly given in the string `text`.
+    """
+    return asm_stream(
+        io.StringIO(text),
+        keep_instructions,
+        method_cache,
+        compute_stacksize,
+        optimize,
+        fold_constants,
+        trusted,
+    )
+
+
+def asm_file(
+    path,
+    keep_instructions: bool = True,
+    method_cache=None,
+    cache=None,
+    jobs: int = 1,
+    compute_stacksize: bool = False,
+    optimize: bool = False,
+    fold_constants: bool = False,
+    trusted: bool = False,
+) -> Optional[Assembler]:
+    """
+    Assemble the Python assembly file `path`. See asm_stream().
+
+    If `jobs` is more than 1, the methods of the file are assembled in
+    that many processes; see asm_sections(). `jobs` is ignored when
+    `method_cache` is given.
+
+    `cache` is an optional xasm.cache.AssemblyCache. If the contents of
+    `path` were assembled before, the file isn't parsed at all, and the
+    Assembler returned has a `code_list` holding the marshalled bytes of
+    the code rather than code objects; write_pycfile() accepts either.
+
+    A `path` ending in ".xasmir" is an IR file written by
+    xasm.ir.dump_ir(), which is loaded without parsing any text.
+    `keep_instructions`, `method_cache` and `jobs` don't apply to it.
+    """
+    if cache is not None:
+        with open(path, "rb") as fp:
+            key = cache.key(
+                fp,
+                output_options(compute_stacksize, optimize, fold_constants, trusted),
+            )
+        entry = cache.get(key)
+        if entry is not None:
+            python_version, is_pypy, timestamp, data = entry
+            asm = Assembler(python_version, is_pypy)
+            asm.timestamp = timestamp
+            asm.code_list = [data]
+            asm.status = "finished"
+            return asm
+
+    from xasm.ir import IR_SUFFIX, load_ir
+
+    if str(path).endswith(IR_SUFFIX):
+        asm = load_ir(path, compute_stacksize, optimize, fold_constants, trusted)
+    else:
+        with open(path) as fp:
+            if jobs > 1 and method_cache is None:
+                asm = asm_sections(
+                    fp, jobs, compute_stacksize, optimize, fold_constants, trusted
+                )
+            else:
+                asm = asm_stream(
+                    fp,
+                    keep_instructions,
+                    method_cache,
+                    compute_stacksize,
+                    optimize,
+                    fold_constants,
+                    trusted,
+                )
+    if cache is not None and asm is not None and asm.status == "finished":
+        cache.put(key, asm)
     return asm
 
 
-def member(fields, match_value) -> int:
-    for i, v in enumerate(fields):
-        if v == match_value and type(v) == type(match_value):
-            return i
-        pass
-    return -1
+def split_sections(fp) -> tuple:
+    """
+    Split the assembly text in `fp` at "# Method Name:" lines. Returns
+    the lines before the first method, and a list of
+    (line number, lines) pairs, one for each method.
+    """
+    preamble = []
+    sections = []
+    lines = preamble
+    for line_no, line in enumerate(fp, 1):
+        if line.startswith(METHOD_NAME_PREFIX):
+            lines = []
+            sections.append((line_no, lines))
+        lines.append(line)
+    return preamble, sections
+
+
+def assemble_section(
+    preamble: str,
+    line_no: int,
+    section: str,
+    compute_stacksize: bool = False,
+    optimize: bool = False,
+    fold_constants: bool = False,
+    trusted: bool = False,
+) -> Optional[tuple]:
+    """
+    Assemble the text of a single method from split_sections(), which
+    starts on line `line_no`, in a worker process. Code objects in its
+    constants are left as placeholders.
+
+    Returns a tuple of the Assembler's version, timestamp and source
+    size, the method name, and its code object, or None if it isn't
+    valid. Native code objects can't be pickled, so they are returned
+    marshalled.
+    """
+    parser = AsmParser(
+        keep_instructions=False,
+        compute_stacksize=compute_stacksize,
+        optimize=optimize,
+        fold_constants=fold_constants,
+        trusted=trusted,
+    )
+    parser.defer_code_consts = True
+
+    def lines():
+        yield from preamble.splitlines(keepends=True)
+        # Keep line numbers in messages the same as in the whole file.
+        parser.lines.line_no = line_no - 1
+        yield from section.splitlines(keepends=True)
+
+    asm = parser.parse(lines())
+    if asm is None:
+        return None
+    co = asm.code_list[0]
+    if isinstance(co, types.CodeType):
+        co = marshal.dumps(co)
+    return (
+        asm.python_version,
+        asm.is_pypy,
+        asm.timestamp,
+        asm.size,
+        parser.method_name,
+        co,
+    )
+
+
+def link_code_consts(co, methods: dict):
+    """
+    Replace the placeholders left by assemble_section() in the constants
+    of `co` with the code objects in `methods`, and return the result.
+    """
+    consts = list(co.co_consts)
+    changed = False
+    for i, const in enumerate(consts):
+        if isinstance(const, str) and const.startswith(CODE_CONST_PLACEHOLDER):
+            name = const[len(CODE_CONST_PLACEHOLDER) :]
+            if name in methods:
+                consts[i] = methods[name]
+            else:
+                print(f"({co.co_filename}, {co.co_name}): can't find method {name}")
+                consts[i] = f"**bogus {name}**"
+                print(f"\t appending {consts[i]} to list of constants")
+            changed = True
+    if not changed:
+        return co
+    if isinstance(co, types.CodeType):
+        return co.replace(co_consts=tuple(consts))
+    co.co_consts = tuple(consts)
+    return co
+
+
+def asm_sections(
+    fp,
+    jobs: int,
+    compute_stacksize: bool = False,
+    optimize: bool = False,
+    fold_constants: bool = False,
+    trusted: bool = False,
+) -> Optional[Assembler]:
+    """
+    Assemble the Python assembly text in `fp`, with its methods parsed
+    and turned into code objects in a pool of `jobs` processes.
+
+    Methods refer to one another only through code objects in their
+    constants, and always to methods earlier in the file, so the code
+    objects are linked together here in file order once all the
+    sections have been assembled. Only `code_list`, not the
+    instructions of each method, is filled in.
+    """
+    preamble, sections = split_sections(fp)
+    if not sections or any(line.startswith(".READ") for line in preamble):
+        return AsmParser(
+            keep_instructions=False,
+            compute_stacksize=compute_stacksize,
+            optimize=optimize,
+            fold_constants=fold_constants,
+            trusted=trusted,
+        ).parse(
+            itertools.chain(preamble, *(lines for _, lines in sections))
+        )
+
+    # Strings pickle much faster than lists of lines.
+    preamble = "".join(preamble)
+    import concurrent.futures
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        results = list(
+            executor.map(
+                assemble_section,
+                itertools.repeat(preamble),
+                [line_no for line_no, _ in sections],
+                ["".join(lines) for _, lines in sections],
+                itertools.repeat(compute_stacksize),
+                itertools.repeat(optimize),
+                itertools.repeat(fold_constants),
+                itertools.repeat(trusted),
+                chunksize=max(1, len(sections) // (4 * jobs)),
+            )
+        )
+    if any(result is None for result in results):
+        return None
+
+    python_version, is_pypy, timestamp, size = results[0][:4]
+    asm = Assembler(python_version, is_pypy)
+    asm.timestamp = timestamp
+    asm.size = size
+    methods = {}
+    for result in results:
+        method_name, co = result[4:]
+        if isinstance(co, bytes):
+            co = marshal.loads(co)
+        co = link_code_consts(co, methods)
+        methods[method_name] = co
+        asm.code_list.append(co)
+    asm.code_list.reverse()
+    asm.status = "finished"
+    return asm
+
+
+def field_key(value):
+    """
+    Return a dictionary key for `value` which, unlike `value` itself,
+    keeps apart values that compare equal but are different constants:
+    True, 1 and 1.0, 0.0 and -0.0, and tuples or frozensets of these.
+    Raises TypeError if `value` can't be hashed.
+    """
+    value_type = type(value)
+    if value_type in (float, complex):
+        # repr() tells 0.0 from -0.0, and makes NaN equal to itself.
+        return (value_type, repr(value))
+    if value_type is tuple:
+        return (value_type, tuple(field_key(item) for item in value))
+    if value_type is frozenset:
+        return (value_type, frozenset(field_key(item) for item in value))
+    return (value_type, value)
+
+
+class FieldIndex:
+    """
+    An index from value to position in one of the lists of a code
+    object, like co_consts or co_names, giving the position of the first
+    occurrence of a value in constant time. Entries appended to the list
+    by others are picked up on the next lookup. Values that can't be
+    hashed, like lists, are found by a linear search of the unhashable
+    entries, comparing type as well as value so that, say, 1 and True
+    are kept apart.
+    """
+
+    def __init__(self, values: list) -> None:
+        self.values = values
+        self.positions = {}
+        self.unhashable = []
+        self.size = 0
+
+    def catch_up(self) -> None:
+        values = self.values
+        for i in range(self.size, len(values)):
+            value = values[i]
+            try:
+                self.positions.setdefault(field_key(value), i)
+            except TypeError:
+                self.unhashable.append(i)
+        self.size = len(values)
+
+    def find(self, value) -> int:
+        """
+        Return the position of `value` in the list, or -1.
+        """
+        if self.size != len(self.values):
+            self.catch_up()
+        try:
+            return self.positions.get(field_key(value), -1)
+        except TypeError:
+            for i in self.unhashable:
+                v = self.values[i]
+                if v == value and type(v) is type(value):
+                    return i
+            return -1
+
+    def add(self, value) -> int:
+        """
+        Return the position of `value` in the list, appending it if it
+        isn't there.
+        """
+        i = self.find(value)
+        if i < 0:
+            i = len(self.values)
+            self.values.append(value)
+        return i
+
+
+def field_index(code, field_name: str) -> FieldIndex:
+    """
+    Return the FieldIndex for list `field_name` of portable code object
+    `code`, creating it if needed.
+    """
+    indexes = code.__dict__.setdefault("field_indexes", {})
+    values = getattr(code, field_name)
+    index = indexes.get(field_name)
+    if index is None or index.values is not values:
+        index = indexes[field_name] = FieldIndex(values)
+    return index
 
 
 def update_code_field(field_name: str, value, inst, opc) -> None:
-    field_values = getattr(opc, field_name)
-    # Can't use "in" because True == 1 and False == 0
-    # if value in l:
-    i = member(field_values, value)
-    if i >= 0:
-        inst.arg = i
-    else:
-        inst.arg = len(field_values)
-        field_values.append(value)
+    """
+    Set the operand of `inst` to the position of `value` in list
+    `field_name` of code object `opc`, adding `value` to the list if it
+    isn't there already.
+    """
+    inst.arg = field_index(opc, field_name).add(value)
 
 
-def update_code_tuple_field(field_name: str, code, lines: List[str], i: int):
+def update_code_tuple_field(field_name: str, code, lines: "LineStream") -> None:
     count = 0
-    while i < len(lines):
-        line = lines[i]
-        i += 1
-        match = re.match(r"^#\s+(\d+): (.+)$", line)
+    for line in lines:
+        match = TABLE_ENTRY_RE.match(line)
         if match:
             index = int(match.group(1))
             assert (
                 index == count
-            ), f'In field" "{field_name}", line {i}, number {index} is expected to have value {count}.'
+            ), f'In field" "{field_name}", line {lines.line_no}, number {index} is expected to have value {count}.'
             field_values = getattr(code, field_name)
             field_values.append(match.group(2))
             count += 1
         else:
-            i -= 1
+            lines.push_back(line)
             break
         pass
-    return i
 
 
 def err(msg: str, inst, i: int):
@@ -469,13 +1121,14 @@ def warn(mess: str) -> None:
     print("Warning: ", mess)
 
 
-def decode_lineno_tab_old(lnotab, first_lineno: int) -> dict:
+def decode_lineno_tab_old(lnotab, first_lineno: int, signed: bool = False) -> dict:
     """
     Uncompresses line number table for Python versions before
-    3.10
+    3.10. Line deltas are signed bytes in Python 3.6 and later;
+    set `signed` for those.
     """
-    line_number, line_number_diff = first_lineno, 0
-    offset, offset_diff = 0, 0
+    line_number = first_lineno
+    offset = 0
     uncompressed_lnotab = {}
     for i in range(0, len(lnotab), 2):
         offset_diff = lnotab[i]
@@ -483,234 +1136,766 @@ def decode_lineno_tab_old(lnotab, first_lineno: int) -> dict:
         if not isinstance(offset_diff, int):
             offset_diff = ord(offset_diff)
             line_number_diff = ord(line_number_diff)
+        if signed and line_number_diff >= 0x80:
+            line_number_diff -= 0x100
 
-        assert offset_diff < 256
-        if offset_diff == 255:
-            continue
-        assert line_number_diff < 256
-        if line_number_diff == 255:
-            continue
-        line_number += line_number_diff
+        # Gaps of more than 255 bytes, and line deltas too big for a
+        # byte, are split over several entries.
         offset += offset_diff
-        uncompressed_lnotab[offset] = line_number
+        if line_number_diff:
+            line_number += line_number_diff
+            uncompressed_lnotab[offset] = line_number
 
     return uncompressed_lnotab
 
 
-def is_code_ok(asm: Assembler) -> bool:
+def operand_limits(code, optable) -> Tuple[dict, dict]:
+    """
+    Return what create_code() needs to check operands that index the
+    tables of `code`: a dictionary from operand kind to the size of the
+    table and its description, and one giving, for opcodes whose operand
+    is more than a single index, where the indices are in it: a tuple of
+    (shift, mask) pairs, one for each index. A mask of -1 takes all the
+    bits above the shift, leaving out low bits that hold flags.
     """
-    Performs some sanity checks on code.
+    version_tuple = optable.version_tuple
+    free_size = len(code.co_cellvars) + len(code.co_freevars)
+    if version_tuple >= (3, 11):
+        # Cells and free variables are numbered after the locals.
+        free_size += len(code.co_varnames)
+    local_size = len(code.co_varnames)
+    if version_tuple >= (3, 13):
+        # LOAD_FAST takes the place of LOAD_CLOSURE, for any variable.
+        local_size = free_size
+    limits = {
+        OPERAND_CONST: (len(code.co_consts), "constant"),
+        OPERAND_LOCAL: (local_size, "variable"),
+        OPERAND_NAME: (len(code.co_names), "name"),
+        OPERAND_FREE: (free_size, "free variable"),
+    }
+    index_fields = {}
+    opmap = optable.opmap
+    if version_tuple >= (3, 11):
+        # The low bit says whether a NULL is pushed too.
+        index_fields[opmap["LOAD_GLOBAL"]] = ((1, -1),)
+    if version_tuple >= (3, 12):
+        index_fields[opmap["LOAD_ATTR"]] = ((1, -1),)
+        index_fields[opmap["LOAD_SUPER_ATTR"]] = ((2, -1),)
+    if version_tuple >= (3, 13):
+        # Two locals, of 4 bits each.
+        for name in (
+            "LOAD_FAST_LOAD_FAST",
+            "STORE_FAST_LOAD_FAST",
+            "STORE_FAST_STORE_FAST",
+        ):
+            index_fields[opmap[name]] = ((4, 0xF), (0, 0xF))
+    return limits, index_fields
+
+
+def extended_arg_count(arg: int, optable) -> int:
     """
+    Return the number of EXTENDED_ARG instructions needed in front of an
+    instruction with operand `arg`.
+    """
+    count = 0
+    while arg > optable.ARG_MAX_VALUE:
+        arg >>= optable.EXTENDED_ARG_SHIFT
+        count += 1
+    return count
 
-    is_valid: bool = True
 
-    code = asm.code
-    last_instruction = code.instructions[-1]
-    last_offset = last_instruction.offset
-    if last_instruction.opname not in ("RETURN_VALUE", "RERAISE", "RAISE_VARARGS"):
-        warn(
-            f"Last instruction of at offset {last_offset} of {code.co_name}"
-            f' should be "RETURN_VALUE", is "{last_instruction.opname}"'
-        )
-        is_valid = False
+def layout_instructions(opcodes: list, args: list, targets: list, optable) -> list:
+    """
+    Decide where each instruction goes, and the operands of jumps.
+
+    `opcodes` and `args` give the opcode and operand of each instruction,
+    with None as the operand of instructions that take none. For a jump,
+    `targets` gives the index of the instruction jumped to, which can be
+    len(opcodes) for the end of the code, and -1 for other instructions.
+    The operands of jumps in `args` are filled in.
+
+    An operand too big for an instruction needs EXTENDED_ARG
+    instructions in front of it, which move everything after it. So jump
+    operands start out assuming they need no EXTENDED_ARG, and are
+    recomputed, adding EXTENDED_ARGs as needed, until nothing changes.
+    Jump operands only grow when instructions get bigger, so this stops,
+    usually after one or two passes, with as few EXTENDED_ARGs as
+    possible.
+
+    From 3.11 on, instructions are followed by the inline CACHE entries
+    their opcode needs, and relative jumps count from after those.
+
+    Returns a list of the offset of each instruction, including its
+    EXTENDED_ARG prefixes, followed by the length of the code.
+    """
+    n = len(opcodes)
+    size = optable.size
+    cache_size = optable.cache_size
+    extended_arg_size = size[optable.EXTENDED_ARG]
+    jump_unit = optable.jump_unit
+    is_jrel = optable.is_jrel
+    opname = optable.opname
+
+    prefixes = [0] * n
+    jumps = []
+    for k in range(n):
+        if targets[k] >= 0:
+            jumps.append(k)
+        elif args[k] is not None:
+            prefixes[k] = extended_arg_count(args[k], optable)
+
+    while True:
+        offsets = []
+        offset = 0
+        for k in range(n):
+            offsets.append(offset)
+            opcode = opcodes[k]
+            offset += prefixes[k] * extended_arg_size + size[opcode] + cache_size[opcode]
+        offsets.append(offset)
+
+        changed = False
+        for k in jumps:
+            target_offset = offsets[targets[k]]
+            opcode = opcodes[k]
+            if is_jrel[opcode]:
+                # Relative jumps count from the end of the instruction.
+                if "BACKWARD" in opname[opcode]:
+                    arg = offsets[k + 1] - target_offset
+                else:
+                    arg = target_offset - offsets[k + 1]
+            else:
+                arg = target_offset
+            arg //= jump_unit
+            args[k] = arg
+            if arg >= 0:
+                count = extended_arg_count(arg, optable)
+                if count > prefixes[k]:
+                    prefixes[k] = count
+                    changed = True
+        if not changed:
+            return offsets
+
+
+def emit_instructions(
+    opcodes: list, args: list, offsets: list, optable
+) -> bytearray:
+    """
+    Return the bytecode of the instructions placed by
+    layout_instructions(). It is written straight into a bytearray of
+    the final length. The zero bytes left between instructions are
+    their inline CACHE entries.
+    """
+    bytecode = bytearray(offsets[-1])
+    extended_arg = optable.EXTENDED_ARG
+    is_wordcode = optable.is_wordcode
+    arg_max_value = optable.ARG_MAX_VALUE
+    for opcode, arg, pos in zip(opcodes, args, offsets):
+        if arg is None:
+            # Wordcode instructions without an operand have 0 for it.
+            bytecode[pos] = opcode
+        elif is_wordcode:
+            # The high bytes of an operand go to EXTENDED_ARGs in front.
+            if arg > arg_max_value:
+                shift = 8
+                while arg >> shift > arg_max_value:
+                    shift += 8
+                for shift in range(shift, 0, -8):
+                    bytecode[pos] = extended_arg
+                    bytecode[pos + 1] = (arg >> shift) & 0xFF
+                    pos += 2
+            bytecode[pos] = opcode
+            bytecode[pos + 1] = arg & 0xFF
+        else:
+            # Operands are two little-endian bytes, with one EXTENDED_ARG
+            # in front holding the next two if needed.
+            if arg > arg_max_value:
+                bytecode[pos] = extended_arg
+                bytecode[pos + 1] = (arg >> 16) & 0xFF
+                bytecode[pos + 2] = (arg >> 24) & 0xFF
+                pos += 3
+            bytecode[pos] = opcode
+            bytecode[pos + 1] = arg & 0xFF
+            bytecode[pos + 2] = (arg >> 8) & 0xFF
+    return bytecode
+
+
+# Limits on the size of folded constants, as in CPython's Python/ast_opt.c:
+# bits of an int, items of a tuple or frozenset, characters of a str or
+# bytes, and items of nested tuples and frozensets altogether.
+MAX_INT_SIZE = 128
+MAX_COLLECTION_SIZE = 256
+MAX_STR_SIZE = 4096
+MAX_TOTAL_ITEMS = 1024
+
+BINARY_OPERATORS = {
+    "BINARY_ADD": operator.add,
+    "BINARY_AND": operator.and_,
+    "BINARY_FLOOR_DIVIDE": operator.floordiv,
+    "BINARY_LSHIFT": operator.lshift,
+    "BINARY_MODULO": operator.mod,
+    "BINARY_MULTIPLY": operator.mul,
+    "BINARY_OR": operator.or_,
+    "BINARY_POWER": operator.pow,
+    "BINARY_RSHIFT": operator.rshift,
+    "BINARY_SUBSCR": operator.getitem,
+    "BINARY_SUBTRACT": operator.sub,
+    "BINARY_TRUE_DIVIDE": operator.truediv,
+    "BINARY_XOR": operator.xor,
+}
+
+# The operators of BINARY_OP, 3.11 and later, by operand. Matrix
+# multiplication and the in-place operators, which follow these, aren't
+# folded.
+BINARY_OP_OPERATORS = (
+    operator.add,
+    operator.and_,
+    operator.floordiv,
+    operator.lshift,
+    None,
+    operator.mul,
+    operator.mod,
+    operator.or_,
+    operator.pow,
+    operator.rshift,
+    operator.sub,
+    operator.truediv,
+    operator.xor,
+)
+
+UNARY_OPERATORS = {
+    "UNARY_INVERT": operator.invert,
+    "UNARY_NEGATIVE": operator.neg,
+    "UNARY_POSITIVE": operator.pos,
+}
+
+# Opcodes after which a list or set built from constants can be a
+# tuple or frozenset constant instead, since they only look inside it.
+CONTAINER_USER_NAMES = frozenset(("CONTAINS_OP", "GET_ITER"))
+
+
+def is_foldable(value, numbers_only: bool = False) -> bool:
+    """
+    Return True if `value` is a constant that constant_fold() can use.
+    Before Python 3, str means bytes, so only numbers and tuples are
+    used, with `numbers_only`.
+    """
+    if isinstance(value, (tuple, frozenset)):
+        return all(is_foldable(item, numbers_only) for item in value)
+    if isinstance(value, (int, float, complex)):
+        return True
+    if numbers_only:
+        return False
+    if isinstance(value, str):
+        # Not a placeholder for a code object.
+        return not value.startswith(CODE_CONST_PLACEHOLDER)
+    return isinstance(value, bytes) or value is None or value is Ellipsis
 
-    cells_free_len = len(code.co_freevars) + len(code.co_cellvars)
-    consts_len = len(code.co_consts)
-    names_len = len(code.co_names)
-    varnames_len = len(code.co_varnames)
 
-    for i, inst in enumerate(code.instructions):
-        if xdis.op_has_argument(inst.opcode, asm.opc):
-            if is_int(inst.arg):
-                if inst.opcode == asm.opc.EXTENDED_ARG:
-                    continue
-                operand = inst.arg
-                if inst.opcode in asm.opc.CONST_OPS:
-                    # FIXME: DRY operand check
-                    if operand >= consts_len:
-                        print(inst)
-                        warn(
-                            f"Constant operand index {operand} at offset {inst.offset} of {code.co_name} "
-                            f"is too large; it should be less than {consts_len}."
-                        )
-                        is_valid = False
-                elif inst.opcode in asm.opc.LOCAL_OPS:
-                    if operand >= varnames_len:
-                        print(inst)
-                        warn(
-                            f"Variable operand index {operand} at offset {inst.offset} of {code.co_name} "
-                            f"is too large; it should be less than {varnames_len}."
-                        )
-                        is_valid = False
-                elif inst.opcode in asm.opc.NAME_OPS:
-                    if operand >= names_len:
-                        print(inst)
-                        warn(
-                            f"Name operand index {operand} at offset {inst.offset} of {code.co_name} "
-                            f"is too large; it should be less than {names_len}."
-                        )
-                        is_valid = False
-                elif inst.opcode in asm.opc.FREE_OPS:
-                    # FIXME: is this right?
-                    if operand >= cells_free_len:
-                        print(inst)
-                        warn(
-                            f"Free operand index {operand} at offset {inst.offset} of {code.co_name} "
-                            f"is too large; it should be less than {cells_free_len}."
-                        )
-                        is_valid = False
+def total_items(value) -> int:
+    """
+    Return the number of items in `value` and any tuples or frozensets
+    nested in it.
+    """
+    if isinstance(value, (tuple, frozenset)):
+        return len(value) + sum(total_items(item) for item in value)
+    return 0
+
 
-    return is_valid
+def is_small_enough(function, left, right) -> bool:
+    """
+    Return True if `function`(`left`, `right`) gives a result small
+    enough to be a folded constant, as CPython decides that.
+    """
+    if function is operator.mul:
+        if isinstance(right, int) and not isinstance(left, int):
+            left, right = right, left
+        if isinstance(left, int) and isinstance(right, int):
+            return (
+                not left
+                or not right
+                or left.bit_length() + right.bit_length() <= MAX_INT_SIZE
+            )
+        elif isinstance(left, int) and isinstance(right, (tuple, frozenset)):
+            if right:
+                if left < 0 or left > MAX_COLLECTION_SIZE // len(right):
+                    return False
+                return not left or total_items(right) <= MAX_TOTAL_ITEMS // left
+        elif isinstance(left, int) and isinstance(right, (str, bytes)):
+            if right:
+                return 0 <= left <= MAX_STR_SIZE // len(right)
+    elif function is operator.pow:
+        if isinstance(left, int) and isinstance(right, int) and left and right > 0:
+            return left.bit_length() <= MAX_INT_SIZE // right
+    elif function is operator.lshift:
+        if isinstance(left, int) and isinstance(right, int) and left and right:
+            return (
+                right <= MAX_INT_SIZE
+                and left.bit_length() <= MAX_INT_SIZE - right
+            )
+    elif function is operator.mod:
+        # Leave string formatting for run time.
+        return not isinstance(left, (str, bytes))
+    return True
 
 
-def append_operand(
-    bytecode: list, arg_value, extended_arg_shift, arg_max_value, extended_arg_op
-) -> None:
+def fold_operation(function, operands: list):
     """
-    Write instruction operand adding EXTENDED_ARG instructions
-    when necessary.
+    Return `function` applied to `operands`, or None if that raises an
+    exception or a warning, or gives something too large.
     """
-    arg_shifts = []
-    shift_value = 1
+    if len(operands) == 2 and not is_small_enough(function, *operands):
+        return None
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        try:
+            return function(*operands)
+        except Exception:
+            return None
 
-    while arg_value > arg_max_value:
-        shift_value <<= extended_arg_shift
-        ext_arg_value, arg_value = divmod(arg_value, shift_value)
-        arg_shifts.append(ext_arg_value)
 
-    while arg_shifts:
-        bytecode.append(extended_arg_op)
-        ext_arg_value = arg_shifts.pop()
-        bytecode.append(ext_arg_value)
+def constant_fold(opcodes: list, args: list, targets: list, code, optable) -> int:
+    """
+    Fold operations on constants in the instructions given as in
+    layout_instructions(): arithmetic, subscripts, and building tuples,
+    and lists and sets that are only searched or iterated over, where
+    all the operands are loaded by LOAD_CONST just before. The operation
+    becomes a LOAD_CONST of its result, which is added to the constants
+    of portable code object `code` as update_code_field() does, and the
+    loads of its operands become NOPs.
+
+    Nothing is folded across a jump target. Returns the number of
+    operations folded.
+    """
+    opname = optable.opname
+    opmap = optable.opmap
+    nop = opmap.get("NOP")
+    load_const = opmap.get("LOAD_CONST")
+    if nop is None or load_const is None:
+        return 0
+    version_tuple = optable.version_tuple
+    numbers_only = version_tuple < (3, 0)
+    consts = code.co_consts
+    consts_index = field_index(code, "co_consts")
+    jumped_to = set(t for t in targets if t >= 0)
+    n = len(opcodes)
+
+    folded = 0
+    # (index, value) of the instructions loading constants, in order,
+    # with nothing but NOPs between them and the current instruction.
+    loads = []
+    for i in range(n):
+        if i in jumped_to:
+            loads = []
+        opcode = opcodes[i]
+        if opcode == nop:
+            continue
+        name = opname[opcode]
+        arg = args[i]
+        if opcode == load_const:
+            if 0 <= arg < len(consts) and is_foldable(consts[arg], numbers_only):
+                loads.append((i, consts[arg]))
+            else:
+                loads = []
+            continue
 
-    bytecode.append(arg_value)
+        next_name = opname[opcodes[i + 1]] if i + 1 < n else ""
+        if next_name == "COMPARE_OP" and version_tuple < (3, 9):
+            compare = args[i + 1]
+            next_is_user = 0 <= compare < len(cmp_op) and cmp_op[compare] in (
+                "in",
+                "not in",
+            )
+        else:
+            next_is_user = next_name in CONTAINER_USER_NAMES
+
+        function = None
+        if name in BINARY_OPERATORS:
+            count, function = 2, BINARY_OPERATORS[name]
+        elif name == "BINARY_OP" and arg < len(BINARY_OP_OPERATORS):
+            count, function = 2, BINARY_OP_OPERATORS[arg]
+        elif name in UNARY_OPERATORS:
+            count, function = 1, UNARY_OPERATORS[name]
+        elif name == "BUILD_TUPLE" or (name == "BUILD_LIST" and next_is_user):
+            count, function = arg, lambda *items: tuple(items)
+        elif name == "BUILD_SET" and next_is_user:
+            count, function = arg, lambda *items: frozenset(items)
+        if function is None or count > len(loads):
+            loads = []
+            continue
+        operands = loads[len(loads) - count :]
+        value = fold_operation(function, [value for _, value in operands])
+        if value is None or not is_foldable(value, numbers_only):
+            loads = []
+            continue
+
+        for j, _ in operands:
+            opcodes[j] = nop
+            args[j] = None
+        opcodes[i] = load_const
+        args[i] = consts_index.add(value)
+        del loads[len(loads) - count :]
+        loads.append((i, value))
+        folded += 1
+    return folded
 
 
 def create_code(asm: Assembler, label, backpatch) -> tuple:
     """
     Turn ``asm`` assembler text into a code object and
     return that.
-    """
-    # print('label: ', asm.label)
-    # print('backpatch: ', asm.backpatch_inst)
 
-    bytecode = []
-    # print(asm.code.instructions)
+    `label` maps label names to offsets, and the keys of the line-number
+    table of ``asm.code`` are offsets too. These offsets count the
+    instructions in ``asm.code.instructions``, including any
+    EXTENDED_ARG and CACHE instructions there, but not the EXTENDED_ARG
+    instructions that are needed for large operands or the inline CACHE
+    entries of 3.11 and later; those are worked out here by
+    layout_instructions().
+    """
+    return finish_code(asm, *resolve_code(asm, label, backpatch))
 
-    offset = 0
-    offset2label = {label[j]: j for j in label}
-    is_valid = True
 
-    for i, inst in enumerate(asm.code.instructions):
-        # Strip out extended arg instructions.
-        # Operands in the input can be arbitary numbers.
-        # In this loop we will figure out whether
-        # or not to add EXTENDED_ARG
-        if inst.opcode == asm.opc.EXTENDED_ARG:
+def resolve_code(asm: Assembler, label, backpatch) -> tuple:
+    """
+    The first half of create_code(): resolve the labels, operands, line
+    numbers and exception table of the method in ``asm``, filling in the
+    tables of ``asm.code`` as operands are looked up.
+
+    Returns the instructions, without EXTENDED_ARG and CACHE
+    instructions, and as for layout_instructions() their opcodes,
+    operands and jump targets; the line numbers by the index of the
+    instruction they start at; and the exception-table entries, or None.
+    What is returned depends only on the listing and not on the assembly
+    options, so it can be saved and finished later; see xasm.ir.
+    """
+    optable = asm.optable
+    has_arg = optable.has_arg
+    size = optable.size
+    operand_kind = optable.operand_kind
+    code = asm.code
+    linetable_field = (
+        "co_lnotab" if optable.version_tuple < (3, 10) else "co_linetable"
+    )
+    line_table = getattr(code, linetable_field)
+
+    # Drop EXTENDED_ARG and CACHE instructions, noting the index of the
+    # instruction at each offset.
+    #
+    # Jump operands given as numbers count bytecode offsets, which
+    # include inline CACHE entries whether or not the listing has CACHE
+    # lines for them; `code_offset` follows those.
+    cache_op = optable.CACHE
+    cache_size = optable.cache_size
+    has_cache_lines = cache_op is not None and any(
+        inst.opcode == cache_op for inst in code.instructions
+    )
+    instructions = []
+    index_at_offset = {}
+    index_at_code_offset = {}
+    # The bytecode offset just after each instruction and its caches.
+    end_offsets = []
+    offset = code_offset = 0
+    for i, inst in enumerate(code.instructions):
+        index_at_offset.setdefault(offset, len(instructions))
+        index_at_code_offset.setdefault(code_offset, len(instructions))
+        offset += size[inst.opcode]
+        code_offset += size[inst.opcode]
+        if inst.opcode == optable.EXTENDED_ARG:
             print(
                 f"Line {i}: superflous EXTENDED_ARG instruction removed;"
                 " this code decides when they are needed."
             )
             continue
-
-        bytecode.append(inst.opcode)
-        if offset in offset2label:
-            if is_int(offset2label[offset]):
-                inst.line_no = int(offset2label[offset])
-                if (
-                    inst.line_no in asm.code.co_lnotab.values()
-                    and asm.python_version < (3, 10)
-                ):
-                    print(
-                        f"Line {i}: this is not the first we encounter source-code line {inst.line_no}."
-                    )
-                asm.code.co_lnotab[offset] = inst.line_no
-
-        inst.offset = offset
-        offset += xdis.op_size(inst.opcode, asm.opc)
-
-        if xdis.op_has_argument(inst.opcode, asm.opc):
-            if inst in backpatch:
-                target = inst.arg
-                match = re.match(r"^(L\d+)(?: \(to \d+\))?$", target)
-                if match:
-                    target = match.group(1)
-                try:
-                    if inst.opcode in asm.opc.JREL_OPS:
-                        inst.arg = label[target] - offset
-                    else:
-                        inst.arg = label[target]
-                    if asm.opc.version_tuple >= (3, 10):
-                        inst.arg >>= 1
-                    pass
-                except KeyError:
-                    err(f"Label {target} not found.\nI know about {backpatch}", inst, i)
-                    is_valid = False
-            elif is_int(inst.arg):
-                pass
-            elif inst.arg.startswith("(") and inst.arg.endswith(")"):
-                operand = inst.arg[1:-1]
-                if inst.opcode in asm.opc.COMPARE_OPS:
-                    if operand in cmp_op:
-                        inst.arg = cmp_op.index(operand)
-                    else:
-                        err(f"Can't handle compare operand {inst.arg}", inst, i)
-                        is_valid = False
-                        break
-
-                    pass
-                elif inst.opcode in asm.opc.CONST_OPS:
-                    if not (operand.startswith("<Code") or operand.startswith("<code")):
-                        operand = ast.literal_eval(operand)
-                    update_code_field("co_consts", operand, inst, asm.code)
-                elif inst.opcode in asm.opc.LOCAL_OPS:
-                    update_code_field("co_varnames", operand, inst, asm.code)
-                elif inst.opcode in asm.opc.NAME_OPS:
-                    update_code_field("co_names", operand, inst, asm.code)
-                elif inst.opcode in asm.opc.FREE_OPS:
-                    if operand in asm.code.co_cellvars:
-                        inst.arg = asm.code.co_cellvars.index(operand)
-                    else:
-                        update_code_field("co_freevars", operand, inst, asm.code)
+        if inst.opcode == cache_op:
+            # Added back where needed by layout_instructions().
+            continue
+        instructions.append(inst)
+        end_offsets.append(code_offset + cache_size[inst.opcode])
+        if not has_cache_lines:
+            code_offset += cache_size[inst.opcode]
+    index_at_offset.setdefault(offset, len(instructions))
+    index_at_code_offset.setdefault(code_offset, len(instructions))
+
+    # Turn label names into instruction indices.
+    label_index = {}
+    seen_lines = set(line_table.values())
+    for name, label_offset in label.items():
+        index = index_at_offset.get(label_offset)
+        if index is None:
+            raise RuntimeError(
+                f"Label {name} at offset {label_offset} is inside an instruction"
+            )
+        if is_int(name):
+            # A number used as a label is a line number.
+            line_no = int(name)
+            if index < len(instructions):
+                instructions[index].line_no = line_no
+            if line_no in seen_lines and optable.version_tuple < (3, 10):
+                print(
+                    f"Line {index}: this is not the first we encounter source-code line {line_no}."
+                )
+            seen_lines.add(line_no)
+            line_table[label_offset] = line_no
+        else:
+            label_index[name] = index
+
+    n = len(instructions)
+    opcodes = [inst.opcode for inst in instructions]
+    args = [None] * n
+    targets = [-1] * n
+    for i, inst in enumerate(instructions):
+        if not has_arg[inst.opcode]:
+            continue
+        if inst in backpatch:
+            target = label_index.get(inst.arg)
+            if target is None:
+                err(f"Label {inst.arg} not found.\nI know about {sorted(label)}", inst, i)
+            targets[i] = target
+            continue
+        elif is_int(inst.arg):
+            if optable.is_jump[inst.opcode]:
+                # A jump operand given as a number rather than a label.
+                # If it reaches the start of an instruction, jump to that
+                # instruction wherever it ends up.
+                jump = int(inst.arg) * optable.jump_unit
+                if not optable.is_jrel[inst.opcode]:
+                    target_offset = jump
+                elif "BACKWARD" in inst.opname:
+                    target_offset = end_offsets[i] - jump
+                else:
+                    target_offset = end_offsets[i] + jump
+                target = index_at_code_offset.get(target_offset)
+                if target is not None:
+                    targets[i] = target
+                    continue
+        elif inst.arg.startswith("(") and inst.arg.endswith(")"):
+            operand = inst.arg[1:-1]
+            kind = operand_kind[inst.opcode]
+            if kind == OPERAND_COMPARE:
+                if operand in cmp_op:
+                    inst.arg = cmp_op.index(operand)
                 else:
-                    # from trepan.api import debug; debug()
-                    err(f"Can't handle operand {inst.arg}", inst, i)
-                    is_valid = False
-                    break
+                    err(f"Can't handle compare operand {inst.arg}", inst, i)
+            elif kind == OPERAND_CONST:
+                if not (operand.startswith("<Code") or operand.startswith("<code")):
+                    operand = ast.literal_eval(operand)
+                update_code_field("co_consts", operand, inst, code)
+            elif kind == OPERAND_LOCAL:
+                update_code_field("co_varnames", operand, inst, code)
+            elif kind == OPERAND_NAME:
+                update_code_field("co_names", operand, inst, code)
+            elif kind == OPERAND_FREE:
+                cell_index = field_index(code, "co_cellvars").find(operand)
+                if cell_index >= 0:
+                    inst.arg = cell_index
+                else:
+                    update_code_field("co_freevars", operand, inst, code)
             else:
-                # from trepan.api import debug; debug()
-                err(
-                    f"Don't understand operand {inst.arg} expecting int or (..)",
-                    inst,
-                    i,
-                )
-
-            append_operand(
-                bytecode,
-                inst.arg,
-                asm.opc.EXTENDED_ARG_SHIFT,
-                asm.opc.ARG_MAX_VALUE,
-                asm.opc.EXTENDED_ARG,
+                err(f"Can't handle operand {inst.arg}", inst, i)
+        else:
+            err(
+                f"Don't understand operand {inst.arg} expecting int or (..)",
+                inst,
+                i,
             )
+        args[i] = int(inst.arg)
+
+    # Line numbers by the index of the instruction they start at.
+    index_lines = {}
+    if isinstance(line_table, dict):
+        for line_offset, line_no in line_table.items():
+            index = index_at_offset.get(line_offset)
+            if index is None:
+                warn(f"Line number {line_no} at offset {line_offset} is inside an instruction")
+                continue
+            index_lines[index] = line_no
+
+    # Exception-table entries as [start, end, target, depth, lasti], with
+    # the first three instruction indices and `end` just after the last
+    # instruction covered. Labels give those directly. Offsets are
+    # bytecode offsets, as dis shows them, where `end` is that of the
+    # last code unit covered.
+    exception_entries = None
+    if code.exception_table is not None:
+        if optable.version_tuple < (3, 11):
+            warn(
+                f"{code.co_name}: exception tables are used only from "
+                "Python 3.11 on; the one given is ignored."
+            )
+        else:
+            exception_entries = []
+            for k, entry in enumerate(code.exception_table):
+                indices = []
+                for field, unit in zip(entry[:3], (0, 2, 0)):
+                    if is_int(field):
+                        index = index_at_code_offset.get(int(field) + unit)
+                    else:
+                        index = label_index.get(field)
+                    if index is None:
+                        raise RuntimeError(
+                            f"{code.co_name}: exception table entry {k}: "
+                            f"{field} is not a label or the offset of an instruction"
+                        )
+                    indices.append(index)
+                exception_entries.append(indices + list(entry[3:]))
+    return instructions, opcodes, args, targets, index_lines, exception_entries
+
+
+def finish_code(
+    asm: Assembler,
+    instructions: list,
+    opcodes: list,
+    args: list,
+    targets: list,
+    index_lines: dict,
+    exception_entries: Optional[list],
+) -> tuple:
+    """
+    The second half of create_code(): lay out the instructions given as
+    resolve_code() returns them, after folding constants and optimizing
+    if asked to, and build the code object for the method in ``asm``.
+    """
+    optable = asm.optable
+    operand_kind = optable.operand_kind
+    code = asm.code
+    linetable_field = (
+        "co_lnotab" if optable.version_tuple < (3, 10) else "co_linetable"
+    )
+    line_table = getattr(code, linetable_field)
+    n = len(instructions)
+    is_valid = True
 
-        elif asm.opc.version_tuple >= (3, 6):
-            # instructions with no operand, or one-byte instructions, are padded
-            # to two bytes in 3.6 and later.
-            bytecode.append(0)
-
-    if not is_valid:
-        return None, False
+    handlers = None
+    if exception_entries is not None:
+        handlers = [entry[2] for entry in exception_entries]
+
+    new_index = None
+    if asm.fold_constants:
+        folded = constant_fold(opcodes, args, targets, code, optable)
+        if folded:
+            print(f"{code.co_name}: {folded} constant operation(s) folded")
+            if not asm.optimize:
+                new_index = compact(opcodes, args, targets, index_lines, optable)[0]
+    if asm.optimize:
+        new_index, stats = optimize(
+            opcodes, args, targets, index_lines, optable, handlers
+        )
+        if stats:
+            print(f"{code.co_name}: {stats.report()}")
+    if new_index is not None:
+        if exception_entries is not None:
+            # Move the entries with their instructions, dropping those
+            # whose instructions are all gone.
+            for entry in exception_entries:
+                entry[:3] = [new_index[i] for i in entry[:3]]
+            exception_entries = [
+                entry for entry in exception_entries if entry[0] < entry[1]
+            ]
+        instructions = [
+            instructions[i] for i in range(n) if new_index[i] != new_index[i + 1]
+        ]
+        for inst, opcode, arg, target in zip(instructions, opcodes, args, targets):
+            if inst.opcode != opcode:
+                inst.opcode = opcode
+                inst.opname = optable.opname[opcode]
+            if target < 0:
+                inst.arg = arg
+
+    offsets = layout_instructions(opcodes, args, targets, optable)
+    if asm.compute_stacksize:
+        # A handler starts with the exception pushed, and with lasti the
+        # offset of the instruction that raised below it.
+        stacksize, problems = max_stack_depth(
+            opcodes,
+            args,
+            targets,
+            optable,
+            [
+                (target, depth + lasti + 1)
+                for _, _, target, depth, lasti in exception_entries or ()
+            ],
+        )
+        for problem in problems:
+            warn(f"{code.co_name}: {problem}")
+        # A stack size of None means none was given.
+        if code.co_stacksize is not None and stacksize != code.co_stacksize:
+            warn(
+                f"{code.co_name}: stack size given is {code.co_stacksize}, "
+                f"but the computed size is {stacksize}; using {stacksize}."
+            )
+        code.co_stacksize = stacksize
+    elif code.co_stacksize is None:
+        code.co_stacksize = DEFAULT_STACKSIZE
+    # Unless the listing is trusted, operands are checked as the
+    # instructions are placed, and the problems found are reported
+    # together afterwards, making the method invalid.
+    problems = []
+    check = not asm.trusted
+    if check:
+        limits, index_fields = operand_limits(code, optable)
+    for i, inst in enumerate(instructions):
+        inst.offset = offsets[i]
+        if targets[i] >= 0:
+            if args[i] < 0:
+                err(f"Can't jump backwards to label {inst.arg}", inst, i)
+            inst.arg = args[i]
+        elif check:
+            limit = limits.get(operand_kind[opcodes[i]])
+            if limit is not None:
+                for shift, mask in index_fields.get(opcodes[i], ((0, -1),)):
+                    operand = args[i] >> shift & mask
+                    if operand >= limit[0]:
+                        problems.append(
+                            f"{inst.opname} operand at offset {offsets[i]}: "
+                            f"{limit[1]} index {operand} is too large; "
+                            f"it should be less than {limit[0]}"
+                        )
 
-    if asm.opc.version_tuple >= (3, 0):
-        co_code = bytearray()
-        for j in bytecode:
-            co_code.append(j % 255)
-        asm.code.co_code = bytes(co_code)
+    bytecode = emit_instructions(opcodes, args, offsets, optable)
+    if optable.version_tuple >= (3, 0):
+        # Code objects, and xdis.marsh, need an immutable bytes object.
+        code.co_code = bytes(bytecode)
     else:
-        asm.code.co_code = "".join([chr(j) for j in bytecode])
-
-    # FIXME: get
-    is_code_ok(asm)
+        # xdis.marsh writes Python 2 code strings as str.
+        code.co_code = bytecode.decode("latin-1")
+
+    # Move line numbers to where their instructions ended up, and
+    # encode them.
+    if isinstance(line_table, dict):
+        line_starts = {offsets[index]: line_no for index, line_no in index_lines.items()}
+        line_table = encode_line_table(
+            line_starts, code.co_firstlineno, len(bytecode), optable.version_tuple
+        )
+        if optable.version_tuple < (3, 0):
+            line_table = line_table.decode("latin-1")
+        setattr(code, linetable_field, line_table)
+
+    if exception_entries is not None:
+        code.exception_entries = [
+            (offsets[start], offsets[end], offsets[target], depth, lasti)
+            for start, end, target, depth, lasti in exception_entries
+        ]
+        code.co_exceptiontable = encode_exception_table(code.exception_entries)
+
+    if check:
+        if not opcodes:
+            problems.append("there are no instructions")
+        elif optable.opname[opcodes[-1]] not in TERMINATOR_NAMES:
+            problems.append(
+                f"last instruction, at offset {offsets[-2]}, is "
+                f"{optable.opname[opcodes[-1]]}; execution would run off the end"
+            )
+        for start, end, target, depth, lasti in exception_entries or ():
+            if depth + lasti + 1 > code.co_stacksize:
+                problems.append(
+                    f"exception handler at offset {offsets[target]} starts "
+                    f"with stack depth {depth + lasti + 1}, more than the "
+                    f"stack size {code.co_stacksize}"
+                )
+        for problem in problems:
+            warn(f"{code.co_name}: {problem}")
+        if problems:
+            is_valid = False
 
     # Stamp might be added here
     if asm.python_version[:2] == PYTHON_VERSION_TRIPLE[:2]:
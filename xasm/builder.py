@@ -0,0 +1,224 @@
+"""
+Building code objects from Python, without going through assembly text.
+
+A CodeBuilder gathers the instructions and tables of one method as the
+parser would from a listing, and hands them to the same back end,
+create_code(), so everything available when assembling a listing --
+labels, line numbers, exception tables, stack-size computation,
+constant folding and the peephole optimizer -- works the same way:
+
+    from xasm.builder import CodeBuilder
+    from xasm.write_pyc import write_pycfile
+
+    module = CodeBuilder("3.8")
+    module.line(1)
+    module.emit("LOAD_NAME", module.name("x"))
+    module.emit("POP_JUMP_IF_FALSE", "done")
+    module.emit("LOAD_NAME", module.name("print"))
+    module.emit("LOAD_CONST", module.const("x is set"))
+    module.emit("CALL_FUNCTION", 1)
+    module.emit("POP_TOP")
+    module.label("done")
+    module.emit("LOAD_CONST", module.const(None))
+    module.emit("RETURN_VALUE")
+    co = module.build()
+
+    with open("x.pyc", "wb") as fp:
+        write_pycfile(fp, [co], None, module.python_version, module.is_pypy)
+
+Nested code objects, such as functions, come from builders made with
+nested(), whose code object is then added to the constants of the
+enclosing method with const().
+"""
+
+from typing import Optional, Union
+
+from xdis.version_info import version_str_to_tuple
+
+from xasm.assemble import Assembler, Instruction, create_code, field_index, is_int
+
+
+class CodeBuilder:
+    """
+    Builds one code object for Python `version`, given as a string like
+    "3.8" or a tuple like (3, 8).
+
+    The other arguments give the fields of the code object, and the
+    assembly options of asm_stream(). Unless `stacksize` is given, the
+    stack size is computed from the instructions.
+    """
+
+    def __init__(
+        self,
+        version: Union[str, tuple],
+        name: str = "<module>",
+        filename: str = "unknown",
+        first_line: int = 1,
+        flags: int = 0,
+        argcount: int = 0,
+        posonlyargcount: int = 0,
+        kwonlyargcount: int = 0,
+        stacksize: Optional[int] = None,
+        is_pypy: bool = False,
+        optimize: bool = False,
+        fold_constants: bool = False,
+        trusted: bool = False,
+    ) -> None:
+        if isinstance(version, str):
+            version = version_str_to_tuple(version, length=2)
+        version = tuple(version[:2])
+        self.asm = asm = Assembler(version, is_pypy)
+        asm.code_init(version)
+        asm.optimize = optimize
+        asm.fold_constants = fold_constants
+        asm.trusted = trusted
+        code = self.code = asm.code
+        code.co_qual_name = code.co_name = name
+        code.co_filename = filename
+        code.co_firstlineno = first_line
+        code.co_flags = flags
+        code.co_argcount = argcount
+        code.co_posonlyargcount = posonlyargcount
+        code.co_kwonlyargcount = kwonlyargcount
+        if stacksize is None:
+            asm.compute_stacksize = True
+        else:
+            code.co_stacksize = stacksize
+        self.optable = asm.optable
+        self.line_table = getattr(
+            code, "co_lnotab" if version < (3, 10) else "co_linetable"
+        )
+        # As for AsmParser: label names to offsets, counting the sizes
+        # of the instructions emitted, and the instructions whose
+        # operand is a label.
+        self.labels = {}
+        self.backpatch = set()
+        self.offset = 0
+        self.line_no = None
+
+    @property
+    def python_version(self) -> tuple:
+        return self.asm.python_version
+
+    @property
+    def is_pypy(self) -> bool:
+        return self.asm.is_pypy
+
+    def nested(self, name: str, **kwargs) -> "CodeBuilder":
+        """
+        Return a builder for a code object, such as a function, to be
+        added to the constants of this one, with the same version, file
+        name and options unless given in `kwargs`.
+        """
+        asm = self.asm
+        for key, value in (
+            ("filename", self.code.co_filename),
+            ("is_pypy", asm.is_pypy),
+            ("optimize", asm.optimize),
+            ("fold_constants", asm.fold_constants),
+            ("trusted", asm.trusted),
+        ):
+            kwargs.setdefault(key, value)
+        return CodeBuilder(asm.python_version, name, **kwargs)
+
+    def label(self, name: str) -> str:
+        """
+        Put label `name` at the next instruction, and return it. Labels
+        can be used as jump operands before they are put.
+        """
+        if is_int(name):
+            raise ValueError(f"Label {name} can't be a number")
+        self.labels[name] = self.offset
+        return name
+
+    def line(self, line_no: int) -> None:
+        """
+        Start source line `line_no` at the next instruction.
+        """
+        self.line_table[self.offset] = line_no
+        self.line_no = line_no
+
+    def emit(self, opname: str, arg: Union[int, str, None] = None) -> None:
+        """
+        Add an `opname` instruction. `arg` is its operand: a number, or
+        for a jump the name of a label.
+        """
+        optable = self.optable
+        opcode = optable.opmap.get(opname)
+        if opcode is None:
+            raise ValueError(f"Illegal opname {opname}")
+        inst = Instruction(opname, opcode, arg, self.line_no)
+        self.line_no = None
+        if optable.has_arg[opcode]:
+            if arg is None:
+                raise ValueError(f"{opname} needs an operand")
+            if isinstance(arg, str):
+                if not optable.is_jump[opcode]:
+                    raise ValueError(f"{opname} operand {arg} must be a number")
+                self.backpatch.add(inst)
+        elif arg is not None:
+            raise ValueError(f"{opname} doesn't take an operand")
+        self.code.instructions.append(inst)
+        self.offset += optable.size[opcode]
+
+    def const(self, value) -> int:
+        """
+        Return the index of `value` in co_consts, adding it if needed.
+        """
+        return field_index(self.code, "co_consts").add(value)
+
+    def name(self, name: str) -> int:
+        """
+        Return the index of `name` in co_names, adding it if needed.
+        """
+        return field_index(self.code, "co_names").add(name)
+
+    def varname(self, name: str) -> int:
+        """
+        Return the index of local variable `name` in co_varnames, adding
+        it if needed. Arguments are the first `argcount` local variables
+        and so must be added first.
+        """
+        return field_index(self.code, "co_varnames").add(name)
+
+    def cellvar(self, name: str) -> int:
+        """
+        Return the index of cell variable `name` in co_cellvars, adding
+        it if needed.
+        """
+        return field_index(self.code, "co_cellvars").add(name)
+
+    def freevar(self, name: str) -> int:
+        """
+        Return the index of free variable `name` in co_freevars, adding
+        it if needed. In operands, free variables are numbered after the
+        cell variables, and from 3.11 on after the local variables too.
+        """
+        return field_index(self.code, "co_freevars").add(name)
+
+    def exception_entry(
+        self, start: str, end: str, target: str, depth: int, lasti: bool = False
+    ) -> None:
+        """
+        Add an entry to the exception table, from Python 3.11 on: the
+        instructions from label `start` up to label `end` are handled at
+        label `target`, which starts with stack depth `depth`, and with
+        `lasti` the offset of the instruction that raised pushed too.
+        """
+        if self.code.exception_table is None:
+            self.code.exception_table = []
+        self.code.exception_table.append((start, end, target, depth, lasti))
+
+    def build(self):
+        """
+        Return the code object, native if the version is that of the
+        running Python. Problems found in the code are printed, and
+        unless the builder is trusted, raise ValueError.
+        """
+        code = self.code
+        code.co_nlocals = len(code.co_varnames)
+        co, is_valid = create_code(self.asm, self.labels, self.backpatch)
+        if not is_valid:
+            raise ValueError(f"{code.co_name} has problems; see the warnings above")
+        self.asm.update_lists(co, self.labels, self.backpatch)
+        return co
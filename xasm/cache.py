@@ -0,0 +1,172 @@
+"""
+An on-disk cache of assembled bytecode, keyed by the content of the
+assembly text.
+
+The key of an entry is a hash of the assembly text, which includes the
+"# Python bytecode" line giving the target version, together with the
+versions of xasm and xdis. The entry holds the marshalled code objects,
+so that on a hit neither parsing, create_code() nor marshalling
+are needed. Entries are evicted least-recently-used first once the
+cache grows past its size limit.
+"""
+
+import hashlib
+import marshal
+import os
+import os.path as osp
+from typing import Optional
+
+import xdis
+
+from xasm.version import __version__
+from xasm.write_pyc import marshal_code
+
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+# Bump this when the layout of a cache entry changes.
+CACHE_FORMAT = 1
+
+# Entries are written to a file named with this and the process id,
+# which then replaces the entry.
+TMP_INFIX = ".tmp"
+
+
+class AssemblyCache:
+    """
+    A directory of assembled bytecode. `hits`, `misses` and `evictions`
+    count what happened since the cache was opened.
+    """
+
+    def __init__(self, directory: str, max_size: int = DEFAULT_MAX_SIZE) -> None:
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # The size of the entries in the directory, as far as this
+        # process knows; None until the directory is first scanned.
+        self.size = None
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, fp, options: tuple = ()) -> str:
+        """
+        Return the cache key for the assembly text read from binary
+        file `fp`, assembled with `options`, see
+        xasm.assemble.output_options().
+        """
+        hasher = hashlib.blake2b(digest_size=20)
+        hasher.update(f"xasm {__version__} xdis {xdis.__version__}\n".encode())
+        if options:
+            hasher.update(f"{options!r}\n".encode())
+        for chunk in iter(lambda: fp.read(1 << 16), b""):
+            hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def entry_path(self, key: str) -> str:
+        return osp.join(self.directory, key[:2], key[2:])
+
+    def get(self, key: str) -> Optional[tuple]:
+        """
+        Return (python_version, is_pypy, timestamp, marshalled code) saved
+        under `key`, or None.
+        """
+        path = self.entry_path(key)
+        try:
+            with open(path, "rb") as fp:
+                entry = marshal.load(fp)
+            # The modification time orders entries for eviction.
+            os.utime(path)
+        except (OSError, EOFError, ValueError, TypeError):
+            entry = None
+        if not isinstance(entry, tuple) or len(entry) != 5 or entry[0] != CACHE_FORMAT:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1:]
+
+    def put(self, key: str, asm) -> None:
+        """
+        Save the code objects of Assembler `asm` under `key`. Nothing is
+        saved if they can't be marshalled.
+        """
+        try:
+            chunks = []
+            for co in asm.code_list:
+                chunks.append(marshal_code(co, asm.python_version, asm.is_pypy))
+        except Exception:
+            return
+        entry = (
+            CACHE_FORMAT,
+            tuple(asm.python_version),
+            bool(asm.is_pypy),
+            asm.timestamp,
+            b"".join(chunks),
+        )
+        path = self.entry_path(key)
+        os.makedirs(osp.dirname(path), exist_ok=True)
+        tmp_path = f"{path}{TMP_INFIX}{os.getpid()}"
+        with open(tmp_path, "wb") as fp:
+            marshal.dump(entry, fp)
+            size = fp.tell()
+        if self.size is None:
+            self.scan()
+        try:
+            # An entry written again replaces the old one.
+            self.size -= os.stat(path).st_size
+        except OSError:
+            pass
+        os.replace(tmp_path, path)
+        self.size += size
+        if self.size > self.max_size:
+            self.evict()
+
+    def scan(self) -> list:
+        """
+        Return (modification time, size, path) for each entry in the
+        directory, and set `size` to their total. Files being written
+        by other processes, whose names end in ".tmp" and a process id,
+        are left out.
+        """
+        entries = []
+        total = 0
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if TMP_INFIX in filename:
+                    continue
+                path = osp.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        self.size = total
+        return entries
+
+    def evict(self) -> None:
+        """
+        Remove the least recently used entries until the cache is no
+        larger than `max_size`. The directory is scanned again, as
+        other processes may have added or removed entries.
+        """
+        entries = self.scan()
+        total = self.size
+        if total <= self.max_size:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.evictions += 1
+            total -= size
+            if total <= self.max_size:
+                break
+        self.size = total
+
+    def report(self) -> str:
+        return (
+            f"Assembly cache {self.directory}: {self.hits} hit(s), "
+            f"{self.misses} miss(es), {self.evictions} eviction(s)."
+        )
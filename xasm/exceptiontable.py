@@ -0,0 +1,58 @@
+"""
+Encoder for the exception tables of code objects, from Python 3.11 on.
+
+From 3.11, try blocks are no longer set up by instructions such as
+SETUP_FINALLY. Instead co_exceptiontable lists the ranges of bytecode
+covered by each handler, so that nothing is executed on entering a try
+block. Each entry gives, in 2-byte code units:
+
+* the start of the range covered,
+* its length,
+* the offset of the handler,
+* the stack depth the handler starts with, shifted left by one, and in
+  the low bit whether the offset of the instruction that raised is
+  pushed as well ("lasti").
+
+Each number is a varint of 6-bit chunks, most significant first, with
+bit 6 set on all but the last chunk. Bit 7 is set on the first byte of
+each entry. See Objects/exception_handling_notes.txt in the CPython
+sources.
+"""
+
+from typing import Iterable, Tuple
+
+# Bits of an exception-table byte.
+CONTINUATION_BIT = 0x40
+ENTRY_START_BIT = 0x80
+
+
+def append_varint(table: bytearray, value: int, first_bits: int = 0) -> None:
+    """
+    Append `value` to `table` in 6-bit chunks, most significant first.
+    `first_bits` is or-ed into the first byte.
+    """
+    shift = 6
+    while value >> shift:
+        shift += 6
+    while shift > 6:
+        shift -= 6
+        table.append(((value >> shift) & 0x3F) | CONTINUATION_BIT | first_bits)
+        first_bits = 0
+    table.append((value & 0x3F) | first_bits)
+
+
+def encode_exception_table(
+    entries: Iterable[Tuple[int, int, int, int, bool]]
+) -> bytes:
+    """
+    Encode `entries`, each (start, end, target, depth, lasti) with the
+    offsets in bytes and `end` just after the last instruction covered,
+    as a co_exceptiontable.
+    """
+    table = bytearray()
+    for start, end, target, depth, lasti in entries:
+        append_varint(table, start // 2, ENTRY_START_BIT)
+        append_varint(table, (end - start) // 2)
+        append_varint(table, target // 2)
+        append_varint(table, (depth << 1) | int(bool(lasti)))
+    return bytes(table)
@@ -0,0 +1,144 @@
+"""
+Reuse of code objects from a previous assembly of the same file.
+
+Each method in an assembly file gets a fingerprint computed from its
+text, the target bytecode version, and the fingerprints of any code
+objects it refers to in its "# Constants:" table. A MethodCache maps
+fingerprints to the marshalled code objects built for them, and is
+saved in a sidecar file next to the output .pyc so that the next run
+only has to assemble the methods that changed.
+"""
+
+import hashlib
+import marshal
+import os
+from types import CodeType
+from typing import Dict, Optional
+
+import xdis
+from xdis.magics import magic2int, magics
+from xdis.marsh import dumps
+from xdis.unmarshal import load_code
+from xdis.version_info import PYTHON_VERSION_TRIPLE, version_tuple_to_str
+
+from xasm.version import __version__
+
+SIDECAR_SUFFIX = ".xasm-methods"
+
+# Bump this when the layout of the sidecar file changes.
+SIDECAR_FORMAT = 1
+
+
+def sidecar_path(pyc_path: str) -> str:
+    """
+    Return the path of the fingerprint file kept next to `pyc_path`.
+    """
+    return pyc_path + SIDECAR_SUFFIX
+
+
+def method_hasher(python_version, is_pypy: bool, options: tuple = ()):
+    """
+    Return a hash object to which the text of a method is fed to
+    get its fingerprint. The versions of xasm and xdis are mixed in
+    so that a change to either one invalidates what was saved before,
+    as are assembly `options`, see xasm.assemble.output_options().
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    key = (__version__, xdis.__version__, tuple(python_version), bool(is_pypy))
+    if options:
+        key += (options,)
+    hasher.update(repr(key).encode())
+    return hasher
+
+
+class MethodCache:
+    """
+    Code objects from a previous assembly, keyed by method fingerprint.
+
+    Only entries looked up or added in the current assembly are written
+    back by save(), so methods that were deleted from the file don't
+    accumulate in the sidecar.
+    """
+
+    def __init__(self, entries: Optional[Dict[str, bytes]] = None) -> None:
+        self.entries = entries if entries is not None else {}
+        self.used: Dict[str, bytes] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def load(cls, path: str) -> "MethodCache":
+        """
+        Read a sidecar file. A missing, unreadable or out-of-date file
+        gives an empty cache.
+        """
+        try:
+            with open(path, "rb") as fp:
+                data = marshal.load(fp)
+        except (OSError, EOFError, ValueError, TypeError):
+            return cls()
+        if (
+            not isinstance(data, dict)
+            or data.get("format") != SIDECAR_FORMAT
+            or data.get("versions") != (__version__, xdis.__version__)
+        ):
+            return cls()
+        return cls(data.get("methods", {}))
+
+    def save(self, path: str) -> None:
+        data = {
+            "format": SIDECAR_FORMAT,
+            "versions": (__version__, xdis.__version__),
+            "methods": self.used,
+        }
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        with open(tmp_path, "wb") as fp:
+            marshal.dump(data, fp)
+        os.replace(tmp_path, path)
+
+    def get(self, fingerprint: str, python_version, is_pypy: bool):
+        """
+        Return the code object saved under `fingerprint`, or None.
+        """
+        data = self.entries.get(fingerprint)
+        co = None
+        if data is not None:
+            try:
+                if is_native(python_version):
+                    co = marshal.loads(data)
+                else:
+                    version = version_tuple_to_str(python_version)
+                    magic_int = magic2int(magics[version])
+                    co = load_code(data, magic_int)
+            except Exception:
+                co = None
+        if co is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.used[fingerprint] = data
+        return co
+
+    def put(self, fingerprint: str, co, python_version, is_pypy: bool) -> None:
+        """
+        Save code object `co` under `fingerprint`. Code objects that
+        can't be marshalled are just not saved.
+        """
+        try:
+            if isinstance(co, CodeType):
+                data = marshal.dumps(co)
+            else:
+                data = dumps(co, python_version=python_version, is_pypy=is_pypy)
+        except Exception:
+            return
+        if isinstance(data, str):
+            data = data.encode("latin-1")
+        self.entries[fingerprint] = self.used[fingerprint] = data
+
+
+def is_native(python_version) -> bool:
+    """
+    True if code for `python_version` is built as a native code object,
+    see create_code().
+    """
+    return tuple(python_version[:2]) == PYTHON_VERSION_TRIPLE[:2]
@@ -0,0 +1,212 @@
+"""
+A binary intermediate form of parsed assembly listings, for assembling
+the same listing again, for example with different options, without
+tokenizing its text and evaluating its constants each time.
+
+An IR file holds, for each method, the fields of its code object, its
+tables of constants, names and variables, and its instructions as
+resolve_code() returns them: opcode and operand arrays, the instruction
+each jump goes to, line numbers and exception-table entries by
+instruction index. Loading it runs just finish_code() on each method,
+so the assembly options, like optimize, still apply.
+
+The file is IR_MAGIC followed by a marshalled tuple starting with the
+IR format and the versions of xasm and xdis. A file written by another
+version is out of date: if the listing it was made from is still
+there, that is assembled instead; otherwise it is an error.
+"""
+
+import marshal
+import os
+import os.path as osp
+from typing import Optional
+
+import xdis
+
+from xasm.assemble import (
+    AsmParser,
+    Assembler,
+    Instruction,
+    asm_file,
+    finish_code,
+    link_code_consts,
+    resolve_code,
+)
+from xasm.version import __version__
+
+IR_MAGIC = b"xasm-ir\n"
+IR_SUFFIX = ".xasmir"
+
+# Bump this when the layout of an IR file changes.
+IR_FORMAT = 1
+
+# The fields of a method's code object saved, in order, other than
+# those filled in from its instructions.
+CODE_FIELDS = (
+    "co_name",
+    "co_filename",
+    "co_firstlineno",
+    "co_argcount",
+    "co_posonlyargcount",
+    "co_kwonlyargcount",
+    "co_nlocals",
+    "co_stacksize",
+    "co_flags",
+)
+TABLE_FIELDS = ("co_consts", "co_names", "co_varnames", "co_cellvars", "co_freevars")
+
+
+def ir_path(path: str) -> str:
+    """
+    Return the path of the IR file for assembly or bytecode file `path`.
+    """
+    return osp.splitext(path)[0] + IR_SUFFIX
+
+
+class IRParser(AsmParser):
+    """
+    An AsmParser that keeps each method as resolve_code() returns it,
+    in `ir_methods`, rather than building its code object. Code objects
+    in constants are left as placeholders, as for asm_sections().
+    """
+
+    def __init__(self) -> None:
+        super().__init__(keep_instructions=False)
+        self.defer_code_consts = True
+        self.ir_methods = []
+
+    def build_code(self) -> tuple:
+        code = self.asm.code
+        _, opcodes, args, targets, index_lines, exception_entries = resolve_code(
+            self.asm, self.label, self.backpatch_inst
+        )
+        self.ir_methods.append(
+            (
+                tuple(getattr(code, field, 0) for field in CODE_FIELDS),
+                tuple(tuple(getattr(code, field)) for field in TABLE_FIELDS),
+                bytes(opcodes),
+                args,
+                targets,
+                index_lines,
+                exception_entries,
+            )
+        )
+        return None, True
+
+
+def dump_ir(asm_path: str, fp) -> bool:
+    """
+    Parse the listing in `asm_path` and write it in IR form to binary
+    file `fp`. Returns False if the listing has no bytecode version.
+    """
+    parser = IRParser()
+    with open(asm_path) as asm_fp:
+        asm = parser.parse(asm_fp)
+    if asm is None:
+        return False
+    fp.write(IR_MAGIC)
+    marshal.dump(
+        (
+            IR_FORMAT,
+            __version__,
+            xdis.__version__,
+            osp.abspath(asm_path),
+            tuple(asm.python_version),
+            bool(asm.is_pypy),
+            asm.timestamp,
+            asm.size,
+            parser.ir_methods,
+        ),
+        fp,
+    )
+    return True
+
+
+def load_ir(
+    path: str,
+    compute_stacksize: bool = False,
+    optimize: bool = False,
+    fold_constants: bool = False,
+    trusted: bool = False,
+) -> Optional[Assembler]:
+    """
+    Assemble the IR file `path` written by dump_ir(), with the options
+    of asm_stream().
+    """
+    with open(path, "rb") as fp:
+        if fp.read(len(IR_MAGIC)) != IR_MAGIC:
+            raise RuntimeError(f"{path} is not an xasm IR file")
+        data = marshal.load(fp)
+    ir_format, xasm_version, xdis_version, asm_path = data[:4]
+    if (ir_format, xasm_version, xdis_version) != (
+        IR_FORMAT,
+        __version__,
+        xdis.__version__,
+    ):
+        stale = (
+            f"{path} was written by xasm {xasm_version} with xdis "
+            f"{xdis_version}; this is xasm {__version__} with xdis {xdis.__version__}"
+        )
+        if not osp.exists(asm_path) or ir_format != IR_FORMAT:
+            raise RuntimeError(f"{stale}. Write it again with --emit-ir.")
+        print(f"{stale}; assembling {asm_path} instead.")
+        return asm_file(
+            asm_path,
+            compute_stacksize=compute_stacksize,
+            optimize=optimize,
+            fold_constants=fold_constants,
+            trusted=trusted,
+        )
+
+    python_version, is_pypy, timestamp, size, ir_methods = data[4:]
+    asm = Assembler(python_version, is_pypy)
+    asm.keep_instructions = False
+    asm.compute_stacksize = compute_stacksize
+    asm.optimize = optimize
+    asm.fold_constants = fold_constants
+    asm.trusted = trusted
+    asm.timestamp = timestamp
+    asm.size = size
+    opname = asm.optable.opname
+    methods = {}
+    for fields, tables, opcodes, args, targets, index_lines, entries in ir_methods:
+        asm.code_init(python_version)
+        code = asm.code
+        for field, value in zip(CODE_FIELDS, fields):
+            if hasattr(code, field):
+                setattr(code, field, value)
+        code.co_qual_name = code.co_name
+        for field, values in zip(TABLE_FIELDS, tables):
+            setattr(code, field, list(values))
+        instructions = [
+            Instruction(opname[opcode], opcode, arg)
+            for opcode, arg in zip(opcodes, args)
+        ]
+        co, is_valid = finish_code(
+            asm, instructions, list(opcodes), args, targets, index_lines, entries
+        )
+        if not is_valid:
+            return None
+        co = link_code_consts(co, methods)
+        asm.update_lists(co, {}, set())
+        methods[code.co_name] = co
+    asm.code_list.reverse()
+    asm.status = "finished"
+    return asm
+
+
+def write_ir_file(asm_path: str, path: str) -> bool:
+    """
+    Write the IR form of the listing in `asm_path` to `path`, replacing
+    any file there only once the new one is complete.
+    """
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    try:
+        with open(tmp_path, "wb") as fp:
+            ok = dump_ir(asm_path, fp)
+        if ok:
+            os.replace(tmp_path, path)
+    finally:
+        if osp.exists(tmp_path):
+            os.remove(tmp_path)
+    return ok
@@ -0,0 +1,169 @@
+"""
+Encoders for the line-number tables of code objects.
+
+While a method is assembled, its line numbers are kept as a dictionary
+from bytecode offset to the line number starting there. create_code()
+turns that into the table format of the target version:
+
+* before 3.10, co_lnotab: pairs of (offset delta, line delta) bytes,
+  with line deltas signed from 3.6 on;
+* 3.10, co_linetable: pairs of (range size, signed line delta) bytes
+  covering the whole of the bytecode;
+* 3.11 and later, co_linetable as a location table: entries of up to
+  8 code units, each starting with a code byte, and here giving a
+  line delta but no columns.
+
+Each encoder makes one pass over the line numbers sorted by offset,
+appending to a bytearray. See Objects/lnotab_notes.txt and
+Objects/locations.md in the CPython sources for the formats.
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+# Location-table entry kinds, see Objects/locations.md.
+LOCATION_NO_COLUMNS = 13
+LOCATION_NONE = 15
+
+# A line delta in a 3.10 line table that means "no line number".
+NO_LINE_DELTA_310 = -128
+
+
+def encode_lnotab(
+    line_starts: Dict[int, int], first_line: int, signed: bool = True
+) -> bytes:
+    """
+    Encode `line_starts`, a dictionary from offset to line number, as a
+    co_lnotab for Python before 3.10, whose line numbers start at
+    `first_line`. Line deltas are signed bytes in 3.6 and later; set
+    `signed` to False for earlier versions, where a line number smaller
+    than the one before it can't be given and is left out.
+    """
+    if signed:
+        max_delta, min_delta = 127, -128
+    else:
+        max_delta, min_delta = 255, 0
+    table = bytearray()
+    prev_offset, prev_line = 0, first_line
+    for offset, line in sorted(line_starts.items()):
+        line_delta = line - prev_line
+        if line_delta == 0 or (line_delta < 0 and not signed):
+            continue
+        offset_delta = offset - prev_offset
+        while offset_delta > 255:
+            table.extend((255, 0))
+            offset_delta -= 255
+        while line_delta > max_delta:
+            table.extend((offset_delta, max_delta))
+            offset_delta = 0
+            line_delta -= max_delta
+        while line_delta < min_delta:
+            table.extend((offset_delta, min_delta & 0xFF))
+            offset_delta = 0
+            line_delta -= min_delta
+        table.extend((offset_delta, line_delta & 0xFF))
+        prev_offset, prev_line = offset, line
+    return bytes(table)
+
+
+def line_ranges(
+    line_starts: Dict[int, int], code_size: int
+) -> List[Tuple[int, int, Optional[int]]]:
+    """
+    Return (start, end, line number) for the ranges of the `code_size`
+    bytes of bytecode, for the line numbers of `line_starts`. Bytecode
+    before the first line number has None for it. Neighboring ranges
+    with the same line number are merged.
+    """
+    ranges = []
+    start, current = 0, None
+    for offset, line in sorted(line_starts.items()):
+        if offset >= code_size:
+            break
+        if line == current:
+            continue
+        if offset > start:
+            ranges.append((start, offset, current))
+        start, current = offset, line
+    if code_size > start:
+        ranges.append((start, code_size, current))
+    return ranges
+
+
+def encode_linetable_310(
+    line_starts: Dict[int, int], first_line: int, code_size: int
+) -> bytes:
+    """
+    Encode `line_starts` as the co_linetable of Python 3.10 for
+    `code_size` bytes of bytecode, starting at line `first_line`.
+    """
+    table = bytearray()
+    prev_line = first_line
+    for start, end, line in line_ranges(line_starts, code_size):
+        size = end - start
+        if line is None:
+            line_delta = next_delta = NO_LINE_DELTA_310
+        else:
+            line_delta = line - prev_line
+            next_delta = 0
+            prev_line = line
+            while line_delta > 127:
+                table.extend((0, 127))
+                line_delta -= 127
+            while line_delta < -127:
+                table.extend((0, -127 & 0xFF))
+                line_delta += 127
+        while size > 254:
+            table.extend((254, line_delta & 0xFF))
+            line_delta = next_delta
+            size -= 254
+        table.extend((size, line_delta & 0xFF))
+    return bytes(table)
+
+
+def append_signed_varint(table: bytearray, value: int) -> None:
+    """
+    Append `value` to `table` as the signed varint of location tables.
+    """
+    value = ((-value) << 1) | 1 if value < 0 else value << 1
+    while value >= 64:
+        table.append(0x40 | (value & 63))
+        value >>= 6
+    table.append(value)
+
+
+def encode_locations_311(
+    line_starts: Dict[int, int], first_line: int, code_size: int
+) -> bytes:
+    """
+    Encode `line_starts` as the co_linetable location table of Python
+    3.11 and later for `code_size` bytes of bytecode, starting at line
+    `first_line`. Only line numbers are given, not columns.
+    """
+    table = bytearray()
+    prev_line = first_line
+    for start, end, line in line_ranges(line_starts, code_size):
+        units = (end - start) // 2
+        while units > 0:
+            length = min(units, 8)
+            if line is None:
+                table.append(0x80 | (LOCATION_NONE << 3) | (length - 1))
+            else:
+                table.append(0x80 | (LOCATION_NO_COLUMNS << 3) | (length - 1))
+                append_signed_varint(table, line - prev_line)
+                prev_line = line
+            units -= length
+    return bytes(table)
+
+
+def encode_line_table(
+    line_starts: Dict[int, int], first_line: int, code_size: int, python_version
+) -> bytes:
+    """
+    Encode `line_starts` in the line-number table format of
+    `python_version`, a version tuple.
+    """
+    if python_version >= (3, 11):
+        return encode_locations_311(line_starts, first_line, code_size)
+    elif python_version >= (3, 10):
+        return encode_linetable_310(line_starts, first_line, code_size)
+    return encode_lnotab(line_starts, first_line, signed=python_version >= (3, 6))
@@ -0,0 +1,160 @@
+"""
+Opcode lookup tables for the assembler, one per bytecode version.
+
+The opcode modules of xdis describe opcodes with lists and sets, and
+helpers like xdis.op_size() compare version tuples on every call. An
+OpcodeTable turns all of that into tuples indexed by opcode, built once
+per (version, PyPy) pair, so that the per-instruction loops of the
+assembler need only an index or a dictionary lookup.
+"""
+
+from functools import lru_cache
+
+from xdis import get_opcode
+
+# Values of OpcodeTable.operand_kind[opcode], saying which table an
+# operand given in parentheses, like "(x)", is looked up in. These are
+# tried in this order, since some opcodes are in more than one class.
+OPERAND_NONE = 0  # no operand
+OPERAND_INT = 1  # the operand can only be an integer
+OPERAND_COMPARE = 2
+OPERAND_CONST = 3
+OPERAND_LOCAL = 4
+OPERAND_NAME = 5
+OPERAND_FREE = 6
+
+# The number of inline CACHE code units that follow each specializable
+# instruction, from 3.11 on, as in _inline_cache_entries of CPython's
+# Lib/opcode.py. The xdis opcode modules don't have these. Later
+# versions use the table of the latest version here.
+INLINE_CACHE_ENTRIES = {
+    (3, 11): {
+        "BINARY_OP": 1,
+        "BINARY_SUBSCR": 4,
+        "CALL": 4,
+        "COMPARE_OP": 2,
+        "LOAD_ATTR": 4,
+        "LOAD_GLOBAL": 5,
+        "LOAD_METHOD": 10,
+        "PRECALL": 1,
+        "STORE_ATTR": 4,
+        "STORE_SUBSCR": 1,
+        "UNPACK_SEQUENCE": 1,
+    },
+    (3, 12): {
+        "BINARY_OP": 1,
+        "BINARY_SUBSCR": 1,
+        "CALL": 3,
+        "COMPARE_OP": 1,
+        "FOR_ITER": 1,
+        "LOAD_ATTR": 9,
+        "LOAD_GLOBAL": 4,
+        "LOAD_SUPER_ATTR": 1,
+        "SEND": 1,
+        "STORE_ATTR": 4,
+        "STORE_SUBSCR": 1,
+        "UNPACK_SEQUENCE": 1,
+    },
+    (3, 13): {
+        "BINARY_OP": 1,
+        "BINARY_SUBSCR": 1,
+        "CALL": 3,
+        "COMPARE_OP": 1,
+        "CONTAINS_OP": 1,
+        "FOR_ITER": 1,
+        "JUMP_BACKWARD": 1,
+        "LOAD_ATTR": 9,
+        "LOAD_GLOBAL": 4,
+        "LOAD_SUPER_ATTR": 1,
+        "POP_JUMP_IF_FALSE": 1,
+        "POP_JUMP_IF_NONE": 1,
+        "POP_JUMP_IF_NOT_NONE": 1,
+        "POP_JUMP_IF_TRUE": 1,
+        "SEND": 1,
+        "STORE_ATTR": 4,
+        "STORE_SUBSCR": 1,
+        "TO_BOOL": 3,
+        "UNPACK_SEQUENCE": 1,
+    },
+}
+
+
+def inline_cache_entries(version_tuple: tuple) -> dict:
+    """
+    Return the number of inline CACHE code units after each opcode
+    that has any, by opcode name, for bytecode of `version_tuple`.
+    """
+    if version_tuple < (3, 11):
+        return {}
+    version_pair = min(tuple(version_tuple[:2]), max(INLINE_CACHE_ENTRIES))
+    return INLINE_CACHE_ENTRIES[version_pair]
+
+
+class OpcodeTable:
+    """
+    Lookup tables for the opcodes of one bytecode version. Use
+    opcode_table() to get one rather than creating it directly.
+    """
+
+    def __init__(self, opc) -> None:
+        self.opc = opc
+        self.version_tuple = opc.version_tuple
+        self.opmap = dict(opc.opmap)
+        self.opname = tuple(opc.opname)
+        self.HAVE_ARGUMENT = opc.HAVE_ARGUMENT
+        self.EXTENDED_ARG = opc.EXTENDED_ARG
+        self.EXTENDED_ARG_SHIFT = opc.EXTENDED_ARG_SHIFT
+        self.ARG_MAX_VALUE = opc.ARG_MAX_VALUE
+
+        # Python 3.6 and later use 2-byte "wordcode" instructions.
+        self.is_wordcode = self.version_tuple >= (3, 6)
+        # Jump operands count 2-byte units starting in Python 3.10.
+        self.jump_unit = 2 if self.version_tuple >= (3, 10) else 1
+
+        opcodes = range(256)
+        self.has_arg = tuple(op >= opc.HAVE_ARGUMENT for op in opcodes)
+        if self.is_wordcode:
+            self.size = (2,) * 256
+        else:
+            self.size = tuple(3 if has_arg else 1 for has_arg in self.has_arg)
+        # Bytes of inline CACHE entries after each instruction. The CACHE
+        # opcode is 0, so they are zero bytes.
+        self.CACHE = self.opmap.get("CACHE") if self.version_tuple >= (3, 11) else None
+        cache_entries = inline_cache_entries(self.version_tuple)
+        self.cache_size = tuple(
+            2 * cache_entries.get(self.opname[op], 0) for op in opcodes
+        )
+        self.is_jump = tuple(op in opc.JUMP_OPS for op in opcodes)
+        self.is_jrel = tuple(op in opc.JREL_OPS for op in opcodes)
+
+        operand_classes = (
+            (opc.COMPARE_OPS, OPERAND_COMPARE),
+            (opc.CONST_OPS, OPERAND_CONST),
+            (opc.LOCAL_OPS, OPERAND_LOCAL),
+            (opc.NAME_OPS, OPERAND_NAME),
+            (opc.FREE_OPS, OPERAND_FREE),
+        )
+        operand_kind = []
+        for op in opcodes:
+            kind = OPERAND_INT if self.has_arg[op] else OPERAND_NONE
+            if kind:
+                for ops, op_kind in operand_classes:
+                    if op in ops:
+                        kind = op_kind
+                        break
+            operand_kind.append(kind)
+        self.operand_kind = tuple(operand_kind)
+
+
+@lru_cache(maxsize=None)
+def _opcode_table(version_pair: tuple, is_pypy: bool) -> OpcodeTable:
+    return OpcodeTable(get_opcode(version_pair, is_pypy))
+
+
+def opcode_table(python_version, is_pypy) -> OpcodeTable:
+    """
+    Return the OpcodeTable for bytecode of `python_version`, a version
+    tuple. Tables are built the first time they are asked for, and
+    shared after that.
+    """
+    return _opcode_table(tuple(python_version[:2]), bool(is_pypy))
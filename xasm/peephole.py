@@ -0,0 +1,353 @@
+"""
+A peephole optimizer for assembled methods, used with --optimize.
+
+It works on instructions given as in layout_instructions(), whose jumps
+refer to instruction indices rather than offsets, so instructions can
+be added or removed without recomputing jump operands; that is done
+afterwards when the instructions are laid out. The changes made are:
+
+* jump threading: a jump to an unconditional jump goes straight to the
+  final target, and an unconditional jump to a return is replaced by
+  the return;
+* instructions that can't be reached are removed;
+* a load with no side effects followed by POP_TOP is removed;
+* unconditional jumps to the next instruction are removed;
+* NOPs are removed, except those needed to keep a line number that
+  would otherwise be lost.
+
+Only opcodes of the target version, as found in its opcode table, are
+used, and a relative jump is retargeted only in the direction its
+opcode can jump.
+"""
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from xasm.stackdepth import TERMINATOR_NAMES
+
+# Unconditional jumps.
+UNCONDITIONAL_JUMP_NAMES = frozenset(
+    """
+    JUMP JUMP_ABSOLUTE JUMP_BACKWARD JUMP_BACKWARD_NO_INTERRUPT
+    JUMP_FORWARD JUMP_NO_INTERRUPT
+    """.split()
+)
+
+# Prefixes of the names of conditional jumps that can be retargeted:
+# ones where the stack is the same whether the jump goes to its target
+# or to wherever an unconditional jump there goes.
+CONDITIONAL_JUMP_PREFIXES = ("POP_JUMP_", "JUMP_IF_")
+
+RETURN_NAMES = frozenset(("RETURN_VALUE", "RETURN_CONST"))
+
+
+def pure_load_names(version_tuple: tuple) -> frozenset:
+    """
+    Return the names of opcodes that push a value without side effects
+    or exceptions, so that one followed by POP_TOP can be removed.
+    """
+    names = {"LOAD_CONST", "DUP_TOP"}
+    if version_tuple >= (3, 12):
+        # The compiler only emits LOAD_FAST when the local is known to
+        # be set; otherwise it uses LOAD_FAST_CHECK.
+        names.add("LOAD_FAST")
+    return frozenset(names)
+
+
+class PeepholeStats:
+    """
+    Counts of the changes made by optimize().
+    """
+
+    __slots__ = (
+        "threaded",
+        "returns",
+        "unreachable",
+        "load_pops",
+        "jumps",
+        "nops",
+        "unresolved",
+    )
+
+    def __init__(self) -> None:
+        self.threaded = 0
+        self.returns = 0
+        self.unreachable = 0
+        self.load_pops = 0
+        self.jumps = 0
+        self.nops = 0
+        # Jumps whose target isn't known, which stop any changes.
+        self.unresolved = 0
+
+    def __bool__(self) -> bool:
+        return any(getattr(self, name) for name in self.__slots__)
+
+    def report(self) -> str:
+        """
+        Return a description of the changes made, like
+        "2 jumps threaded, 1 NOP removed".
+        """
+        if self.unresolved:
+            return (
+                f"not optimized: {self.unresolved} jump operand(s) "
+                "don't reach the start of an instruction"
+            )
+        parts = []
+        for count, singular, plural in (
+            (self.threaded, "jump threaded", "jumps threaded"),
+            (self.returns, "jump to a return replaced", "jumps to a return replaced"),
+            (
+                self.unreachable,
+                "unreachable instruction removed",
+                "unreachable instructions removed",
+            ),
+            (self.load_pops, "load and POP_TOP removed", "loads and POP_TOPs removed"),
+            (
+                self.jumps,
+                "jump to the next instruction removed",
+                "jumps to the next instruction removed",
+            ),
+            (self.nops, "NOP removed", "NOPs removed"),
+        ):
+            if count:
+                parts.append(f"{count} {singular if count == 1 else plural}")
+        return ", ".join(parts) if parts else "no changes"
+
+
+def optimize(
+    opcodes: list,
+    args: list,
+    targets: list,
+    line_starts: Dict[int, int],
+    optable,
+    handlers: Optional[Iterable[int]] = None,
+) -> Tuple[List[int], PeepholeStats]:
+    """
+    Optimize the instructions given by `opcodes`, `args` and `targets`
+    as for layout_instructions(), changing the three lists in place.
+    `line_starts` maps the index of each instruction that starts a
+    source line to its line number, and is changed in place too.
+    `handlers` gives the indices of other places where execution can
+    start, such as exception handlers. From 3.11 on, handlers are found
+    only through the exception table, so unless `handlers` is given,
+    unreachable instructions are not removed for those versions.
+
+    Returns a list giving for each index of the original instructions
+    its new index, or for a removed instruction the index of the next
+    one kept, and the changes made.
+    """
+    opname = optable.opname
+    opmap = optable.opmap
+    is_jrel = optable.is_jrel
+    stats = PeepholeStats()
+    n = len(opcodes)
+    nop = opmap.get("NOP")
+
+    is_jump = optable.is_jump
+    stats.unresolved = sum(
+        1 for opcode, target in zip(opcodes, targets) if is_jump[opcode] and target < 0
+    )
+    if stats.unresolved:
+        return list(range(n + 1)), stats
+    if handlers is None:
+        handlers = []
+        remove_unreachable = optable.version_tuple < (3, 11)
+    else:
+        handlers = list(handlers)
+        remove_unreachable = True
+
+    def name_at(i: int) -> str:
+        return opname[opcodes[i]] if i < n else ""
+
+    # Instructions turned into NOPs here, so they aren't counted as
+    # NOPs removed too.
+    made_nop = [False] * n
+
+    # Loads whose value is popped right away. The POP_TOP must not be
+    # jumped to, or the value popped could come from elsewhere.
+    if nop is not None:
+        jumped_to = set(t for t in targets if t >= 0)
+        jumped_to.update(handlers)
+        pure_loads = pure_load_names(optable.version_tuple)
+        for i in range(n - 1):
+            if (
+                name_at(i) in pure_loads
+                and name_at(i + 1) == "POP_TOP"
+                and i + 1 not in jumped_to
+            ):
+                opcodes[i] = opcodes[i + 1] = nop
+                args[i] = args[i + 1] = None
+                made_nop[i] = made_nop[i + 1] = True
+                stats.load_pops += 1
+
+    def skip_nops(target: int) -> int:
+        # NOPs that start a line may be needed to keep it.
+        while target < n and opcodes[target] == nop and target not in line_starts:
+            target += 1
+        return target
+
+    def final_target(i: int) -> int:
+        """
+        Return the index the jump at `i` finally ends up at, following
+        unconditional jumps, and NOPs that don't start a line.
+        """
+        target = skip_nops(targets[i])
+        seen = set()
+        while (
+            target < n
+            and target not in seen
+            and opname[opcodes[target]] in UNCONDITIONAL_JUMP_NAMES
+        ):
+            seen.add(target)
+            target = skip_nops(targets[target])
+        return target
+
+    def can_jump(opcode: int, i: int, target: int) -> bool:
+        if not is_jrel[opcode]:
+            return True
+        elif "BACKWARD" in opname[opcode]:
+            return target <= i + 1
+        return target > i
+
+    def direction_opcode(i: int, target: int):
+        """
+        Return an unconditional jump opcode that can go from `i` to
+        `target`, or None.
+        """
+        for name in ("JUMP_ABSOLUTE", "JUMP_FORWARD", "JUMP_BACKWARD"):
+            opcode = opmap.get(name)
+            if opcode is not None and can_jump(opcode, i, target):
+                return opcode
+        return None
+
+    # Jump threading.
+    for i in range(n):
+        if targets[i] < 0:
+            continue
+        name = opname[opcodes[i]]
+        unconditional = name in UNCONDITIONAL_JUMP_NAMES
+        if not (unconditional or name.startswith(CONDITIONAL_JUMP_PREFIXES)):
+            continue
+        target = final_target(i)
+        if unconditional and name_at(target) in RETURN_NAMES:
+            opcodes[i] = opcodes[target]
+            args[i] = args[target]
+            targets[i] = -1
+            stats.returns += 1
+            continue
+        if target == skip_nops(targets[i]):
+            continue
+        if can_jump(opcodes[i], i, target):
+            targets[i] = target
+            stats.threaded += 1
+        elif unconditional and not name.endswith("NO_INTERRUPT"):
+            opcode = direction_opcode(i, target)
+            if opcode is not None:
+                opcodes[i] = opcode
+                targets[i] = target
+                stats.threaded += 1
+
+    # Reachability, following fallthrough and jumps from the start and
+    # from the handlers.
+    reachable = [not remove_unreachable] * n
+    worklist = [0] + handlers if remove_unreachable else []
+    while worklist:
+        i = worklist.pop()
+        while i < n and not reachable[i]:
+            reachable[i] = True
+            if targets[i] >= 0:
+                worklist.append(targets[i])
+            if opname[opcodes[i]] in TERMINATOR_NAMES:
+                break
+            i += 1
+
+    keep = reachable
+    stats.unreachable = n - sum(keep)
+    new_index, removed_nops, removed_jumps = compact(
+        opcodes, args, targets, line_starts, optable, keep, remove_jumps=True
+    )
+    stats.jumps = len(removed_jumps)
+    stats.nops = sum(1 for i in removed_nops if not made_nop[i])
+    return new_index, stats
+
+
+def compact(
+    opcodes: list,
+    args: list,
+    targets: list,
+    line_starts: Dict[int, int],
+    optable,
+    keep: Optional[List[bool]] = None,
+    remove_jumps: bool = False,
+) -> Tuple[List[int], List[int], List[int]]:
+    """
+    Remove from the instructions given as in optimize() the NOPs, and
+    those whose entry in `keep` is False, moving jump targets and line
+    starts to the next instruction kept. A NOP is kept if it starts a
+    line that the next instruction kept doesn't. With `remove_jumps`,
+    unconditional jumps to the next instruction kept are removed too.
+
+    Returns a list giving the new index of each instruction as in
+    optimize(), and the indices of the NOPs and of the jumps removed.
+    """
+    opname = optable.opname
+    nop = optable.opmap.get("NOP")
+    n = len(opcodes)
+    if keep is None:
+        keep = [True] * n
+    removed_nops = []
+    removed_jumps = []
+
+    # Walk backwards so that whether the next instruction is kept is known.
+    next_kept = n
+    for i in range(n - 1, -1, -1):
+        if not keep[i]:
+            continue
+        jump = False
+        if (
+            remove_jumps
+            and targets[i] >= 0
+            and opname[opcodes[i]] in UNCONDITIONAL_JUMP_NAMES
+        ):
+            # Where the jump goes, once instructions in the way are gone.
+            target = targets[i]
+            while target < next_kept and not keep[target]:
+                target += 1
+            if target == next_kept and nop is not None:
+                opcodes[i] = nop
+                args[i] = None
+                targets[i] = -1
+                jump = True
+        if opcodes[i] == nop:
+            line = line_starts.get(i)
+            if line is not None and next_kept < n and next_kept not in line_starts:
+                # The line can move to the next instruction.
+                line_starts[next_kept] = line
+                line = None
+            if line is None:
+                keep[i] = False
+                if jump:
+                    removed_jumps.append(i)
+                else:
+                    removed_nops.append(i)
+                continue
+        next_kept = i
+
+    new_index = []
+    count = 0
+    for i in range(n):
+        new_index.append(count)
+        if keep[i]:
+            count += 1
+    new_index.append(count)
+
+    kept = [i for i in range(n) if keep[i]]
+    opcodes[:] = [opcodes[i] for i in kept]
+    args[:] = [args[i] for i in kept]
+    targets[:] = [new_index[targets[i]] if targets[i] >= 0 else -1 for i in kept]
+    new_line_starts = {}
+    for i in sorted(line_starts):
+        if i >= n or keep[i]:
+            new_line_starts[new_index[i]] = line_starts[i]
+    line_starts.clear()
+    line_starts.update(new_line_starts)
+    return new_index, removed_nops, removed_jumps
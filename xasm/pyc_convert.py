@@ -2,26 +2,18 @@
 """Convert Python Bytecode from one version to another for
 some limited set of Python bytecode versions
 """
-import os
 import os.path as osp
 from copy import copy
-from tempfile import NamedTemporaryFile
+from typing import Optional
 
 import click
-import xdis
-from xdis import disassemble_file, load_module, magic2int, write_bytecode_file
+from xdis import findlinestarts, iscode, load_module, magic2int, write_bytecode_file
 from xdis.magics import magics
-from xdis.opcodes import opcode_27, opcode_33
-
-from xasm.assemble import (
-    Assembler,
-    Instruction,
-    asm_file,
-    create_code,
-    decode_lineno_tab_old,
-)
+from xdis.version_info import version_str_to_tuple
+
+from xasm.assemble import Assembler, Instruction, create_code, decode_lineno_tab_old
 from xasm.version import __version__
-from xasm.write_pyc import write_pycfile
+from xasm.write_pyc import write_pycfile_atomic
 
 
 def add_credit(asm, src_version, dest_version) -> None:
@@ -38,21 +30,176 @@ def add_credit(asm, src_version, dest_version) -> None:
 def copy_magic_into_pyc(input_pyc, output_pyc, src_version, dest_version) -> None:
     """Bytecodes are the same except the magic number, so just change
     that"""
-    (version, timestamp, magic_int, co, is_pypy, source_size) = load_module(input_pyc)
-    assert version == float(
-        src_version
+    (version, timestamp, magic_int, co, is_pypy, source_size, sip_hash) = load_module(
+        input_pyc
+    )
+    assert version[:2] == version_str_to_tuple(
+        src_version, length=2
     ), f"Need Python {src_version} bytecode; got bytecode for version {version}"
-    magic_int = magic2int(magics.magics[dest_version])
+    magic_int = magic2int(magics[dest_version])
     write_bytecode_file(output_pyc, co, magic_int)
     print(f"Wrote {output_pyc}")
     return
 
 
-def xlate26_27(inst) -> None:
+def decode_instructions(co, optable) -> tuple:
+    """
+    Decode the bytecode of code object `co`, using xasm.optable.OpcodeTable
+    `optable`, into a list of Instructions,
+    folding EXTENDED_ARG prefixes and inline CACHE entries into the
+    instruction they belong to.
+
+    Jump operands are replaced by the name of a label of the form
+    "L<offset>", as they would be in assembler text. Offsets, of
+    instructions and labels alike, count only the instructions returned. Returned is the
+    instruction list, the label dictionary, and the set of
+    instructions whose operands are labels.
+    """
+    bytecode = co.co_code
+    if isinstance(bytecode, str):
+        bytecode = bytecode.encode("latin-1")
+    is_wordcode = optable.is_wordcode
+    has_arg = optable.has_arg
+    extended_arg_op = optable.EXTENDED_ARG
+    cache_op = optable.opmap.get("CACHE")
+    is_jump = optable.is_jump
+    is_jrel = optable.is_jrel
+    jump_unit = optable.jump_unit
+    line_starts = dict(findlinestarts(co))
+
+    instructions = []
+    extended_arg = 0
+    start = None
+    i, n = 0, len(bytecode)
+    while i < n:
+        offset = i
+        opcode = bytecode[i]
+        if is_wordcode:
+            arg = bytecode[i + 1] | extended_arg
+            i += 2
+        elif has_arg[opcode]:
+            arg = bytecode[i + 1] | bytecode[i + 2] << 8 | extended_arg
+            i += 3
+        else:
+            arg = None
+            i += 1
+        if start is None:
+            start = offset
+        if opcode == extended_arg_op:
+            extended_arg = arg << optable.EXTENDED_ARG_SHIFT
+            continue
+        if opcode == cache_op and instructions:
+            # Part of the instruction before; the next one starts after it.
+            start = None
+            continue
+        inst = Instruction(
+            optable.opname[opcode],
+            opcode,
+            arg if has_arg[opcode] else None,
+            line_starts.get(start),
+            start,
+        )
+        instructions.append(inst)
+        extended_arg = 0
+        start = None
+
+    # Labels and line numbers are given at offsets counting just the
+    # instructions kept, as in an assembly listing; see create_code().
+    listing_offset = {}
+    offset = 0
+    for inst in instructions:
+        listing_offset[inst.offset] = offset
+        offset += optable.size[inst.opcode]
+    listing_offset[n] = offset
+
+    label = {}
+    backpatch = set([])
+    for j, inst in enumerate(instructions):
+        if not is_jump[inst.opcode]:
+            continue
+        if is_jrel[inst.opcode]:
+            # Relative jumps are from the end of the instruction,
+            # including any inline cache entries that follow it.
+            next_offset = instructions[j + 1].offset if j + 1 < len(instructions) else n
+            if "BACKWARD" in inst.opname:
+                target = next_offset - inst.arg * jump_unit
+            else:
+                target = next_offset + inst.arg * jump_unit
+        else:
+            target = inst.arg * jump_unit
+        target = listing_offset[target]
+        label_name = f"L{target}"
+        label[label_name] = target
+        inst.arg = label_name
+        backpatch.add(inst)
+    for inst in instructions:
+        inst.offset = listing_offset[inst.offset]
+    return instructions, label, backpatch
+
+
+def add_code_to_asm(asm: Assembler, co) -> None:
+    """
+    Add code object `co`, after any code objects in its constants, to
+    the method lists of `asm`.
+    """
+    for const in co.co_consts:
+        if iscode(const):
+            add_code_to_asm(asm, const)
+
+    asm.code_init(asm.python_version)
+    code = asm.code
+    for field in (
+        "co_argcount",
+        "co_posonlyargcount",
+        "co_kwonlyargcount",
+        "co_nlocals",
+        "co_stacksize",
+        "co_flags",
+        "co_filename",
+        "co_name",
+        "co_firstlineno",
+    ):
+        if hasattr(co, field):
+            setattr(code, field, getattr(co, field))
+    for field in "co_consts co_names co_varnames co_freevars co_cellvars".split():
+        setattr(code, field, list(getattr(co, field)))
+
+    instructions, label, backpatch = decode_instructions(co, asm.optable)
+    code.instructions = instructions
+    line_starts = {
+        inst.offset: inst.line_no for inst in instructions if inst.line_no is not None
+    }
+    if asm.python_version < (3, 10):
+        code.co_lnotab = line_starts
+    else:
+        code.co_linetable = line_starts
+    asm.update_lists(co, label, backpatch)
+
+
+def code_to_asm(co, python_version, is_pypy: bool, timestamp=None) -> Assembler:
+    """
+    Build an Assembler for code object `co` and the code objects nested
+    in it directly from their bytecode. The result has the same
+    instructions, labels and backpatch sets that asm_file() would build
+    from a ``pydisasm --xasm`` listing of `co`, but without formatting,
+    writing, and reparsing text.
+
+    ``code_list`` holds the code objects passed in, not reassembled ones.
+    """
+    asm = Assembler(python_version[:2], is_pypy)
+    asm.timestamp = timestamp
+    add_code_to_asm(asm, co)
+    asm.code_list.reverse()
+    asm.status = "finished"
+    return asm
+
+
+def xlate26_27(inst, optable) -> None:
     """Between 2.6 and 2.7 opcode values changed
-    Adjust for the differences by using the opcode name
+    Adjust for the differences by using the opcode name and
+    the 2.7 opcode table `optable`.
     """
-    inst.opcode = opcode_27.opmap[inst.opname]
+    inst.opcode = optable.opmap[inst.opname]
 
 
 def conversion_to_version(conversion_type, is_dest=False):
@@ -62,30 +209,42 @@ def conversion_to_version(conversion_type, is_dest=False):
         return conversion_type[0] + "." + conversion_type[1]
 
 
-def transform_26_27(inst, new_inst, i, n, offset, instructions, new_asm):
-    """Change JUMP_IF_FALSE and JUMP_IF_TRUE to
-    POP_JUMP_IF_FALSE and POP_JUMP_IF_TRUE"""
+def transform_26_27(
+    inst, new_inst, i, n, instructions, new_asm, labels, index_at
+) -> int:
+    """Change JUMP_IF_FALSE and JUMP_IF_TRUE, which leave the value
+    tested on the stack and are followed by a POP_TOP, to the 2.7 jumps
+    that pop it themselves.
+
+    When the jump target starts with a POP_TOP too, as in an if
+    statement, the jump becomes POP_JUMP_IF_FALSE or POP_JUMP_IF_TRUE to
+    the instruction after that POP_TOP. Otherwise, as in "a and b", the
+    value is still wanted there, and the jump becomes
+    JUMP_IF_FALSE_OR_POP or JUMP_IF_TRUE_OR_POP.
+    """
     if inst.opname in ("JUMP_IF_FALSE", "JUMP_IF_TRUE"):
-        i += 1
-        assert i < n
-        assert instructions[i].opname == "POP_TOP"
-        new_inst.offset = offset
-        new_inst.opname = (
-            "POP_JUMP_IF_FALSE"
-            if inst.opname == "JUMP_IF_FALSE"
-            else "POP_JUMP_IF_TRUE"
-        )
-        new_asm.backpatch[-1].remove(inst)
-        new_inst.arg = "L%d" % (inst.offset + inst.arg + 3)
-        new_asm.backpatch[-1].add(new_inst)
-    else:
-        xlate26_27(new_inst)
-    return xdis.op_size(new_inst.opcode, opcode_27)
+        assert i + 1 < n
+        assert instructions[i + 1].opname == "POP_TOP"
+        sense = inst.opname.split("_")[-1]
+        target = index_at[labels[inst.arg]]
+        if instructions[target].opname == "POP_TOP" and target + 1 < n:
+            new_inst.opname = f"POP_JUMP_IF_{sense}"
+            after_pop = instructions[target + 1].offset
+            new_inst.arg = f"L{after_pop}"
+            labels[new_inst.arg] = after_pop
+        else:
+            new_inst.opname = f"JUMP_IF_{sense}_OR_POP"
+        xlate26_27(new_inst, new_asm.optable)
+        # The POP_TOP that follows is done by the jump now.
+        return 2
+    xlate26_27(new_inst, new_asm.optable)
+    return 1
 
 
-def transform_32_33(inst, new_inst, i, n, offset, instructions, new_asm):
+def transform_32_33(
+    inst, new_inst, i, n, instructions, new_asm, labels, index_at
+) -> int:
     """MAKE_FUNCTION adds another const. probably MAKE_CLASS as well"""
-    add_size = xdis.op_size(new_inst.opcode, opcode_33)
     if inst.opname in ("MAKE_FUNCTION", "MAKE_CLOSURE"):
         # Previous instruction should be a load const which
         # contains the name of the function to call
@@ -94,35 +253,25 @@ def transform_32_33(inst, new_inst, i, n, offset, instructions, new_asm):
         assert isinstance(prev_inst.arg, int)
 
         # Add the function name as an additional LOAD_CONST
-        load_fn_const = Instruction()
-        load_fn_const.opname = "LOAD_CONST"
-        load_fn_const.opcode = opcode_33.opmap["LOAD_CONST"]
-        load_fn_const.line_no = None
+        load_fn_const = Instruction("LOAD_CONST", new_asm.optable.opmap["LOAD_CONST"])
         prev_const = new_asm.code.co_consts[prev_inst.arg]
         if hasattr(prev_const, "co_name"):
-            fn_name = new_asm.code.co_consts[prev_inst.arg].co_name
+            fn_name = prev_const.co_name
         else:
             fn_name = "what-is-up"
         const_index = len(new_asm.code.co_consts)
-        new_asm.code.co_consts = list(new_asm.code.co_consts)
         new_asm.code.co_consts.append(fn_name)
         load_fn_const.arg = const_index
-        load_fn_const.offset = offset
-        load_fn_const.starts_line = False
-        load_fn_const.is_jump_target = False
         new_asm.code.instructions.append(load_fn_const)
-        load_const_size = xdis.op_size(load_fn_const.opcode, opcode_33)
-        add_size += load_const_size
-        new_inst.offset = offset + add_size
-        pass
-    return add_size
+    return 1
 
 
-def transform_33_32(inst, new_inst, i, n, offset, instructions, new_asm):
+def transform_33_32(
+    inst, new_inst, i, n, instructions, new_asm, labels, index_at
+) -> int:
     """MAKE_FUNCTION, and MAKE_CLOSURE have an additional LOAD_CONST of a name
     that are not in Python 3.2. Remove these.
     """
-    add_size = xdis.op_size(new_inst.opcode, opcode_33)
     if inst.opname in ("MAKE_FUNCTION", "MAKE_CLOSURE"):
         # Previous instruction should be a load const which
         # contains the name of the function to call
@@ -130,28 +279,29 @@ def transform_33_32(inst, new_inst, i, n, offset, instructions, new_asm):
         assert prev_inst.opname == "LOAD_CONST"
         assert isinstance(prev_inst.arg, int)
         assert len(instructions) > 2
-        assert len(instructions) > 2
         prev_inst2 = instructions[i - 2]
         assert prev_inst2.opname == "LOAD_CONST"
         assert isinstance(prev_inst2.arg, int)
 
         # Remove the function name as an additional LOAD_CONST
-        prev2_const = new_asm.code.co_consts[prev_inst.arg]
+        prev2_const = new_asm.code.co_consts[prev_inst2.arg]
         assert hasattr(prev2_const, "co_name")
-        new_asm.code.instructions = new_asm.code.instructions[:-1]
-        load_const_size = xdis.op_size(prev_inst.opcode, opcode_33)
-        add_size -= load_const_size
-        new_inst.offset = offset - add_size
-        return -load_const_size
-    return 0
+        new_asm.code.instructions.pop()
+    return 1
 
 
 def transform_asm(
-    asm: Assembler | None, conversion_type, src_version, dest_version
+    asm: Optional[Assembler], conversion_type, src_version, dest_version
 ) -> Assembler:
-    new_asm = Assembler(dest_version, is_pypy=False)
-    for field in "code size".split():
-        setattr(new_asm, field, copy(getattr(asm, field)))
+    """
+    Convert the methods of `asm`, as built by code_to_asm(), from
+    `src_version` to `dest_version` bytecode and create code objects for
+    them.
+    """
+    dest_version_pair = version_str_to_tuple(dest_version, length=2)
+    new_asm = Assembler(dest_version_pair, is_pypy=False)
+    new_asm.timestamp = asm.timestamp
+    new_asm.size = asm.size
 
     if conversion_type == "26-27":
         transform_fn = transform_26_27
@@ -161,33 +311,93 @@ def transform_asm(
         transform_fn = transform_33_32
     else:
         raise RuntimeError(f"Don't know how to convert {conversion_type} ")
-    for j, code in enumerate(asm.code_list):
-        offset2label = {v: k for k, v in asm.label[j].items()}
-        new_asm.backpatch.append(copy(asm.backpatch[j]))
-        new_asm.label.append(copy(asm.label[j]))
-        new_asm.codes.append(copy(code))
-        new_asm.code.co_lnotab = decode_lineno_tab_old(
-            code.co_lnotab, code.co_firstlineno
-        )
-        instructions = asm.codes[j].instructions
-        new_asm.code.instructions = []
-        i, offset, n = 0, 0, len(instructions)
+
+    # asm.codes is in the order the methods were added: nested code
+    # first. asm.code_list is the reverse of that.
+    new_codes = {}
+    is_valid = True
+    num_codes = len(asm.codes)
+    for j, code in enumerate(asm.codes):
+        source_co = asm.code_list[num_codes - 1 - j]
+        new_asm.code_init(dest_version_pair)
+        new_code = new_asm.code
+        for field in (
+            "co_argcount",
+            "co_posonlyargcount",
+            "co_kwonlyargcount",
+            "co_nlocals",
+            "co_stacksize",
+            "co_flags",
+            "co_filename",
+            "co_name",
+            "co_firstlineno",
+        ):
+            if hasattr(code, field):
+                setattr(new_code, field, getattr(code, field))
+        for field in "co_names co_varnames co_freevars co_cellvars".split():
+            setattr(new_code, field, list(getattr(code, field)))
+        new_code.co_consts = [new_codes.get(id(c), c) for c in code.co_consts]
+
+        line_table = code.co_lnotab
+        if not isinstance(line_table, dict):
+            line_table = decode_lineno_tab_old(line_table, code.co_firstlineno)
+
+        # Transform functions may add labels, at source offsets.
+        labels = dict(asm.label[j])
+        backpatch = asm.backpatch[j]
+        new_backpatch = set([])
+        line_nos = {}
+
+        # Transform instructions. Labels and line numbers of a source
+        # instruction go with the first instruction added for it, and
+        # those of source instructions dropped with the next one.
+        instructions = code.instructions
+        index_at = {inst.offset: k for k, inst in enumerate(instructions)}
+        new_instructions = new_code.instructions
+        new_index = {}
+        i, n = 0, len(instructions)
         while i < n:
             inst = instructions[i]
             new_inst = copy(inst)
-            inst_size = transform_fn(
-                inst, new_inst, i, offset, n, instructions, new_asm
+            size_before = len(new_instructions)
+            consumed = transform_fn(
+                inst, new_inst, i, n, instructions, new_asm, labels, index_at
             )
-            if inst.offset in offset2label:
-                new_asm.label[-1][offset2label[inst.offset]] = offset
-                pass
-            offset += inst_size
-            new_asm.code.instructions.append(new_inst)
-            i += 1
-            pass
+            # A transform can add instructions before this one, or remove
+            # ones it finds were added for earlier instructions.
+            first_new = min(size_before, len(new_instructions))
+            new_instructions.append(new_inst)
+            if inst in backpatch:
+                new_backpatch.add(new_inst)
+            for k in range(i, i + consumed):
+                offset = instructions[k].offset
+                index = first_new if k == i else len(new_instructions)
+                new_index[offset] = index
+                if offset in line_table:
+                    line_nos.setdefault(index, line_table[offset])
+            i += consumed
+
+        # Lay out the new instructions to find label and line-number offsets.
+        new_label = {}
+        new_code.co_lnotab = {}
+        offset = 0
+        inst_offsets = []
+        for new_inst in new_instructions:
+            inst_offsets.append(offset)
+            offset += new_asm.optable.size[new_inst.opcode]
+        inst_offsets.append(offset)
+        for label_name, label_offset in labels.items():
+            # A label not at an instruction is at the end of the code.
+            index = new_index.get(label_offset, len(new_instructions))
+            new_label[label_name] = inst_offsets[index]
+        for index, line_no in line_nos.items():
+            new_code.co_lnotab[inst_offsets[index]] = line_no
+
+        co, method_is_valid = create_code(new_asm, new_label, new_backpatch)
+        is_valid = is_valid and method_is_valid
+        new_codes[id(source_co)] = co
+        new_asm.update_lists(co, new_label, new_backpatch)
 
-    co, is_valid = create_code(new_asm, new_asm.label[-1], new_asm.backpatch[-1])
-    new_asm.code_list.append(co)
     new_asm.code_list.reverse()
     new_asm.status = "finished" if is_valid else "invalid"
     return new_asm
@@ -241,18 +451,22 @@ def main(conversion_type, input_pyc, output_pyc) -> None:
     if conversion_type in UPWARD_COMPATIBLE:
         copy_magic_into_pyc(input_pyc, output_pyc, src_version, dest_version)
         return
-    temp_asm = NamedTemporaryFile("w", suffix=".pyasm", prefix=shortname, delete=False)
-    (filename, co, version, timestamp, magic_int) = disassemble_file(
-        input_pyc, temp_asm, asm_format=True
+    (version, timestamp, magic_int, co, is_pypy, source_size, sip_hash) = load_module(
+        input_pyc
     )
-    temp_asm.close()
-    assert version == float(
-        src_version
+    assert version[:2] == version_str_to_tuple(
+        src_version, length=2
     ), f"Need Python {src_version} bytecode; got bytecode for version {version}"
-    asm = asm_file(temp_asm.name)
+    asm = code_to_asm(co, version, is_pypy, timestamp)
     new_asm = transform_asm(asm, conversion_type, src_version, dest_version)
-    os.unlink(temp_asm.name)
-    write_pycfile(output_pyc, new_asm)
+    write_pycfile_atomic(
+        output_pyc,
+        new_asm.code_list,
+        new_asm.timestamp,
+        new_asm.python_version,
+        new_asm.is_pypy,
+    )
+    print(f"Wrote {output_pyc}")
 
 
 if __name__ == "__main__":
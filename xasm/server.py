@@ -0,0 +1,218 @@
+"""
+A long-lived assembler listening on a Unix-domain socket, and a client
+for it.
+
+This avoids paying Python, click and xdis start-up costs for each
+listing when many small listings are assembled, say by an editor or a
+code generator.
+
+Each message in either direction is a frame: a 4-byte big-endian
+length followed by that many bytes. A request is one frame holding a
+JSON object:
+
+    {"text": <assembly text>, "timestamp": <optional int>,
+     "options": <optional object>}
+
+"options" gives assembly options of asm_string(), by name, from
+ASSEMBLY_OPTIONS; those not given take the server's defaults. The reply is two frames: a JSON object
+
+    {"rc": <return code>, "diagnostics": <messages printed>}
+
+followed by the bytes of the .pyc file, which are empty if nothing
+could be assembled. Any number of requests can be sent over one
+connection.
+
+Each connection is served in its own thread, so a client that keeps
+its connection open doesn't hold up others. Listings are assembled
+one at a time, though, as what is printed while assembling is
+captured by redirecting standard output.
+"""
+
+import json
+import os
+import socket
+import socketserver
+import struct
+import threading
+from contextlib import redirect_stdout
+from io import StringIO
+from typing import Optional, Tuple
+
+from xasm.assemble import asm_string
+from xasm.write_pyc import pyc_bytes
+
+FRAME_HEADER = struct.Struct(">I")
+
+# The options of asm_string() a request can give.
+ASSEMBLY_OPTIONS = ("compute_stacksize", "optimize", "fold_constants", "trusted")
+
+
+def read_frame(fp) -> Optional[bytes]:
+    """
+    Read a frame from binary file `fp`. Returns None at end of file.
+    """
+    header = fp.read(FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+        return None
+    (size,) = FRAME_HEADER.unpack(header)
+    data = fp.read(size)
+    if len(data) < size:
+        raise EOFError(f"frame of {size} bytes cut short after {len(data)}")
+    return data
+
+
+def write_frame(fp, data: bytes) -> None:
+    fp.write(FRAME_HEADER.pack(len(data)))
+    fp.write(data)
+
+
+def check_options(options) -> dict:
+    """
+    Return assembly options `options` as a dict, raising ValueError if
+    it isn't a mapping from names in ASSEMBLY_OPTIONS to booleans.
+    """
+    if options is None:
+        return {}
+    if not isinstance(options, dict):
+        raise ValueError("options must be an object")
+    for name, value in options.items():
+        if name not in ASSEMBLY_OPTIONS:
+            raise ValueError(f"unknown option {name}")
+        if not isinstance(value, bool):
+            raise ValueError(f"option {name} must be true or false")
+    return options
+
+
+def assemble_to_bytes(
+    text: str, timestamp: Optional[int] = None, options: Optional[dict] = None
+) -> Tuple[int, bytes, str]:
+    """
+    Assemble `text` with the asm_string() options in `options`. Returns
+    a return code, the bytes of a .pyc file, and the messages printed
+    while assembling. `timestamp`, if given, overrides any
+    "# Timestamp in code:" in `text`.
+    """
+    out = StringIO()
+    pyc = b""
+    with redirect_stdout(out):
+        try:
+            asm = asm_string(text, keep_instructions=False, **(options or {}))
+            if asm is None:
+                print("No Python bytecode was assembled")
+                rc = 1
+            else:
+                if timestamp is not None:
+                    asm.timestamp = timestamp
+                rc, pyc = pyc_bytes(
+                    asm.code_list, asm.timestamp, asm.python_version, asm.is_pypy
+                )
+        except Exception as e:
+            print(f"Error: {e}")
+            rc = 1
+    return rc, pyc, out.getvalue()
+
+
+class AssemblerHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        while True:
+            data = read_frame(self.rfile)
+            if data is None:
+                break
+            try:
+                request = json.loads(data)
+                options = dict(self.server.options)
+                options.update(check_options(request.get("options")))
+                with self.server.lock:
+                    rc, pyc, diagnostics = assemble_to_bytes(
+                        request["text"], request.get("timestamp"), options
+                    )
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                rc, pyc, diagnostics = 1, b"", f"Bad request: {e}\n"
+            reply = {"rc": rc, "diagnostics": diagnostics}
+            write_frame(self.wfile, json.dumps(reply).encode())
+            write_frame(self.wfile, pyc)
+            self.wfile.flush()
+
+
+class AssemblerServer(socketserver.ThreadingUnixStreamServer):
+    """
+    Serves assembly requests on the Unix-domain socket `socket_path`,
+    each connection in its own thread. `options` gives the assembly
+    options used for those a request doesn't give.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, options: Optional[dict] = None) -> None:
+        self.options = check_options(options)
+        # Held while assembling; see the module docstring.
+        self.lock = threading.Lock()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, AssemblerHandler)
+
+    def server_close(self) -> None:
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def serve(socket_path: str, options: Optional[dict] = None) -> None:
+    """
+    Serve requests on `socket_path` until interrupted, with `options`
+    as the default assembly options.
+    """
+    with AssemblerServer(socket_path, options) as server:
+        print(f"Assembling requests on {socket_path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+class AssemblerClient:
+    """
+    A connection to an assembler server, see serve(). For example:
+
+        with AssemblerClient("/tmp/xasm.sock") as client:
+            rc, pyc, diagnostics = client.assemble(text)
+    """
+
+    def __init__(self, socket_path: str) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.rfile = self.sock.makefile("rb")
+        self.wfile = self.sock.makefile("wb")
+
+    def assemble(
+        self, text: str, timestamp: Optional[int] = None, **options
+    ) -> Tuple[int, bytes, str]:
+        """
+        Have the server assemble `text`, with the assembly options given
+        as keyword arguments, like optimize=True. Returns the same things
+        as assemble_to_bytes().
+        """
+        request = {"text": text}
+        if timestamp is not None:
+            request["timestamp"] = timestamp
+        if options:
+            request["options"] = options
+        write_frame(self.wfile, json.dumps(request).encode())
+        self.wfile.flush()
+        reply = read_frame(self.rfile)
+        pyc = read_frame(self.rfile)
+        if reply is None or pyc is None:
+            raise EOFError("assembler server closed the connection")
+        reply = json.loads(reply)
+        return reply["rc"], pyc, reply["diagnostics"]
+
+    def close(self) -> None:
+        self.rfile.close()
+        self.wfile.close()
+        self.sock.close()
+
+    def __enter__(self) -> "AssemblerClient":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
@@ -0,0 +1,248 @@
+"""
+Computation of the maximum evaluation-stack depth of a method, for
+co_stacksize.
+
+The stack effect of each instruction comes from the opcode tables of
+xdis. Those give, for instructions that branch, the larger of the
+effects with and without the branch taken; branch_effects() below
+gives the two separately, as CPython's compiler does. Effects that
+depend on the operand are worked out by operand_effect(), following
+CPython's compile.c for each version, since the xdis tables don't
+have all of them.
+
+Depths are propagated along the control-flow graph with a worklist:
+starting from the first instruction, each straight run of
+instructions is walked once, and the targets of jumps met along the
+way are added to the worklist when first reached. An instruction is
+walked again only if it is reached with a greater depth than before,
+which doesn't happen in code from a compiler, so the time taken is
+linear in the number of instructions.
+"""
+
+from typing import Iterable, List, Optional, Tuple
+
+from xdis.cross_dis import xstack_effect
+
+# Opcodes after which execution doesn't continue with the next
+# instruction.
+TERMINATOR_NAMES = frozenset(
+    """
+    BREAK_LOOP CONTINUE_LOOP JUMP JUMP_ABSOLUTE JUMP_BACKWARD
+    JUMP_BACKWARD_NO_INTERRUPT JUMP_FORWARD JUMP_NO_INTERRUPT RAISE_VARARGS
+    RERAISE RETURN_CONST RETURN_VALUE
+    """.split()
+)
+
+
+def branch_effects(opname: str, version_tuple: tuple):
+    """
+    Return (effect when not jumping, effect when jumping) for opcodes
+    whose two differ, or None.
+    """
+    if opname == "FOR_ITER":
+        # From 3.12 on, the iterator is popped by END_FOR at the target.
+        return (1, 1) if version_tuple >= (3, 12) else (1, -1)
+    elif opname in ("JUMP_IF_TRUE_OR_POP", "JUMP_IF_FALSE_OR_POP"):
+        return (-1, 0)
+    elif opname == "SEND":
+        return (0, -1)
+    elif opname in ("SETUP_EXCEPT", "SETUP_FINALLY"):
+        # A handler starts with the exception pushed, and in Python 3
+        # the exception state it replaces too; 3 values each.
+        return (0, 6) if version_tuple >= (3, 0) else (0, 3)
+    elif opname == "SETUP_WITH":
+        if version_tuple >= (3, 7):
+            return (1, 6)
+        return (1, 7) if version_tuple >= (3, 0) else (1, 4)
+    elif opname == "SETUP_ASYNC_WITH":
+        return (0, 5)
+    elif opname == "CALL_FINALLY":
+        return (0, 1)
+    return None
+
+
+def nargs(arg: int) -> int:
+    """
+    Return the number of stack entries for the arguments of a call
+    before Python 3.6: positional arguments in the low byte of `arg`,
+    and keyword arguments, which take two entries each, in the next.
+    """
+    return (arg & 0xFF) + 2 * ((arg >> 8) & 0xFF)
+
+
+def operand_effect(opname: str, arg: int, version_tuple: tuple) -> Optional[int]:
+    """
+    Return the stack effect of an `opname` instruction with operand
+    `arg`, for opcodes whose effect depends on the operand, or None.
+    """
+    if opname in ("BUILD_TUPLE", "BUILD_LIST", "BUILD_SET", "BUILD_STRING"):
+        return 1 - arg
+    elif opname in (
+        "BUILD_TUPLE_UNPACK",
+        "BUILD_TUPLE_UNPACK_WITH_CALL",
+        "BUILD_LIST_UNPACK",
+        "BUILD_SET_UNPACK",
+        "BUILD_MAP_UNPACK",
+    ):
+        return 1 - arg
+    elif opname == "BUILD_MAP_UNPACK_WITH_CALL":
+        return 1 - (arg & 0xFF if version_tuple < (3, 6) else arg)
+    elif opname == "BUILD_MAP":
+        return 1 - 2 * arg if version_tuple >= (3, 5) else 1
+    elif opname == "BUILD_CONST_KEY_MAP":
+        return -arg
+    elif opname == "BUILD_SLICE":
+        return -2 if arg == 3 else -1
+    elif opname == "UNPACK_SEQUENCE":
+        return arg - 1
+    elif opname == "UNPACK_EX":
+        return (arg & 0xFF) + (arg >> 8)
+    elif opname == "RAISE_VARARGS":
+        return -arg
+    elif opname == "DUP_TOPX":
+        return arg
+    elif opname == "FORMAT_VALUE":
+        # Bit 2 says whether there is a format spec.
+        return -1 if arg & 0x04 else 0
+    elif opname == "CALL_FUNCTION":
+        return -arg if version_tuple >= (3, 6) else -nargs(arg)
+    elif opname == "CALL_FUNCTION_KW":
+        return -arg - 1 if version_tuple >= (3, 6) else -nargs(arg) - 1
+    elif opname == "CALL_FUNCTION_VAR":
+        return -nargs(arg) - 1
+    elif opname == "CALL_FUNCTION_VAR_KW":
+        return -nargs(arg) - 2
+    elif opname == "CALL_FUNCTION_EX":
+        return (-2 if version_tuple >= (3, 11) else -1) - (arg & 0x01)
+    elif opname == "CALL_METHOD":
+        return -arg - 1
+    elif opname == "PRECALL":
+        return -arg
+    elif opname == "CALL":
+        return -arg - 1 if version_tuple >= (3, 12) else -1
+    elif opname in ("MAKE_FUNCTION", "MAKE_CLOSURE"):
+        if version_tuple >= (3, 6):
+            # One entry for each of the flags in the low 4 bits, and
+            # before 3.11 the qualified name.
+            effect = -bin(arg & 0x0F).count("1")
+            return effect - 1 if version_tuple < (3, 11) else effect
+        if version_tuple >= (3, 0):
+            # Default arguments, and annotations counted in the high bits.
+            effect = -nargs(arg) - ((arg >> 16) & 0x7FFF)
+            if version_tuple >= (3, 3):
+                effect -= 1  # the qualified name
+        else:
+            effect = -arg
+        if opname == "MAKE_CLOSURE":
+            effect -= 1  # the tuple of cells
+        return effect
+    return None
+
+
+def max_stack_depth(
+    opcodes: list,
+    args: list,
+    targets: list,
+    optable,
+    handlers: Iterable[Tuple[int, int]] = (),
+) -> Tuple[int, List[str]]:
+    """
+    Return the maximum stack depth reached by the instructions given as
+    in layout_instructions(): their `opcodes`, their `args`, and the
+    index of the instruction each one jumps to in `targets`, or -1.
+
+    `handlers` gives (instruction index, stack depth) of other places
+    where execution can start, such as exception handlers.
+
+    Also returned is a list of problems found, such as the stack
+    going below empty, or an instruction reached with different depths.
+    """
+    opc = optable.opc
+    opname = optable.opname
+    version_tuple = optable.version_tuple
+    n = len(opcodes)
+    depths = [-1] * n
+    problems = []
+    max_depth = 0
+
+    worklist = []
+
+    def reach(index: int, depth: int, from_index: int) -> None:
+        if index >= n:
+            return
+        if depths[index] < 0:
+            depths[index] = depth
+            worklist.append(index)
+        elif depths[index] != depth:
+            problems.append(
+                f"instruction {index} reached from instruction {from_index} "
+                f"with stack depth {depth}, but elsewhere with {depths[index]}"
+            )
+            if depth > depths[index]:
+                depths[index] = depth
+                worklist.append(index)
+
+    start_depth = 0
+    if n and opname[opcodes[0]] == "GEN_START":
+        # The value sent to start the generator.
+        start_depth = 1
+    reach(0, start_depth, 0)
+    for index, depth in handlers:
+        reach(index, depth, index)
+
+    # (effect when not jumping, effect when jumping) by opcode and operand.
+    effect_cache = {}
+
+    def effects_of(opcode: int, arg: int, i: int) -> Tuple[int, int]:
+        name = opname[opcode]
+        effects = branch_effects(name, version_tuple)
+        if effects is None:
+            effect = operand_effect(name, arg, version_tuple)
+            if effect is not None:
+                pass
+            elif name == "RETURN_GENERATOR":
+                # The value sent when the generator is resumed.
+                effect = 1
+            else:
+                effect = xstack_effect(opcode, opc, arg)
+                if effect is None or effect == -100:
+                    problems.append(
+                        f"instruction {i} {name}: stack effect unknown; taken as 0"
+                    )
+                    effect = 0
+            effects = (effect, effect)
+        effect_cache[opcode, arg] = effects
+        return effects
+
+    while worklist:
+        i = worklist.pop()
+        depth = depths[i]
+        while i < n:
+            opcode = opcodes[i]
+            arg = args[i] if args[i] is not None else 0
+            effects = effect_cache.get((opcode, arg))
+            if effects is None:
+                effects = effects_of(opcode, arg, i)
+            effect, jump_effect = effects
+
+            if targets[i] >= 0:
+                jump_depth = depth + jump_effect
+                max_depth = max(max_depth, jump_depth)
+                reach(targets[i], jump_depth, i)
+
+            depth += effect
+            if depth < 0:
+                problems.append(f"instruction {i} {opname[opcode]}: stack underflow")
+                depth = 0
+            max_depth = max(max_depth, depth)
+
+            if opname[opcode] in TERMINATOR_NAMES:
+                break
+            i += 1
+            if i < n:
+                if depths[i] >= 0:
+                    # Already walked from here.
+                    reach(i, depth, i - 1)
+                    break
+                depths[i] = depth
+    return max_depth, problems
@@ -1,5 +1,9 @@
+import marshal
+import os
+import os.path as osp
 import time
 from struct import pack
+from types import CodeType
 from typing import Optional
 
 import xdis
@@ -9,48 +13,129 @@ from xdis.marsh import dumps
 from xdis.version_info import PYTHON3, version_tuple_to_str
 
 
-def write_pycfile(
-    fp,
-    code_list,
-    timestamp=None,
+def pyc_header(
     version_triple=xdis.PYTHON_VERSION_TRIPLE,
+    timestamp=None,
     is_pypy: Optional[bool] = None,
-) -> int:
-    rc = 0
+) -> bytes:
+    """
+    Return the header of a bytecode file for `version_triple`: the magic
+    number, flags, timestamp and source size, as the version has them.
+    """
     version_str = version_tuple_to_str(version_triple, end=2)
     if is_pypy:
         version_str += "pypy"
     magic_bytes = magics[version_str]
     magic_int = magic2int(magic_bytes)
-    fp.write(magic_bytes)
 
     if timestamp is None:
         timestamp = int(time.time())
-    write_source_size = version_triple >= (3, 3)
     if version_triple >= (3, 7):
         if magic_int == 3393:
-            fp.write(pack("I", timestamp))
-            fp.write(pack("I", 0))
+            header = pack("I", timestamp) + pack("I", 0)
         else:
             # PEP 552. https://www.python.org/dev/peps/pep-0552/
             # 0 in the lowest-order bit means used old-style timestamps
-            fp.write(pack("<I", 0))
-            fp.write(pack("<I", timestamp))
+            header = pack("<I", 0) + pack("<I", timestamp)
     else:
-        fp.write(pack("<I", timestamp))
+        header = pack("<I", timestamp)
+
+    if version_triple >= (3, 3):
+        header += pack("<I", 0)  # size mod 2**32
+    return magic_bytes + header
+
 
-    if write_source_size:
-        fp.write(pack("<I", 0))  # size mod 2**32
+def marshal_code(co, version_triple, is_pypy: Optional[bool] = None) -> bytes:
+    """
+    Return code object `co` marshalled for `version_triple`. Native code
+    objects, built when that is the running Python's version, go through
+    the marshal module, which is faster and writes what the running
+    Python reads back. Bytes are taken as already marshalled.
+    """
+    if isinstance(co, bytes):
+        # Already marshalled, e.g. from xasm.cache.
+        return co
+    if isinstance(co, CodeType):
+        return marshal.dumps(co)
+    data = dumps(co, python_version=version_triple, is_pypy=is_pypy)
+    if PYTHON3 and isinstance(data, str):
+        data = data.encode("latin-1")
+    return data
 
+
+def dumps_pyc(
+    code_list,
+    timestamp=None,
+    version_triple=xdis.PYTHON_VERSION_TRIPLE,
+    is_pypy: Optional[bool] = None,
+) -> bytes:
+    """
+    Return the contents of a bytecode file holding `code_list`. Unlike
+    write_pycfile(), a code object that can't be marshalled raises an
+    exception rather than being left out.
+    """
+    chunks = [pyc_header(version_triple, timestamp, is_pypy)]
     for co in code_list:
-        try:
-            co_obj = dumps(co, python_version=version_triple, is_pypy=is_pypy)
-            if PYTHON3 and version_triple < (3, 0):
-                co_obj = str.encode(co_obj)
-                pass
+        chunks.append(marshal_code(co, version_triple, is_pypy))
+    return b"".join(chunks)
+
 
-            fp.write(co_obj)
+def pyc_bytes(code_list, timestamp, version_triple, is_pypy) -> tuple:
+    """
+    Return a return code and the contents of a bytecode file holding
+    `code_list`, leaving out, with a message, code objects that can't
+    be marshalled.
+    """
+    rc = 0
+    chunks = [pyc_header(version_triple, timestamp, is_pypy)]
+    for co in code_list:
+        try:
+            chunks.append(marshal_code(co, version_triple, is_pypy))
         except Exception as e:
             print(f"error dumping {co}: {e}; ignoring")
             rc = 1
+    return rc, b"".join(chunks)
+
+
+def write_pycfile(
+    fp,
+    code_list,
+    timestamp=None,
+    version_triple=xdis.PYTHON_VERSION_TRIPLE,
+    is_pypy: Optional[bool] = None,
+) -> int:
+    rc, data = pyc_bytes(code_list, timestamp, version_triple, is_pypy)
+    fp.write(data)
+    return rc
+
+
+def write_pycfile_atomic(
+    path: str,
+    code_list,
+    timestamp=None,
+    version_triple=xdis.PYTHON_VERSION_TRIPLE,
+    is_pypy: Optional[bool] = None,
+    fsync: bool = False,
+) -> int:
+    """
+    Write a bytecode file holding `code_list` to `path`, as
+    write_pycfile() does, so that readers of `path` see either the old
+    file or the whole new one: the bytecode goes to a temporary file in
+    the same directory, which then replaces `path`. With `fsync`, it is
+    also flushed to disk first.
+    """
+    rc, data = pyc_bytes(code_list, timestamp, version_triple, is_pypy)
+    tmp_path = osp.join(
+        osp.dirname(path), f".{osp.basename(path)}.tmp{os.getpid()}"
+    )
+    try:
+        with open(tmp_path, "wb") as fp:
+            fp.write(data)
+            if fsync:
+                fp.flush()
+                os.fsync(fp.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if osp.exists(tmp_path):
+            os.remove(tmp_path)
     return rc
@@ -1,61 +1,545 @@
 #!/usr/bin/env python
 import os
+import os.path as osp
 import sys
-from typing import List
+from contextlib import redirect_stdout
+from io import StringIO
+from typing import List, Optional, Tuple
 
 import click
-import xdis
-from xdis.version_info import version_tuple_to_str
 
-from xasm.assemble import asm_file
-from xasm.write_pyc import write_pycfile
+# xdis and the rest of xasm are imported only once they are needed,
+# so that, for example, "pyc-xasm --help" starts quickly. Use
+# pytest/test_import_time.py to check import times.
 
+ASM_SUFFIXES = (".pyasm", ".xasm")
 
-@click.command()
-@click.option("--pyc-file", default=None)
-@click.argument("asm-path", type=click.Path(exists=True, readable=True), required=True)
-def main(pyc_file: List[str], asm_path):
+# Default for --cache-size in megabytes; see xasm.cache.DEFAULT_MAX_SIZE.
+DEFAULT_CACHE_MEGABYTES = 64
+
+
+def default_pyc_path(asm_path: str) -> Optional[str]:
+    from xasm.ir import IR_SUFFIX
+
+    for suffix in ASM_SUFFIXES + (IR_SUFFIX,):
+        if asm_path.endswith(suffix):
+            return asm_path[: -len(suffix)] + ".pyc"
+    return None
+
+
+def expand_asm_paths(asm_paths, output_dir: Optional[str]) -> List[Tuple[str, str]]:
+    """
+    Return (assembly file, bytecode file) pairs for the files and
+    directories in `asm_paths`. Directories are searched recursively for
+    files ending in .pyasm or .xasm. If `output_dir` is given, bytecode
+    files go there, with the directory structure under each directory
+    argument repeated; otherwise they go next to the assembly file.
     """
-    Create Python bytecode from a Python assembly file.
+    pairs = []
+    for asm_path in asm_paths:
+        if osp.isdir(asm_path):
+            found = []
+            for dirpath, dirnames, filenames in os.walk(asm_path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if filename.endswith(ASM_SUFFIXES):
+                        found.append(osp.join(dirpath, filename))
+            top = asm_path
+        else:
+            found = [asm_path]
+            top = osp.dirname(asm_path)
+        for path in found:
+            pyc_path = default_pyc_path(path) or path + ".pyc"
+            if output_dir is not None:
+                pyc_path = osp.join(output_dir, osp.relpath(pyc_path, top))
+            pairs.append((path, pyc_path))
+    return pairs
 
-    ASM_PATH gives the input Python assembly file. We suggest ending the
-    file in .pyc
 
-    If --pyc-file is given, that indicates the path to write the
-    Python bytecode. The path should end in '.pyc'.
+def assemble_one(
+    asm_path: str,
+    pyc_file: str,
+    incremental: bool = False,
+    cache=None,
+    stdout=None,
+    compute_stacksize: bool = False,
+    optimize: bool = False,
+    fold_constants: bool = False,
+    trusted: bool = False,
+    emit_ir: bool = False,
+    fsync: bool = False,
+) -> int:
+    """
+    Assemble `asm_path`, "-" for standard input, into `pyc_file`, "-"
+    for `stdout`, printing what was done. Returns a return code.
 
-    See https://github.com/rocky/python-xasm/blob/master/HOW-TO-USE.rst
-    for how to write a Python assembler file.
+    With `emit_ir`, the parsed listing is written to `pyc_file` in the
+    binary form of xasm.ir instead.
     """
-    if os.stat(asm_path).st_size == 0:
-        print(f"Size of assembly file {asm_path} is zero")
-        sys.exit(1)
-    asm = asm_file(asm_path)
+    if emit_ir:
+        from xasm.ir import write_ir_file
 
-    if not pyc_file:
-        if asm_path.endswith(".pyasm"):
-            pyc_file = asm_path[: -len(".pyasm")] + ".pyc"
-        elif not pyc_file and asm_path.endswith(".xasm"):
-            pyc_file = asm_path[: -len(".xasm")] + ".pyc"
+        if asm_path == "-" or pyc_file == "-":
+            print("--emit-ir needs an assembly file and an output file")
+            return 1
+        if not write_ir_file(asm_path, pyc_file):
+            print(f"No Python bytecode was assembled from {asm_path}")
+            return 1
+        print(f'Wrote IR file "{pyc_file}"; {os.stat(pyc_file).st_size} bytes.')
+        return 0
+
+    from xdis.version_info import version_tuple_to_str
 
-    if xdis.PYTHON3:
-        file_mode = "wb"
+    from xasm.assemble import asm_file, asm_stream
+    from xasm.incremental import MethodCache, sidecar_path
+    from xasm.write_pyc import pyc_bytes, write_pycfile_atomic
+
+    method_cache = None
+    if incremental and pyc_file != "-":
+        method_cache = MethodCache.load(sidecar_path(pyc_file))
+
+    if asm_path == "-":
+        asm = asm_stream(
+            sys.stdin,
+            keep_instructions=False,
+            method_cache=method_cache,
+            compute_stacksize=compute_stacksize,
+            optimize=optimize,
+            fold_constants=fold_constants,
+            trusted=trusted,
+        )
     else:
-        file_mode = "w"
+        if os.stat(asm_path).st_size == 0:
+            print(f"Size of assembly file {asm_path} is zero")
+            return 1
+        asm = asm_file(
+            asm_path,
+            keep_instructions=False,
+            method_cache=method_cache,
+            cache=cache,
+            compute_stacksize=compute_stacksize,
+            optimize=optimize,
+            fold_constants=fold_constants,
+            trusted=trusted,
+        )
 
-    with open(pyc_file, file_mode) as fp:
-        rc = write_pycfile(
-            fp, asm.code_list, asm.timestamp, asm.python_version, asm.is_pypy
+    if asm is None:
+        print(f"No Python bytecode was assembled from {asm_path}")
+        return 1
+
+    if pyc_file == "-":
+        rc, data = pyc_bytes(
+            asm.code_list, asm.timestamp, asm.python_version, asm.is_pypy
+        )
+        stdout.buffer.write(data)
+        stdout.flush()
+        size = len(data)
+        pyc_file = "<stdout>"
+    else:
+        # Importers, or other builds, reading pyc_file see either the
+        # old file or the whole new one.
+        rc = write_pycfile_atomic(
+            pyc_file,
+            asm.code_list,
+            asm.timestamp,
+            asm.python_version,
+            asm.is_pypy,
+            fsync=fsync,
         )
-        size = fp.tell()
+        size = os.stat(pyc_file).st_size
+        if method_cache is not None and rc == 0:
+            method_cache.save(sidecar_path(pyc_file))
+            print(
+                f"{method_cache.hits} method(s) reused, {method_cache.misses} assembled."
+            )
     print(
         f"""Wrote Python {version_tuple_to_str(asm.python_version)} bytecode file "{pyc_file}"; {size} bytes."""
     )
     if size <= 16:
         print("Warning: bytecode file is too small to be usable.")
         rc = 2
-    if rc != 0:
-        print(f"Exiting with return code {rc}")
+    return rc
+
+
+def batch_worker(
+    asm_path: str,
+    pyc_file: str,
+    incremental: bool,
+    cache_dir,
+    cache_size: int,
+    compute_stacksize: bool = False,
+    optimize: bool = False,
+    fold_constants: bool = False,
+    trusted: bool = False,
+    emit_ir: bool = False,
+    fsync: bool = False,
+) -> Tuple[int, str, int, int]:
+    """
+    Run assemble_one() in a worker process. Returns the return code,
+    the messages printed, and cache hit and miss counts.
+    """
+    from xasm.cache import AssemblyCache
+
+    cache = None
+    if cache_dir is not None:
+        cache = AssemblyCache(cache_dir, cache_size)
+    out = StringIO()
+    with redirect_stdout(out):
+        try:
+            pyc_dir = osp.dirname(pyc_file)
+            if pyc_dir:
+                os.makedirs(pyc_dir, exist_ok=True)
+            rc = assemble_one(
+                asm_path,
+                pyc_file,
+                incremental,
+                cache,
+                compute_stacksize=compute_stacksize,
+                optimize=optimize,
+                fold_constants=fold_constants,
+                trusted=trusted,
+                emit_ir=emit_ir,
+                fsync=fsync,
+            )
+        except Exception as e:
+            print(f"Error assembling {asm_path}: {e}")
+            rc = 1
+    return (
+        rc,
+        out.getvalue(),
+        cache.hits if cache else 0,
+        cache.misses if cache else 0,
+    )
+
+
+def run_batch(
+    pairs,
+    jobs: int,
+    incremental: bool,
+    cache_dir,
+    cache_size: int,
+    compute_stacksize: bool = False,
+    optimize: bool = False,
+    fold_constants: bool = False,
+    trusted: bool = False,
+    emit_ir: bool = False,
+    fsync: bool = False,
+) -> int:
+    """
+    Assemble each (assembly file, bytecode file) pair of `pairs` in a
+    pool of `jobs` processes, so xdis is imported just once per
+    process. Prints each file's messages and return code, then a
+    summary. The return code is the largest of those of the files.
+    """
+    worker_args = [
+        (
+            asm_path,
+            pyc_file,
+            incremental,
+            cache_dir,
+            cache_size,
+            compute_stacksize,
+            optimize,
+            fold_constants,
+            trusted,
+            emit_ir,
+            fsync,
+        )
+        for asm_path, pyc_file in pairs
+    ]
+    if jobs > 1 and len(pairs) > 1:
+        import concurrent.futures
+
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+        results = executor.map(batch_worker, *zip(*worker_args))
+    else:
+        executor = None
+        results = (batch_worker(*args) for args in worker_args)
+
+    counts = {}
+    hits = misses = 0
+    max_rc = 0
+    try:
+        for (asm_path, _), (rc, output, file_hits, file_misses) in zip(
+            pairs, results
+        ):
+            sys.stdout.write(output)
+            print(f"{asm_path}: return code {rc}")
+            counts[rc] = counts.get(rc, 0) + 1
+            hits += file_hits
+            misses += file_misses
+            max_rc = max(max_rc, rc)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    summary = ", ".join(
+        f"{count} with return code {rc}" for rc, count in sorted(counts.items())
+    )
+    print(f"Assembled {len(pairs)} file(s): {summary}.")
+    if cache_dir is not None:
+        print(f"Assembly cache {cache_dir}: {hits} hit(s), {misses} miss(es).")
+    return max_rc
+
+
+@click.command()
+@click.option("--pyc-file", default=None)
+@click.option(
+    "--incremental/--no-incremental",
+    default=False,
+    help="Reuse code objects of methods that haven't changed since the last run.",
+)
+@click.argument(
+    "asm-path",
+    nargs=-1,
+    type=click.Path(exists=True, readable=True, allow_dash=True),
+)
+@click.option(
+    "--cache-dir",
+    default=None,
+    type=click.Path(file_okay=False),
+    help="Directory of a cache of assembled bytecode, shared between runs.",
+)
+@click.option(
+    "--cache-size",
+    default=DEFAULT_CACHE_MEGABYTES,
+    show_default=True,
+    help="Size limit of --cache-dir in megabytes.",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    default=1,
+    type=click.IntRange(min=1),
+    help="Number of processes to assemble files in.",
+)
+@click.option(
+    "--output-dir",
+    default=None,
+    type=click.Path(file_okay=False),
+    help="Directory to write bytecode files to, mirroring the input directories.",
+)
+@click.option(
+    "--compute-stack-size/--no-compute-stack-size",
+    "compute_stacksize",
+    default=False,
+    help="Compute the stack size of each method rather than use the one given.",
+)
+@click.option(
+    "--optimize/--no-optimize",
+    default=False,
+    help="Run a peephole optimizer over each method, reporting what it changed.",
+)
+@click.option(
+    "--fold-constants/--no-fold-constants",
+    default=False,
+    help="Do arithmetic and build tuples of constants at assembly time.",
+)
+@click.option(
+    "--trusted/--no-trusted",
+    default=False,
+    help="Don't check operands; for listings that are known to be valid.",
+)
+@click.option(
+    "--emit-ir",
+    is_flag=True,
+    default=False,
+    help="Write the parsed listing in a binary form that loads faster, not bytecode.",
+)
+@click.option(
+    "--fsync/--no-fsync",
+    default=False,
+    help="Flush each bytecode file to disk before it replaces the old one.",
+)
+@click.option(
+    "--serve",
+    "socket_path",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help="Assemble listings sent over this Unix-domain socket; see xasm.server.",
+)
+def main(
+    pyc_file: List[str],
+    incremental: bool,
+    cache_dir,
+    cache_size: int,
+    jobs: int,
+    output_dir,
+    compute_stacksize: bool,
+    optimize: bool,
+    fold_constants: bool,
+    trusted: bool,
+    emit_ir: bool,
+    fsync: bool,
+    socket_path,
+    asm_path,
+):
+    """
+    Create Python bytecode from Python assembly files.
+
+    ASM_PATH gives the input Python assembly file. We suggest ending the
+    file in .pyc. If ASM_PATH is "-", the assembly text is read from
+    standard input.
+
+    If --pyc-file is given, that indicates the path to write the
+    Python bytecode. The path should end in '.pyc'. If it is "-", or if
+    it is not given and input comes from standard input, the bytecode
+    is written to standard output, and messages go to standard error.
+
+    More than one ASM_PATH can be given, and an ASM_PATH can be a
+    directory, which is searched for files ending in .pyasm or .xasm.
+    The files are assembled in --jobs processes. Bytecode files are
+    written next to the assembly files, or under --output-dir if that
+    is given. The return code of each file is printed, followed by a
+    summary.
+
+    With --incremental, fingerprints of each method and the code
+    objects built for them are saved in a file next to the bytecode
+    file, and methods whose fingerprint hasn't changed are not
+    assembled again on the next run. This is ignored when writing to
+    standard output.
+
+    With --cache-dir, assembled bytecode is saved in that directory
+    keyed by a hash of the assembly text, and reused whenever the same
+    text is assembled again. Least-recently-used entries are removed
+    when the directory grows past --cache-size.
+
+    With --compute-stack-size, the stack size of each method is worked
+    out from its instructions, and a warning is given when it differs
+    from the "# Stack size:" of the listing.
+
+    With --optimize, jumps to jumps and to returns are shortened, and
+    unreachable code, NOPs, and constants loaded only to be popped are
+    removed; see xasm.peephole. What was changed in each method is
+    printed.
+
+    With --fold-constants, arithmetic, subscripts, and tuples and sets
+    built from constants are worked out at assembly time and loaded as
+    constants, within the size limits CPython's compiler uses.
+
+    With --trusted, the operands of instructions aren't checked against
+    the tables of constants, names and variables, nor are method endings
+    and exception handlers; use it for machine-generated listings that
+    are known to be valid. Without it, the problems found in each method
+    are printed together, and no bytecode is written.
+
+    With --emit-ir, the parsed listing is written in a binary form,
+    to a file ending in .xasmir by default, instead of bytecode. Give
+    that file as ASM_PATH to assemble it without parsing text again,
+    with any of the options above; see xasm.ir.
+
+    Bytecode files are written to a temporary file that then replaces
+    the old one, so that nothing ever sees a partly written file. With
+    --fsync, the new file is also flushed to disk first.
+
+    With --serve SOCKET, no ASM_PATH is given. Instead, pyc-xasm stays
+    running and assembles listings sent to it over the Unix-domain
+    socket SOCKET, replying with bytecode and messages.
+    xasm.server.AssemblerClient sends such requests. The assembly
+    options --compute-stack-size, --optimize, --fold-constants and
+    --trusted are used for requests that don't give their own.
+
+    See https://github.com/rocky/python-xasm/blob/master/HOW-TO-USE.rst
+    for how to write a Python assembler file.
+    """
+    if socket_path is not None:
+        if asm_path:
+            raise click.UsageError("ASM_PATH can't be given with --serve.")
+        if (
+            pyc_file
+            or incremental
+            or cache_dir
+            or jobs != 1
+            or output_dir
+            or emit_ir
+            or fsync
+        ):
+            raise click.UsageError(
+                "Only the assembly options --compute-stack-size, --optimize, "
+                "--fold-constants and --trusted can be given with --serve."
+            )
+        from xasm.server import serve
+
+        serve(
+            socket_path,
+            {
+                "compute_stacksize": compute_stacksize,
+                "optimize": optimize,
+                "fold_constants": fold_constants,
+                "trusted": trusted,
+            },
+        )
+        sys.exit(0)
+    if not asm_path:
+        raise click.UsageError("Missing argument 'ASM_PATH...'.")
+
+    cache_size *= 1024 * 1024
+    if len(asm_path) > 1 or osp.isdir(asm_path[0]) or output_dir is not None:
+        if pyc_file or "-" in asm_path:
+            raise click.UsageError(
+                "--pyc-file and - can only be used with a single assembly file."
+            )
+        pairs = expand_asm_paths(asm_path, output_dir)
+        if emit_ir:
+            from xasm.ir import ir_path
+
+            pairs = [(path, ir_path(pyc_path)) for path, pyc_path in pairs]
+        sys.exit(
+            run_batch(
+                pairs,
+                jobs,
+                incremental,
+                cache_dir,
+                cache_size,
+                compute_stacksize,
+                optimize,
+                fold_constants,
+                trusted,
+                emit_ir,
+                fsync,
+            )
+        )
+
+    asm_path = asm_path[0]
+    if not pyc_file:
+        if asm_path == "-":
+            pyc_file = "-"
+        else:
+            pyc_file = default_pyc_path(asm_path)
+            if emit_ir and pyc_file is not None:
+                from xasm.ir import ir_path
+
+                pyc_file = ir_path(pyc_file)
+
+    cache = None
+    if cache_dir is not None:
+        from xasm.cache import AssemblyCache
+
+        cache = AssemblyCache(cache_dir, cache_size)
+
+    # When bytecode goes to standard output, keep anything
+    # printed out of it.
+    stdout = sys.stdout
+    message_fp = sys.stderr if pyc_file == "-" else stdout
+
+    with redirect_stdout(message_fp):
+        rc = assemble_one(
+            asm_path,
+            pyc_file,
+            incremental,
+            cache,
+            stdout,
+            compute_stacksize,
+            optimize,
+            fold_constants,
+            trusted,
+            emit_ir,
+            fsync,
+        )
+        if cache is not None:
+            print(cache.report())
+        if rc != 0:
+            print(f"Exiting with return code {rc}")
     sys.exit(rc)
 
 